@@ -1,4 +1,6 @@
-from .compiler import ParseResult
+from .cache import GrammarCache
+
+from .compiler import Grammar, ParseResult, PassManager, shared_grammar
 
 from .expressions import (
     Alt,
@@ -7,6 +9,7 @@ from .expressions import (
     AnyOf,
     Backtrack,
     Bind,
+    Commit,
     End,
     Expect,
     Fail,
@@ -14,6 +17,8 @@ from .expressions import (
     Left,
     List,
     Literal,
+    Memo,
+    NoMemo,
     Not,
     Opt,
     Or,
@@ -29,13 +34,24 @@ from .expressions import (
 )
 
 from .interpreter import (
+    IncrementalParser,
+    ParseBudget,
+    ParseBudgetExceeded,
     ParseError,
+    Parser,
+    iterparse,
     parse,
+    parse_async,
+    parse_many,
+    parse_parallel,
     parse_prefix,
+    recognize,
     tokenize,
     tokenize_and_parse,
 )
 
+from .memo import BindCache, WindowedMemo
+
 from .precedence import (
     InfixLeft,
     InfixRight,
@@ -49,6 +65,8 @@ from .precedence import (
     RightAssoc,
 )
 
+from .profiler import ParseProfile, ParseTrace, RuleStats, TraceEvent
+
 from .tokens import (
     AnyChar,
     AnyString,
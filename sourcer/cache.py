@@ -0,0 +1,243 @@
+import hashlib
+import imp
+import marshal
+import os
+import re
+import tempfile
+from .compiler import (
+    _Dispatch,
+    _Fusion,
+    _LiteralChoice,
+    _OrParser,
+    _Scan,
+    _child_parsers,
+    _plan,
+    _regex_type,
+    _token_instance_parser,
+)
+
+
+# Change this number whenever the format of the cache files changes.
+_FORMAT = 1
+
+
+class GrammarCache(object):
+    '''
+    Keeps the costly parts of compiling a grammar in a directory, so that a
+    new process can load them instead of working them out again. Pass it to
+    ``parse`` (and the other parsing functions) as the ``cache`` argument.
+
+    The cache holds two kinds of files. A plan file holds the compiler's
+    analysis of a grammar (which parsers to memoize, which ones always
+    succeed, the left-recursive cycles and the dispatch tables), keyed by a
+    fingerprint of the grammar's structure. A code file holds the bytecode
+    that the "codegen" backend compiles, keyed by the generated source.
+
+    Grammars contain Python functions, which can't be saved, so the compiler
+    still builds the graph of parsers from the expressions. That part is
+    cheap. A grammar whose fingerprint changes (say, because you edited a
+    rule) just gets new files. The files are only readable by the same
+    version of Python.
+
+    The ``hits`` and ``misses`` attributes count the lookups.
+
+    Example::
+
+        import tempfile
+        from sourcer import *
+
+        class Pair(Struct):
+            def parse(self):
+                self.left = Pattern(r'\\d+') * int
+                self.right = ',' >> Pattern(r'\\d+') * int
+
+        cache = GrammarCache(tempfile.mkdtemp())
+        parse(Pair, '1,2')
+        # Pair is already compiled, but not with the cache.
+        parse(Pair, '1,2', cache=cache)
+        # A new Grammar compiles Pair again, like a new process would.
+        ans = parse(Grammar(Pair), '3,4', cache=cache)
+        assert (ans.left, ans.right) == (3, 4)
+        assert cache.misses == 1 and cache.hits == 1
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def plan(self, root, hints, is_text=True):
+        # Loads the plan of a newly compiled parser graph, or makes it and
+        # saves it. (See compiler._plan.)
+        nodes = _nodes(root)
+        indexes = dict((id(node), index) for index, node in enumerate(nodes))
+        fingerprint = repr((is_text, [_describe(i, indexes, hints)
+            for i in nodes]))
+        path = self._path('plan', fingerprint)
+        entries = self._load(path)
+        if entries is not None and len(entries) == len(nodes):
+            self.hits += 1
+            _apply_plan(nodes, entries, is_text)
+            return
+        self.misses += 1
+        _plan(root, hints, is_text)
+        # First sets refer to token classes by the index of a leaf that
+        # matches the class.
+        classes = dict((id(node.arg), index)
+            for index, node in enumerate(nodes)
+            if getattr(node, 'factory', None) is _token_instance_parser)
+        self._save(path, [_save_plan(i, indexes, classes) for i in nodes])
+
+    def code(self, source, filename='<sourcer>'):
+        # Returns the code object for the source of a generated program.
+        path = self._path('code', source)
+        code = self._load(path)
+        if code is not None:
+            self.hits += 1
+            return code
+        self.misses += 1
+        code = compile(source, filename, 'exec')
+        self._save(path, code)
+        return code
+
+    def _path(self, kind, key):
+        digest = hashlib.sha1()
+        for part in (str(_FORMAT), imp.get_magic(), kind, key):
+            digest.update(part.encode('utf-8') if isinstance(part, unicode)
+                else part)
+        return os.path.join(self.directory, digest.hexdigest() + '.' + kind)
+
+    def _load(self, path):
+        # Returns None if the file is missing or damaged.
+        try:
+            with open(path, 'rb') as f:
+                return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def _save(self, path, value):
+        # Write to a temporary file first, so that other processes never see
+        # a partial file. If the rename fails (because another process beat
+        # us to it, say), we just keep the other file.
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(value, f)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            if os.path.exists(temp):
+                os.remove(temp)
+
+
+def _nodes(root):
+    # Returns the parsers of a graph in depth-first order, which is the same
+    # for every graph with the same structure.
+    ans = []
+    visited = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        ans.append(node)
+        stack.extend(reversed(_child_parsers(node)))
+    return ans
+
+
+def _describe(parser, indexes, hints):
+    # Returns a description of everything about a parser that may affect its
+    # plan. (But not its functions, which don't.)
+    children = tuple(indexes[id(i)] for i in _child_parsers(parser))
+    hint = hints.get(id(parser))
+    factory = getattr(parser, 'factory', None)
+    if factory is not None:
+        return (factory.__name__, _describe_value(parser.arg), children, hint)
+    name = getattr(parser, '__name__', parser.__class__.__name__)
+    return (name, getattr(parser, 'collect', None), children, hint)
+
+
+def _describe_value(value):
+    if isinstance(value, _regex_type):
+        return ('regex', value.pattern, value.flags)
+    if isinstance(value, _Fusion):
+        return ('fusion', value.pattern)
+    if isinstance(value, _Scan):
+        return ('scan', value.fusion.pattern, value.collect)
+    if isinstance(value, _LiteralChoice):
+        return ('choice', tuple(value.strings), value.is_text)
+    if isinstance(value, type):
+        return ('class', value.__module__, value.__name__)
+    return ('value', repr(value))
+
+
+def _save_plan(parser, indexes, classes):
+    # Returns a tuple with the plan of a parser, using indexes in place of
+    # parsers and classes, and patterns in place of regexes.
+    encode = lambda first: _encode_first(first, classes)
+    left_recursion = getattr(parser, 'left_recursion', None)
+    if left_recursion is not None:
+        left_recursion = [indexes[id(i)] for i in left_recursion]
+    dispatch = getattr(parser, 'dispatch', None)
+    if dispatch is not None:
+        dispatch = [encode(i) for i in dispatch.choices]
+    return (
+        getattr(parser, 'memoize', True),
+        getattr(parser, 'always_succeeds', False),
+        left_recursion,
+        encode(getattr(parser, 'first', None)),
+        dispatch,
+    )
+
+
+def _encode_first(first, classes):
+    if first is None:
+        return None
+    ans = []
+    for kind, arg in first:
+        if kind == 'regex':
+            ans.append((kind, arg.pattern, arg.flags))
+        elif kind == 'class':
+            ans.append((kind, classes[id(arg)]))
+        else:
+            ans.append((kind, arg))
+    # Sort the items, since the order of a set depends on the ids of the
+    # classes in it.
+    return sorted(ans)
+
+
+def _apply_plan(nodes, entries, is_text):
+    # Gives each parser the plan that we loaded, unless it already has one.
+    # (Like the parsers that every grammar shares.)
+    regexes = {}
+    def decode(first):
+        if first is None:
+            return None
+        ans = []
+        for item in first:
+            if item[0] == 'regex':
+                key = item[1:]
+                if key not in regexes:
+                    regexes[key] = re.compile(*key)
+                ans.append(('regex', regexes[key]))
+            elif item[0] == 'class':
+                ans.append(('class', nodes[item[1]].arg))
+            else:
+                ans.append(item)
+        return frozenset(ans)
+
+    for node, entry in zip(nodes, entries):
+        memoize, always_succeeds, left_recursion, first, dispatch = entry
+        if not hasattr(node, 'memoize'):
+            node.memoize = memoize
+        if not hasattr(node, 'always_succeeds'):
+            node.always_succeeds = always_succeeds
+        if not hasattr(node, 'left_recursion'):
+            node.left_recursion = (None if left_recursion is None
+                else [nodes[i] for i in left_recursion])
+        if not hasattr(node, 'first'):
+            node.first = decode(first)
+            if isinstance(node, _OrParser):
+                node.dispatch = (None if dispatch is None
+                    else _Dispatch(is_text, [decode(i) for i in dispatch]))
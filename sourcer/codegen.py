@@ -0,0 +1,621 @@
+from .compiler import (
+    ParseFailure,
+    ParseResult,
+    ParseStep,
+    _BindParser,
+    _ExpectParser,
+    _LeftParser,
+    _ListParser,
+    _NotParser,
+    _OrParser,
+    _RequireParser,
+    _RightParser,
+    _SequenceParser,
+    _TokenParser,
+    _TransformParser,
+    _any_parser,
+    _backtrack_parser,
+    _child_parsers,
+    _commit_parser,
+    _end_parser,
+    _fail_parser,
+    _fused_text_parser,
+    _literal_choice_parser,
+    _literal_parser,
+    _make_token,
+    _none_parser,
+    _regex_text_parser,
+    _regex_token_parser,
+    _return_parser,
+    _scan_parser,
+    _start_parser,
+    _text_prefix_eq,
+    _token_content_eq,
+    _token_instance_parser,
+)
+
+
+# The code generator turns a parser graph into the source code of a Python
+# function called ``_build``. When called with an input sequence, ``_build``
+# defines one plain function per parser and returns the function for the root
+# parser. Each function takes a position and returns either a ``(value, pos)``
+# tuple or ``None``. So unlike the interpreter, the generated code doesn't
+# allocate a generator, a ParseStep, or a memo key for each step of the parse.
+#
+# The generated functions call one another directly, so very deeply nested
+# input can run into Python's recursion limit. (The interpreter doesn't have
+# this problem.)
+#
+# Left-recursive parsers follow the plan that the compiler made for them. The
+# head of each cycle gets a second function, which parses again and again
+# until its result stops getting longer. (See ``_plan_left_recursion``.)
+#
+# When the grammar uses Commit, the generated code keeps the position of the
+# last Commit in ``cut[0]``. Wherever a parser would recover from a failure
+# before that position, it raises a ``_Cut`` exception instead, which ends the
+# parse.
+
+
+def generate(parser, cache=None):
+    # Cache the program on the parser, the same way that ``compile`` caches
+    # the parser on the expression. The "cache" argument is an optional
+    # GrammarCache, which keeps the compiled code on disk.
+    program = getattr(parser, '_program', None)
+    if program is None:
+        program = Program(parser, cache)
+        parser._program = program
+    return program
+
+
+class _Cut(Exception):
+    pass
+
+
+class Program(object):
+    def __init__(self, parser, cache=None):
+        generator = _CodeGenerator(parser)
+        self.source = generator.generate()
+        self.constants = tuple(generator.constants)
+        namespace = {
+            'ParseFailure': ParseFailure,
+            'ParseResult': ParseResult,
+            'ParseStep': ParseStep,
+            'Cut': _Cut,
+            'commit': _commit_parser,
+            'lookaheads': (_ExpectParser, _NotParser),
+            'make_token': _make_token,
+        }
+        if cache is None:
+            code = compile(self.source, '<sourcer>', 'exec')
+        else:
+            code = cache.code(self.source)
+        exec code in namespace
+        self.build = namespace['_build']
+
+    def run(self, source, pos=0):
+        parser = self.build(source, self.constants)
+        try:
+            ans = parser(pos)
+        except _Cut:
+            return ParseFailure
+        return ParseFailure if ans is None else ParseResult(*ans)
+
+
+# These helper functions run any parser that the code generator doesn't know
+# about (like the parsers that Bind creates while parsing). They drive the
+# parser's generator the same way that the interpreter does, but they call the
+# generated functions whenever they can.
+_DYNAMIC_HELPERS = '''
+memo = {}
+def call(parser, pos):
+    function = table.get(parser)
+    return drive(parser, pos) if function is None else function(pos)
+def drive(parser, pos):
+    key = (parser, pos)
+    if key in memo:
+        return memo[key]
+    memo[key] = None
+    generator = parser(source, pos)
+    ans = next(generator)
+    while isinstance(ans, ParseStep):
+        step = call(ans.parser, ans.pos)
+        step = ParseFailure if step is None else ParseResult(*step)
+        ans = generator.send(step)
+    ans = memo[key] = None if ans is ParseFailure else tuple(ans)
+    return ans
+'''.strip().split('\n')
+
+
+# The same helpers, for a grammar that may use Commit. Like the interpreter,
+# they record the position of each Commit (unless a lookahead is running),
+# and they end the parse when a parser that started before it fails.
+_DYNAMIC_COMMIT_HELPERS = '''
+memo = {}
+def call(parser, pos):
+    function = table.get(parser)
+    return drive(parser, pos) if function is None else function(pos)
+def drive(parser, pos):
+    key = (parser, pos)
+    if key in memo:
+        return memo[key]
+    memo[key] = None
+    lookahead = isinstance(parser, lookaheads)
+    look[0] += lookahead
+    generator = parser(source, pos)
+    ans = next(generator)
+    while isinstance(ans, ParseStep):
+        if ans.parser is commit:
+            if not look[0] and ans.pos > cut[0]:
+                cut[0] = ans.pos
+            step = (None, ans.pos)
+        else:
+            step = call(ans.parser, ans.pos)
+        if step is None and ans.pos < cut[0] and not grow[0]:
+            raise Cut()
+        step = ParseFailure if step is None else ParseResult(*step)
+        ans = generator.send(step)
+    look[0] -= lookahead
+    ans = memo[key] = None if ans is ParseFailure else tuple(ans)
+    return ans
+'''.strip().split('\n')
+
+
+def _uses_commit(root):
+    # A Bind may build a grammar that uses Commit while parsing, so count it
+    # as a Commit.
+    visited = set()
+    stack = [root]
+    while stack:
+        parser = stack.pop()
+        if parser is _commit_parser or isinstance(parser, _BindParser):
+            return True
+        if id(parser) not in visited:
+            visited.add(id(parser))
+            stack.extend(_child_parsers(parser))
+    return False
+
+
+def _is_memoized(parser):
+    # The head of a left-recursive cycle keeps its seed in its memo table.
+    return getattr(parser, 'memoize', True) or _is_head(parser)
+
+
+def _is_head(parser):
+    return getattr(parser, 'left_recursion', None) is not None
+
+
+class _CodeGenerator(object):
+    def __init__(self, root):
+        self.root = root
+        self.numbers = {}
+        self.parsers = []
+        self.constants = []
+        self.is_dynamic = False
+        self.has_prefix = False
+        self.has_commit = _uses_commit(root)
+
+    def generate(self):
+        self.number(self.root)
+        functions = []
+        # The list of parsers grows as we discover their children.
+        index = 0
+        while index < len(self.parsers):
+            functions.extend(self.function(index, self.parsers[index]))
+            index += 1
+
+        lines = ['def _build(source, constants):', '    n = len(source)']
+        if self.has_commit:
+            # The position of the last Commit, the number of lookaheads that
+            # are running, and the number of left-recursive parsers that are
+            # growing. (Python 2 doesn't have "nonlocal".)
+            lines.extend(['    cut = [0]', '    look = [0]', '    grow = [0]'])
+        if self.has_prefix:
+            # Buffers and mmap objects don't have a "startswith" method.
+            lines.extend([
+                '    startswith = getattr(source, "startswith", None)',
+                '    if startswith is None:',
+                '        startswith = lambda s, pos: '
+                    'source[pos:pos + len(s)] == s',
+            ])
+        if self.is_dynamic:
+            table = self.constant(tuple(self.parsers))
+            names = ''.join('p%d, ' % i for i in range(len(self.parsers)))
+            functions.append('table = dict(zip(%s, (%s)))' % (table, names))
+            functions.extend(_DYNAMIC_COMMIT_HELPERS if self.has_commit
+                else _DYNAMIC_HELPERS)
+        if self.constants:
+            names = ''.join('k%d, ' % i for i in range(len(self.constants)))
+            lines.append('    (%s) = constants' % names)
+        lines.extend('    m%d = {}' % i for i, p in enumerate(self.parsers)
+            if _is_memoized(p))
+        lines.extend('    ' + i for i in functions)
+        lines.append('    return p0')
+        return '\n'.join(lines) + '\n'
+
+    def number(self, parser):
+        key = id(parser)
+        if key not in self.numbers:
+            self.numbers[key] = len(self.parsers)
+            self.parsers.append(parser)
+        return 'p%d' % self.numbers[key]
+
+    def constant(self, value):
+        self.constants.append(value)
+        return 'k%d' % (len(self.constants) - 1)
+
+    def function(self, index, parser):
+        self.current = index
+        if _is_head(parser):
+            return self.growing_function(index, parser)
+        self.is_memoized = _is_memoized(parser)
+        body = self.body(parser)
+        lines = ['def p%d(pos):' % index]
+        if self.is_memoized:
+            memo = 'm%d' % index
+            lines.extend([
+                '    if pos in %s:' % memo,
+                '        return %s[pos]' % memo,
+                '    %s[pos] = None' % memo,
+            ])
+        lines.extend('    ' + i for i in body)
+        return lines
+
+    def growing_function(self, index, parser):
+        # The "p" function grows the seed, and the "g" function parses once.
+        self.is_memoized = False
+        body = self.body(parser)
+        memo = 'm%d' % index
+        lines = [
+            'def p%d(pos):' % index,
+            '    if pos in %s:' % memo,
+            '        return %s[pos]' % memo,
+            '    %s[pos] = seed = None' % memo,
+        ]
+        if self.has_commit:
+            lines.append('    grow[0] += 1')
+        lines.extend([
+            '    while True:',
+            '        ans = g%d(pos)' % index,
+            '        if ans is None or seed and ans[1] <= seed[1]:',
+            '            break',
+            '        %s[pos] = seed = ans' % memo,
+        ])
+        # Forget the results that depended on the old seed.
+        for other in parser.left_recursion:
+            if _is_memoized(other):
+                self.number(other)
+                name = 'm%d' % self.numbers[id(other)]
+                lines.append('        %s.pop(pos, None)' % name)
+        if self.has_commit:
+            lines.append('    grow[0] -= 1')
+        lines.append('    return seed')
+        lines.append('def g%d(pos):' % index)
+        lines.extend('    ' + i for i in body)
+        return lines
+
+    def succeed(self, value):
+        if not self.is_memoized:
+            return ['return %s' % value]
+        return ['ans = m%d[pos] = %s' % (self.current, value), 'return ans']
+
+    def body(self, parser):
+        emitter = _NODE_EMITTERS.get(type(parser))
+        if emitter is not None:
+            return emitter(self, parser)
+        factory = getattr(parser, 'factory', None)
+        if factory in _LEAF_EMITTERS:
+            return _LEAF_EMITTERS[factory](self, parser.arg)
+        if parser in _SINGLETON_EMITTERS:
+            return _SINGLETON_EMITTERS[parser](self)
+        return self.emit_dynamic(parser)
+
+    def emit_dynamic(self, parser):
+        self.is_dynamic = True
+        parser = self.constant(parser)
+        return self.succeed_unless_none('drive(%s, pos)' % parser)
+
+    def succeed_unless_none(self, call):
+        return [
+            'r = %s' % call,
+            'if r is None:',
+            '    return None',
+        ] + self.succeed('r')
+
+    def emit_bind(self, parser):
+        self.is_dynamic = True
+        bind = self.constant(parser.bind)
+        function = self.constant(parser.function)
+        return [
+            'r = %s(pos)' % self.number(parser.parser),
+            'if r is None:',
+            '    return None',
+        ] + self.succeed_unless_none(
+            'call(%s(r[0], %s), r[1])' % (bind, function))
+
+    def check_cut(self, pos):
+        # Returns the lines that end the parse if the parser is about to
+        # backtrack before the last Commit.
+        if not self.has_commit:
+            return []
+        return ['if %s < cut[0] and not grow[0]:' % pos, '    raise Cut()']
+
+    def lookahead(self, call):
+        if not self.has_commit:
+            return ['r = %s' % call]
+        return ['look[0] += 1', 'r = %s' % call, 'look[0] -= 1']
+
+    def emit_expect(self, parser):
+        return self.lookahead('%s(pos)' % self.number(parser.parser)) + [
+            'if r is None:',
+            '    return None',
+        ] + self.succeed('(r[0], pos)')
+
+    def emit_left(self, parser):
+        return [
+            'r = %s(pos)' % self.number(parser.left_parser),
+            'if r is None:',
+            '    return None',
+            's = %s(r[1])' % self.number(parser.right_parser),
+            'if s is None:',
+            '    return None',
+        ] + self.succeed('(r[0], s[1])')
+
+    def emit_list(self, parser):
+        # Without "collect", just count the elements.
+        if parser.collect:
+            start, append = 'xs = []', 'xs.append(r[0])'
+        else:
+            start, append = 'xs = 0', 'xs += 1'
+        return [
+            start,
+            'q = pos',
+            'while True:',
+            '    r = %s(q)' % self.number(parser.parser),
+            '    if r is None:',
+        ] + ['        ' + i for i in self.check_cut('q')] + [
+            '        break',
+            '    if r[1] == q:',
+            '        break',
+            '    ' + append,
+            '    q = r[1]',
+        ] + self.succeed('(xs, q)')
+
+    def emit_not(self, parser):
+        return self.lookahead('%s(pos)' % self.number(parser.parser)) + [
+            'if r is not None:',
+            '    return None',
+        ] + self.check_cut('pos') + self.succeed('(None, pos)')
+
+    def emit_or(self, parser):
+        if parser.dispatch is not None:
+            return self.emit_dispatch(parser)
+        lines = []
+        for child in parser.parsers:
+            lines.append('r = %s(pos)' % self.number(child))
+            lines.append('if r is not None:')
+            lines.extend('    ' + i for i in self.succeed('r'))
+            lines.extend(self.check_cut('pos'))
+        return lines + ['return None']
+
+    def emit_dispatch(self, parser):
+        # Skip the alternatives that can't match the next character or token.
+        # Each key maps to a bit mask of the alternatives to try.
+        dispatch = parser.dispatch
+        masks = self.constant(dispatch.masks)
+        if dispatch.is_text:
+            lines = ['key = source[pos] if pos < n else None']
+        elif not dispatch.contents:
+            lines = ['key = source[pos].__class__ if pos < n else None']
+        else:
+            contents = self.constant(dispatch.contents)
+            lines = [
+                'key = None',
+                'if pos < n:',
+                '    obj = source[pos]',
+                '    c = getattr(obj, "content", None)',
+                '    key = (obj.__class__, c if c in %s else None)' % contents,
+            ]
+        lines.extend([
+            'mask = %s.get(key)' % masks,
+            'if mask is None:',
+            '    mask = %s(key)' % self.constant(dispatch.mask),
+        ])
+        for index, child in enumerate(parser.parsers):
+            call = [
+                'r = %s(pos)' % self.number(child),
+                'if r is not None:',
+            ] + ['    ' + i for i in self.succeed('r')] + self.check_cut('pos')
+            if dispatch.choices[index] is None:
+                lines.extend(call)
+            else:
+                lines.append('if mask & %d:' % (1 << index))
+                lines.extend('    ' + i for i in call)
+        return lines + ['return None']
+
+    def emit_require(self, parser):
+        predicate = self.constant(parser.predicate)
+        return [
+            'r = %s(pos)' % self.number(parser.parser),
+            'if r is None or not %s(r[0]):' % predicate,
+            '    return None',
+        ] + self.succeed('r')
+
+    def emit_right(self, parser):
+        return [
+            'r = %s(pos)' % self.number(parser.left_parser),
+            'if r is None:',
+            '    return None',
+        ] + self.succeed_unless_none(
+            '%s(r[1])' % self.number(parser.right_parser))
+
+    def emit_sequence(self, parser):
+        lines = []
+        values = []
+        pos = 'pos'
+        for index, child in enumerate(parser.parsers):
+            lines.extend([
+                'r = %s(%s)' % (self.number(child), pos),
+                'if r is None:',
+                '    return None',
+                'v%d, q = r' % index,
+            ])
+            values.append('v%d, ' % index)
+            pos = 'q'
+        value = '(%s)' % ''.join(values) if parser.collect else 'None'
+        return lines + self.succeed('(%s, %s)' % (value, pos))
+
+    def emit_token(self, parser):
+        token_class = self.constant(parser.token_class)
+        return [
+            'r = %s(pos)' % self.number(parser.parser),
+            'if r is None:',
+            '    return None',
+        ] + self.succeed('(make_token(%s, r[0]), r[1])' % token_class)
+
+    def emit_transform(self, parser):
+        function = self.constant(parser.function)
+        return [
+            'r = %s(pos)' % self.number(parser.parser),
+            'if r is None:',
+            '    return None',
+        ] + self.succeed('(%s(r[0]), r[1])' % function)
+
+    def emit_backtrack(self, count):
+        return [
+            'if pos < %d:' % count,
+            '    return None',
+        ] + self.succeed('(None, pos - %d)' % count)
+
+    def emit_literal(self, value):
+        value = self.constant(value)
+        return [
+            'if pos >= n or source[pos] != %s:' % value,
+            '    return None',
+        ] + self.succeed('(%s, pos + 1)' % value)
+
+    def emit_return(self, value):
+        return self.succeed('(%s, pos)' % self.constant(value))
+
+    def emit_token_instance(self, token_class):
+        token_class = self.constant(token_class)
+        return [
+            'obj = source[pos] if pos < n else None',
+            'if not isinstance(obj, %s):' % token_class,
+            '    return None',
+        ] + self.succeed('(obj, pos + 1)')
+
+    def emit_text_prefix(self, string):
+        name = self.constant(string)
+        self.has_prefix = True
+        return [
+            'if not startswith(%s, pos):' % name,
+            '    return None',
+        ] + self.succeed('(%s, pos + %d)' % (name, len(string)))
+
+    def emit_token_content(self, string):
+        string = self.constant(string)
+        return [
+            'if pos >= n or source[pos].content != %s:' % string,
+            '    return None',
+        ] + self.succeed('(%s, pos + 1)' % string)
+
+    def emit_literal_choice(self, choice):
+        strings = self.constant(choice.strings)
+        end = 'pos + len(value)' if choice.is_text else 'pos + 1'
+        return [
+            'index = %s(source, pos)' % self.constant(choice.find),
+            'if index is None:',
+            '    return None',
+            'value = %s[index]' % strings,
+        ] + self.succeed('(value, %s)' % end)
+
+    def emit_regex_text(self, regex):
+        return [
+            'match = %s(source, pos)' % self.constant(regex.match),
+            'if not match:',
+            '    return None',
+        ] + self.succeed('(match, match.end())')
+
+    def emit_fused_text(self, fusion):
+        value = 'None'
+        if fusion.build is not None:
+            value = '%s(match, source)' % self.constant(fusion.build)
+        return [
+            'match = %s(source, pos)' % self.constant(fusion.regex.match),
+            'if not match:',
+            '    return None',
+        ] + self.succeed('(%s, match.end())' % value)
+
+    def emit_scan(self, scan):
+        return self.succeed('%s(source, pos)' % self.constant(scan.run))
+
+    def emit_regex_token(self, regex):
+        return [
+            'if pos >= n:',
+            '    return None',
+            'match = %s(source[pos].content)' % self.constant(regex.match),
+            'if not match:',
+            '    return None',
+        ] + self.succeed('(match, pos + 1)')
+
+    def emit_any(self):
+        return ['if pos >= n:', '    return None'] + self.succeed(
+            '(source[pos], pos + 1)')
+
+    def emit_commit(self):
+        return [
+            'if not look[0] and pos > cut[0]:',
+            '    cut[0] = pos',
+        ] + self.succeed('(None, pos)')
+
+    def emit_end(self):
+        return ['if pos != n:', '    return None'] + self.succeed('(None, pos)')
+
+    def emit_fail(self):
+        return ['return None']
+
+    def emit_none(self):
+        return self.succeed('(None, pos)')
+
+    def emit_start(self):
+        return ['if pos != 0:', '    return None'] + self.succeed('(None, pos)')
+
+
+_NODE_EMITTERS = {
+    _BindParser: _CodeGenerator.emit_bind,
+    _ExpectParser: _CodeGenerator.emit_expect,
+    _LeftParser: _CodeGenerator.emit_left,
+    _ListParser: _CodeGenerator.emit_list,
+    _NotParser: _CodeGenerator.emit_not,
+    _OrParser: _CodeGenerator.emit_or,
+    _RequireParser: _CodeGenerator.emit_require,
+    _RightParser: _CodeGenerator.emit_right,
+    _SequenceParser: _CodeGenerator.emit_sequence,
+    _TokenParser: _CodeGenerator.emit_token,
+    _TransformParser: _CodeGenerator.emit_transform,
+}
+
+
+_LEAF_EMITTERS = {
+    _backtrack_parser: _CodeGenerator.emit_backtrack,
+    _fused_text_parser: _CodeGenerator.emit_fused_text,
+    _literal_choice_parser: _CodeGenerator.emit_literal_choice,
+    _literal_parser: _CodeGenerator.emit_literal,
+    _regex_text_parser: _CodeGenerator.emit_regex_text,
+    _regex_token_parser: _CodeGenerator.emit_regex_token,
+    _return_parser: _CodeGenerator.emit_return,
+    _scan_parser: _CodeGenerator.emit_scan,
+    _text_prefix_eq: _CodeGenerator.emit_text_prefix,
+    _token_content_eq: _CodeGenerator.emit_token_content,
+    _token_instance_parser: _CodeGenerator.emit_token_instance,
+}
+
+
+_SINGLETON_EMITTERS = {
+    _any_parser: _CodeGenerator.emit_any,
+    _commit_parser: _CodeGenerator.emit_commit,
+    _end_parser: _CodeGenerator.emit_end,
+    _fail_parser: _CodeGenerator.emit_fail,
+    _none_parser: _CodeGenerator.emit_none,
+    _start_parser: _CodeGenerator.emit_start,
+}
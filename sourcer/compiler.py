@@ -1,6 +1,16 @@
+import copy
 import inspect
+import itertools
+import re
+import sre_constants
+import sre_parse
+import threading
+import time
+from functools import partial
 from .expressions import *
 from .tokens import *
+from .tokens import _matched_text
+from .memo import BindCache
 from .structs import compile_struct, compile_bound_struct
 
 
@@ -14,24 +24,163 @@ ParseFailure = object()
 ParseStep = namedtuple('ParseStep', 'parser, pos')
 
 
-def compile(expression, is_text=True):
-    attr = '_text_parser' if is_text else '_data_parser'
-    is_operand = isinstance(expression, ParsingOperand)
-    is_class = inspect.isclass(expression)
-    is_cacheable = is_operand and not is_class
-    if is_cacheable and hasattr(expression, attr):
-        return getattr(expression, attr)
-
-    compiler = _Compiler(is_text)
+def compile(expression, is_text=True, deferred=False, recognize=False,
+        fuse=True, cache=None, passes=None, bind_cache=None, labels=None):
+    # With "deferred", the parser doesn't run the functions of Transform
+    # expressions (or build tokens and structs) as it goes. Instead, it builds
+    # a tree of _Deferred objects, and the caller runs them with _resolve once
+    # the parse is over. So the parser never runs the actions of alternatives
+    # that it ends up throwing away.
+    # With "recognize", the parser only finds out where the expression stops
+    # matching, and doesn't build the values at all. (Except for the parts of
+    # the grammar that Require and Bind expressions look at.)
+    # With "fuse", runs of text-mode terminals become single regexes.
+    # The "cache" argument is an optional GrammarCache, which keeps the plan
+    # of the parser on disk for the next process.
+    # The "passes" argument is a PassManager, or a list of passes for one.
+    # (By default, the compiler runs the passes in DEFAULT_PASSES.)
+    # The "bind_cache" argument is a BindCache for the parsers that the
+    # grammar's Bind expressions compile while it parses. (By default, each
+    # grammar gets its own.)
+    # Without "passes" or "bind_cache", the parsing functions share a Grammar
+    # for each expression object (and each class), so that each mode of the
+    # expression only gets compiled once.
+    # The "labels" argument is an optional dict. It gets a list of the
+    # expressions that each parser came from, keyed by the parser. (So it
+    # always gets a new parser.) A parser that a pass put in place of others
+    # doesn't get their labels.
+    if labels is not None:
+        if isinstance(expression, Grammar):
+            passes, bind_cache = expression.passes, expression.bind_cache
+            expression = expression.expression
+        return _compile(expression, is_text, deferred, recognize, fuse, cache,
+            passes, bind_cache, labels)
+    if isinstance(expression, Grammar):
+        if passes is not None or bind_cache is not None:
+            raise ValueError('A Grammar has its own passes and bind cache.')
+        return expression.compile(is_text, deferred, recognize, fuse, cache)
+    if passes is None and bind_cache is None:
+        grammar = shared_grammar(expression)
+        if grammar is not None:
+            return grammar.compile(is_text, deferred, recognize, fuse, cache)
+    return _compile(expression, is_text, deferred, recognize, fuse, cache,
+        passes, bind_cache)
+
+
+def _compile(expression, is_text, deferred, recognize, fuse, cache, passes,
+        bind_cache, labels=None):
+    if bind_cache is None:
+        bind_cache = BindCache()
+    if recognize:
+        compiler = _Recognizer(is_text, fuse, bind_cache)
+    else:
+        compiler = _Compiler(is_text, deferred, fuse, bind_cache)
     parser = compiler.compile(expression)
     assert not isinstance(parser, ForwardingPointer)
     _replace_pointers(parser)
-
-    if is_cacheable:
-        setattr(expression, attr, parser)
+    hints = compiler.memo_hints()
+    if not isinstance(passes, PassManager):
+        passes = PassManager(passes)
+    parser = passes.run(parser, hints)
+    if labels is not None:
+        # Only label the parsers that the passes left in the graph.
+        present = set(_unplanned_parsers(parser, None))
+        tables = [compiler.map]
+        if compiler.values is not compiler:
+            tables.append(compiler.values.map)
+        for table in tables:
+            for node, value in table.iteritems():
+                if value in present:
+                    labels.setdefault(value, []).append(node)
+    if cache is None:
+        _plan(parser, hints, is_text)
+    else:
+        cache.plan(parser, hints, is_text)
     return parser
 
 
+class Grammar(object):
+    '''
+    Compiles an expression once for each mode (text or data, deferred or
+    recognizing) and each GrammarCache (or none), and keeps the parsers.
+    Threads may share a Grammar. When several of them need the same mode at
+    the same time, one of them compiles it and the others wait for it. The
+    ``compiles`` attribute counts the compilations.
+
+    The parsing functions (and Parser objects) accept a Grammar in place of
+    an expression. They also keep a shared Grammar for each expression
+    object and each class, like a Struct class, without being asked to. Use
+    ``shared_grammar`` to look at one of those.
+
+    Example::
+
+        from sourcer import *
+
+        class Point(Struct):
+            def parse(self):
+                self.x = Pattern(r'\\d+') * int
+                self.y = ',' >> Pattern(r'\\d+') * int
+
+        grammar = Grammar(Point)
+        p1 = parse(grammar, '1,2')
+        p2 = parse(grammar, '3,4')
+        assert (p2.x, p2.y) == (3, 4)
+        assert recognize(grammar, '5,6')
+        assert grammar.compiles == 2
+
+        parse(Point, '1,2')
+        parse(Point, '3,4')
+        assert shared_grammar(Point).compiles == 1
+    '''
+    def __init__(self, expression, passes=None, bind_cache=None):
+        # See the compile function for the "passes" and "bind_cache"
+        # arguments.
+        self.expression = expression
+        self.passes = passes
+        self.bind_cache = bind_cache
+        self.parsers = {}
+        self.compiles = 0
+        self.lock = threading.Lock()
+
+    def compile(self, is_text=True, deferred=False, recognize=False,
+            fuse=True, cache=None):
+        # A different cache gets a parser of its own, so that the cache sees
+        # the grammar, even if the grammar was compiled without it.
+        key = (is_text, deferred and not recognize, recognize, fuse, cache)
+        parser = self.parsers.get(key)
+        if parser is not None:
+            return parser
+        with self.lock:
+            parser = self.parsers.get(key)
+            if parser is None:
+                parser = _compile(self.expression, is_text, deferred,
+                    recognize, fuse, cache, self.passes, self.bind_cache)
+                self.parsers[key] = parser
+                self.compiles += 1
+        return parser
+
+
+_shared_grammars_lock = threading.Lock()
+
+
+def shared_grammar(expression):
+    # Returns the Grammar that the parsing functions use for an expression
+    # object or a class, or None for other expressions (like strings and
+    # tuples), which they compile each time. We keep the Grammar in the
+    # object's own dict, so that it goes away with the object, and so that a
+    # subclass doesn't find the Grammar of its base class.
+    if not isinstance(expression, ParsingOperand):
+        return None
+    grammar = vars(expression).get('_grammar')
+    if grammar is None:
+        with _shared_grammars_lock:
+            grammar = vars(expression).get('_grammar')
+            if grammar is None:
+                grammar = Grammar(expression)
+                setattr(expression, '_grammar', grammar)
+    return grammar
+
+
 class ForwardingPointer(object):
     def __call__(self, source, pos):
         ans = yield ParseStep(self.parser, pos)
@@ -63,21 +212,1053 @@ def _replace_pointers(parser, visited=None):
             setattr(parser, key, value.parser)
 
 
+def _plan(root, hints, is_text=True):
+    # Analyze a newly compiled parser graph.
+    _plan_memoization(root, hints)
+    _plan_failures(root)
+    _plan_left_recursion(root)
+    _plan_dispatch(root, is_text)
+
+
+def _plan_memoization(root, hints):
+    # Decide which parsers are worth memoizing. A memo entry only pays off
+    # when the grammar may run a parser more than once at the same position.
+    # So we don't memoize leaves (it's cheaper to run them again than to store
+    # and look up their results), and we don't memoize parsers that have only
+    # one caller, unless they're part of a cycle. (The memo table also keeps
+    # left-recursive rules from looping forever, so every cycle needs at least
+    # one memoized parser. We pick the ones that a depth-first search finds at
+    # the end of a back edge.)
+    # The "Memo" and "NoMemo" expressions override these decisions, except
+    # that NoMemo can't take the memo table away from a cycle. Parsers
+    # that already have a plan (like the ones that Bind shares with the rest
+    # of the grammar) keep it.
+    nodes = _unplanned_parsers(root)
+    callers = {}
+    for node in nodes:
+        for child in _child_parsers(node):
+            callers[id(child)] = callers.get(id(child), 0) + 1
+    cyclic = set()
+    for component in _components(nodes):
+        start = component[-1]
+        if len(component) > 1 or start in _child_parsers(start):
+            members = set(id(i) for i in component)
+            inside = lambda i: [j for j in _child_parsers(i)
+                if id(j) in members]
+            cyclic.update(id(i) for i in _cycle_heads(start, inside))
+    for node in nodes:
+        key = id(node)
+        if key in cyclic:
+            node.memoize = True
+        elif key in hints:
+            node.memoize = hints[key]
+        elif hasattr(node, 'factory'):
+            node.memoize = False
+        else:
+            node.memoize = (key in cyclic or callers.get(key, 0) > 1
+                or isinstance(node, _BindParser))
+
+
+def _plan_failures(root):
+    # Find the parsers that can never fail, like List and Opt. Start by
+    # assuming that every parser may fail, and then keep looking for parsers
+    # that we can prove always succeed, until there aren't any more.
+    nodes = _unplanned_parsers(root, 'always_succeeds')
+    for node in nodes:
+        node.always_succeeds = False
+    changed = True
+    while changed:
+        changed = False
+        for node in nodes:
+            if node.always_succeeds:
+                continue
+            children = [getattr(i, 'always_succeeds', False)
+                for i in _child_parsers(node)]
+            if _always_succeeds(node, children):
+                node.always_succeeds = True
+                changed = True
+
+
+def _always_succeeds(parser, children):
+    # The "children" list says which of the parser's children always succeed.
+    if isinstance(parser, _ListParser):
+        return True
+    if getattr(parser, 'factory', None) is _return_parser:
+        return True
+    if getattr(parser, 'factory', None) is _fused_text_parser:
+        return parser.arg.always_succeeds
+    if getattr(parser, 'factory', None) is _scan_parser:
+        return True
+    if isinstance(parser, _OrParser):
+        return any(children)
+    is_composite = isinstance(parser, (_ExpectParser, _LeftParser,
+        _RightParser, _SequenceParser, _TokenParser, _TransformParser,
+        ForwardingPointer))
+    return is_composite and all(children)
+
+
+def _plan_left_recursion(root):
+    # Find the cycles of parsers that may call one another at the same
+    # position, like in ``Expr = (Expr, '+', Term) | Term``. In each cycle,
+    # one parser (the "head") grows its result: it parses again and again,
+    # using its previous result as the result of the recursive call, until
+    # the result stops getting longer. The interpreter finds these cycles as
+    # it parses, so only the code generator uses this plan. Each head gets a
+    # list of the other parsers in its cycle, and every other parser gets
+    # None.
+    nodes = _unplanned_parsers(root, 'left_recursion')
+    for node in nodes:
+        node.left_recursion = None
+    calls, cycles = _left_cycles(nodes)
+    for component in cycles:
+        # Tarjan's algorithm puts the first parser that it visits last.
+        start = component[-1]
+        cycle = set(id(i) for i in component)
+        inside = lambda i: [j for j in calls[id(i)] if id(j) in cycle]
+        heads = _cycle_heads(start, inside)
+        rest = [i for i in component if i not in heads]
+        for head in heads:
+            head.left_recursion = rest
+
+
+def _left_cycles(nodes):
+    # Returns a pair: a dict that maps the id of each parser to the parsers
+    # that it may call at its own position, and a list of the components of
+    # that graph that have cycles.
+    members = set(id(i) for i in nodes)
+    empty = _empty_parsers(nodes)
+    may_be_empty = lambda i: id(i) in empty or id(i) not in members
+    calls = dict((id(i), _left_calls(i, may_be_empty)) for i in nodes)
+    cycles = [i for i in _components(nodes, lambda i: calls[id(i)])
+        if len(i) > 1 or i[0] in calls[id(i[0])]]
+    return calls, cycles
+
+
+def _empty_parsers(nodes):
+    # Returns the set of ids of the parsers that may succeed without consuming
+    # any input. (Parsers that aren't in the list are assumed to.)
+    members = set(id(i) for i in nodes)
+    empty = set()
+    changed = True
+    while changed:
+        changed = False
+        for node in nodes:
+            if id(node) in empty:
+                continue
+            children = [id(i) not in members or id(i) in empty
+                for i in _child_parsers(node)]
+            if _may_be_empty(node, children):
+                empty.add(id(node))
+                changed = True
+    return empty
+
+
+def _may_be_empty(parser, children):
+    if parser in (_any_parser, _fail_parser):
+        return False
+    factory = getattr(parser, 'factory', None)
+    if factory is _text_prefix_eq:
+        return parser.arg == ''
+    if factory is _regex_text_parser:
+        return _regex_may_be_empty(parser.arg)
+    if factory is _fused_text_parser:
+        return parser.arg.is_empty
+    if factory is _literal_choice_parser:
+        return parser.arg.is_text and '' in parser.arg.indexes
+    if factory in (_literal_parser, _regex_token_parser, _token_content_eq,
+            _token_instance_parser):
+        return False
+    if isinstance(parser, _OrParser):
+        return any(children)
+    if isinstance(parser, (_LeftParser, _RightParser, _SequenceParser,
+            _RequireParser, _TokenParser, _TransformParser)):
+        return all(children)
+    return True
+
+
+def _left_calls(parser, may_be_empty):
+    # Returns the parsers that the given parser may call at its own position.
+    if isinstance(parser, (_LeftParser, _RightParser, _SequenceParser)):
+        ans = []
+        for child in _child_parsers(parser):
+            ans.append(child)
+            if not may_be_empty(child):
+                break
+        return ans
+    return _child_parsers(parser)
+
+
+def _plan_dispatch(root, is_text):
+    # Work out the FIRST set of each parser: the items that may come first in
+    # its match. (A set of tests, or None if any item may come first.) Then
+    # give each Or a _Dispatch object, so that it only tries the alternatives
+    # that may match the next item. An alternative that may match without
+    # consuming anything is always tried, so this never changes the result.
+    # Every FIRST set may be too large, but never too small. Sets start empty
+    # and grow until they stop changing, since grammars have cycles.
+    nodes = _unplanned_parsers(root, 'first')
+    members = set(id(i) for i in nodes)
+    empty = _empty_parsers(nodes)
+    may_be_empty = lambda i: id(i) in empty or id(i) not in members
+    for node in nodes:
+        node.first = frozenset()
+    changed = True
+    while changed:
+        changed = False
+        for node in nodes:
+            if node.first is None:
+                continue
+            first = _first_set(node, may_be_empty)
+            if first != node.first:
+                node.first = first
+                changed = True
+    for node in nodes:
+        if isinstance(node, _OrParser):
+            choices = [None if may_be_empty(i) else i.first
+                for i in node.parsers]
+            is_useful = any(i is not None for i in choices)
+            node.dispatch = _Dispatch(is_text, choices) if is_useful else None
+
+
+def _first_set(parser, may_be_empty):
+    factory = getattr(parser, 'factory', None)
+    if factory is _text_prefix_eq:
+        return frozenset([('char', parser.arg[0])] if parser.arg else [])
+    if factory is _regex_text_parser:
+        return _regex_first_set(parser.arg)
+    if factory is _fused_text_parser:
+        return parser.arg.first
+    if factory is _scan_parser:
+        return parser.arg.fusion.first
+    if factory is _literal_choice_parser:
+        if not parser.arg.is_text:
+            return frozenset(('content', i) for i in parser.arg.strings)
+        return frozenset(('char', i[0]) for i in parser.arg.strings if i)
+    if factory is _token_instance_parser:
+        return frozenset([('class', parser.arg)])
+    if factory is _token_content_eq:
+        return frozenset([('content', parser.arg)])
+    if parser in (_end_parser, _fail_parser, _none_parser, _start_parser):
+        return frozenset()
+    if factory is _return_parser or isinstance(parser, _NotParser):
+        return frozenset()
+    # A Commit ends the parse when an Or fails after it, so the Or must try
+    # every alternative that begins with one.
+    if factory is not None or parser in (_any_parser, _commit_parser):
+        return None
+    if isinstance(parser, _BindParser) and may_be_empty(parser.parser):
+        return None
+    ans = frozenset()
+    for child in _left_calls(parser, may_be_empty):
+        first = getattr(child, 'first', None)
+        if first is None:
+            return None
+        ans |= first
+    return ans
+
+
+def _regex_first_set(regex):
+    # Returns a FIRST set with a regex that matches one character: the ones
+    # that may start a match of the given regex.
+    try:
+        tree = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, TypeError):
+        return None
+    parts = _pattern_first(tree)[0]
+    if not parts:
+        return None if parts is None else frozenset()
+    flags = tree.pattern.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE)
+    first = re.compile('|'.join(parts), flags)
+    return frozenset([('regex', first)])
+
+
+def _regex_may_be_empty(regex):
+    # Checks if a regex may match without consuming anything. (Matching the
+    # empty string isn't enough: "(?=a)" fails on "", but it matches nothing
+    # where an "a" comes next.)
+    try:
+        tree = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, TypeError):
+        return True
+    return _pattern_first(tree)[1]
+
+
+def _pattern_first(items):
+    # Returns a pair: a list of patterns that match the characters that may
+    # start a match of the parsed regex (or None for any character), and
+    # whether the regex may match the empty string.
+    ans = []
+    for op, arg in items:
+        parts, is_empty = _pattern_item_first(op, arg)
+        if parts is None:
+            return None, True
+        ans.extend(parts)
+        if not is_empty:
+            return ans, False
+    return ans, True
+
+
+def _pattern_item_first(op, arg):
+    c = sre_constants
+    if op == c.LITERAL:
+        return [_escape_char(arg)], False
+    if op == c.NOT_LITERAL:
+        return ['[^%s]' % _escape_char(arg)], False
+    if op == c.IN:
+        return _pattern_class(arg), False
+    if op == c.BRANCH:
+        ans, is_empty = [], False
+        for branch in arg[1]:
+            parts, branch_is_empty = _pattern_first(branch)
+            if parts is None:
+                return None, True
+            ans.extend(parts)
+            is_empty = is_empty or branch_is_empty
+        return ans, is_empty
+    if op == c.SUBPATTERN:
+        return _pattern_first(arg[-1])
+    if op in (c.MAX_REPEAT, c.MIN_REPEAT):
+        parts, is_empty = _pattern_first(arg[2])
+        return parts, is_empty or arg[0] == 0
+    # Anything else may start with any character, like ".". Anchors and
+    # lookarounds don't consume anything, but they decide whether the regex
+    # matches without consuming anything, so the same goes for them.
+    return None, True
+
+
+_pattern_categories = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_NOT_SPACE: r'\S',
+    sre_constants.CATEGORY_WORD: r'\w',
+    sre_constants.CATEGORY_NOT_WORD: r'\W',
+}
+
+
+def _pattern_class(items):
+    # Returns a list with a character class, or None if we can't rebuild it.
+    ans = []
+    for op, arg in items:
+        if op == sre_constants.NEGATE:
+            ans.insert(0, '^')
+        elif op == sre_constants.LITERAL:
+            ans.append(_escape_char(arg))
+        elif op == sre_constants.RANGE:
+            ans.append('%s-%s' % (_escape_char(arg[0]), _escape_char(arg[1])))
+        elif arg in _pattern_categories:
+            ans.append(_pattern_categories[arg])
+        else:
+            return None
+    return ['[%s]' % ''.join(ans)]
+
+
+def _escape_char(code):
+    return re.escape(chr(code) if code < 256 else unichr(code))
+
+
+class _RegexReach(object):
+    # Works out which part of the input a regex may look at, for the parsers
+    # that need to know which changes to the input may change its result.
+    # "behind" is how many characters before its position it may look at, and
+    # "width" is how many characters past its position an attempt may look at
+    # (both may be infinite). When the width is infinite, "prefix" is a regex
+    # that finds how far a failed attempt got, or None if we can't tell.
+    # (See _simple_prefix.)
+
+    def __init__(self, regex):
+        inf = float('inf')
+        self.width = self.behind = inf
+        self.first = None
+        self.prefix = None
+        try:
+            tree = sre_parse.parse(regex.pattern, regex.flags)
+        except (re.error, TypeError):
+            return
+        _, self.width, self.behind = _pattern_reach(tree)
+        if self.width == inf:
+            self.first = _regex_first_set(regex)
+            self.prefix = _simple_prefix(list(tree), tree.pattern.flags)
+
+    def examined(self, source, pos, ans):
+        # Returns the end of the part of the input that the regex looked at,
+        # when it returned "ans" at "pos". (A regex may look at the character
+        # after the last one that it can consume, to check an anchor.)
+        if self.width < float('inf'):
+            return pos + self.width + 1
+        if self.prefix is not None:
+            if ans is ParseFailure:
+                match = self.prefix.match(source, pos)
+                return (pos if match is None else match.end()) + 1
+            return ans.pos + 1
+        if ans is ParseFailure and self.first is not None:
+            # If the next character can't start a match, the regex failed
+            # right away.
+            if pos >= len(source) or not any(
+                    test[1].match(source[pos]) for test in self.first):
+                return pos + 1
+        return len(source) + 1
+
+
+_regex_reaches = {}
+
+
+def _regex_reach(regex):
+    ans = _regex_reaches.get(regex)
+    if ans is None:
+        ans = _regex_reaches[regex] = _RegexReach(regex)
+    return ans
+
+
+def _pattern_reach(items):
+    # Returns a triple for the parsed regex: how far a match may move past its
+    # start, how far an attempt may look past its start, and how far it may
+    # look before its start. (Any of them may be infinite.)
+    c = sre_constants
+    inf = float('inf')
+    advance = reach = behind = 0
+    for op, arg in items:
+        if op in (c.LITERAL, c.NOT_LITERAL, c.IN, c.ANY):
+            step, look, back = 1, 1, 0
+        elif op == c.SUBPATTERN:
+            step, look, back = _pattern_reach(arg[-1])
+        elif op == c.BRANCH:
+            parts = [_pattern_reach(branch) for branch in arg[1]]
+            step, look, back = [max(part[i] for part in parts) for i in range(3)]
+        elif op in (c.MAX_REPEAT, c.MIN_REPEAT):
+            step, look, back = _pattern_reach(arg[2])
+            if arg[1] == 0:
+                step = look = 0
+            elif arg[1] == c.MAXREPEAT:
+                step = look = inf
+            else:
+                look += step * (arg[1] - 1)
+                step *= arg[1]
+        elif op == c.AT:
+            # An anchor may look at the characters on both sides of it.
+            step, look, back = 0, 0, 1
+        elif op in (c.ASSERT, c.ASSERT_NOT):
+            direction, sub = arg
+            step, look, back = _pattern_reach(sub)
+            if direction < 0:
+                step, look, back = 0, 0, back + step
+            else:
+                step = 0
+        else:
+            # Like a backreference, which may look at any length of input.
+            return inf, inf, inf
+        reach = max(reach, advance + look)
+        behind = max(behind, back)
+        advance += step
+    return advance, reach, behind
+
+
+def _simple_prefix(items, flags):
+    # Checks if a regex only has single characters and greedy repeats of
+    # single characters (with anchors before the first repeat), where nothing
+    # that may follow a repeat can match what it matches. Such a regex never
+    # backtracks into a repeat, so it doesn't look past the end of its match,
+    # and a failed attempt stops at the first item that fails. If so, returns
+    # a regex that matches as many of these items as it can, with no minimum
+    # count for the repeats. Otherwise, returns None.
+    c = sre_constants
+    items = _ungroup(items)
+    texts = []
+    has_repeat = False
+    for index, (op, arg) in enumerate(items):
+        if op == c.AT:
+            text = _anchors.get(arg)
+            if has_repeat or text is None:
+                return None
+        elif op == c.MAX_REPEAT:
+            has_repeat = True
+            item = _single_char(arg[2])
+            if item is None or not _ends_repeat(item, items[index + 1:], flags):
+                return None
+            limit = '' if arg[1] == c.MAXREPEAT else arg[1]
+            text = '%s{0,%s}' % (_char_pattern(*item), limit)
+        else:
+            text = _char_pattern(op, arg)
+        if text is None:
+            return None
+        texts.append(text)
+    if not texts:
+        return None
+    pattern = ''.join(texts[:1] + ['(?:%s' % i for i in texts[1:]])
+    return re.compile(pattern + ')?' * (len(texts) - 1), flags)
+
+
+_anchors = {
+    sre_constants.AT_BEGINNING: '^',
+    sre_constants.AT_BEGINNING_STRING: r'\A',
+    sre_constants.AT_BOUNDARY: r'\b',
+    sre_constants.AT_NON_BOUNDARY: r'\B',
+    sre_constants.AT_END: '$',
+    sre_constants.AT_END_STRING: r'\Z',
+}
+
+
+def _ungroup(items):
+    # Returns the items of a parsed regex with their groups spliced in.
+    ans = []
+    for op, arg in items:
+        if op == sre_constants.SUBPATTERN:
+            ans.extend(_ungroup(arg[-1]))
+        else:
+            ans.append((op, arg))
+    return ans
+
+
+def _single_char(items):
+    # Returns the only item of a parsed regex, if it matches one character.
+    items = _ungroup(items)
+    if len(items) != 1 or _char_pattern(*items[0]) is None:
+        return None
+    return items[0]
+
+
+def _char_pattern(op, arg):
+    c = sre_constants
+    if op == c.ANY:
+        return '.'
+    if op in (c.LITERAL, c.NOT_LITERAL, c.IN):
+        parts = _pattern_item_first(op, arg)[0]
+        return parts and parts[0]
+    return None
+
+
+def _ends_repeat(item, rest, flags):
+    # Checks that none of the items that may follow a repeat of "item" can
+    # match a character that "item" matches.
+    c = sre_constants
+    for op, arg in rest:
+        if op == c.MAX_REPEAT:
+            other = _single_char(arg[2])
+            is_empty = arg[0] == 0
+        else:
+            other = (op, arg) if _char_pattern(op, arg) is not None else None
+            is_empty = False
+        if other is None or not _disjoint(item, other, flags):
+            return False
+        if not is_empty:
+            break
+    return True
+
+
+_disjoint_categories = {
+    sre_constants.CATEGORY_DIGIT: frozenset([
+        sre_constants.CATEGORY_NOT_DIGIT, sre_constants.CATEGORY_SPACE]),
+    sre_constants.CATEGORY_SPACE: frozenset([
+        sre_constants.CATEGORY_NOT_SPACE, sre_constants.CATEGORY_DIGIT,
+        sre_constants.CATEGORY_WORD]),
+    sre_constants.CATEGORY_WORD: frozenset([
+        sre_constants.CATEGORY_NOT_WORD, sre_constants.CATEGORY_SPACE]),
+    sre_constants.CATEGORY_NOT_DIGIT: frozenset([
+        sre_constants.CATEGORY_DIGIT]),
+    sre_constants.CATEGORY_NOT_SPACE: frozenset([
+        sre_constants.CATEGORY_SPACE]),
+    sre_constants.CATEGORY_NOT_WORD: frozenset([
+        sre_constants.CATEGORY_WORD]),
+}
+
+
+def _disjoint(a, b, flags):
+    # Checks that two single-character items can't match the same character.
+    # When we can't list the characters of either one, we only know about
+    # classes of categories, like "\d" and "\s".
+    for this, other in [(a, b), (b, a)]:
+        chars = _char_list(*this)
+        if chars is not None:
+            test = re.compile(_char_pattern(*other), flags)
+            if flags & re.IGNORECASE:
+                chars = [i for char in chars for i in (char.lower(), char.upper())]
+            return not any(test.match(char) for char in chars)
+    names = [_char_categories(*item) for item in (a, b)]
+    if None in names:
+        return False
+    return all(j in _disjoint_categories.get(i, ())
+        for i in names[0] for j in names[1])
+
+
+def _char_list(op, arg):
+    # Returns a list of the characters that an item matches, if it's short.
+    c = sre_constants
+    if op == c.LITERAL:
+        codes = [arg]
+    elif op == c.IN:
+        codes = []
+        for kind, value in arg:
+            if kind == c.LITERAL:
+                codes.append(value)
+            elif kind == c.RANGE and value[1] - value[0] < 1024:
+                codes.extend(range(value[0], value[1] + 1))
+            else:
+                return None
+    else:
+        return None
+    return [chr(i) if i < 128 else unichr(i) for i in codes]
+
+
+def _char_categories(op, arg):
+    # Returns the categories of a class like "[\d\s]", or None for others.
+    c = sre_constants
+    if op != c.IN or any(kind != c.CATEGORY for kind, _ in arg):
+        return None
+    return [value for _, value in arg]
+
+
+class _Dispatch(object):
+    # Picks the alternatives of an Or that may match at a position, given
+    # the next item of the input. In text mode, the key is the next character.
+    # In token mode, it's the class of the next token, and its content if some
+    # alternative looks for that content. At the end of the input, the key is
+    # None. The "choices" are the FIRST sets of the alternatives, with None
+    # for the alternatives that must always be tried.
+
+    def __init__(self, is_text, choices):
+        self.is_text = is_text
+        self.choices = choices
+        self.contents = frozenset(test[1] for first in choices if first
+            for test in first if test[0] == 'content')
+        self.table = {}
+        self.masks = {}
+
+    def key(self, source, pos):
+        if pos >= len(source):
+            return None
+        item = source[pos]
+        if self.is_text:
+            return item
+        if not self.contents:
+            return item.__class__
+        content = getattr(item, 'content', None)
+        return (item.__class__, content if content in self.contents else None)
+
+    def indexes(self, key):
+        # Returns the indexes of the alternatives to try, in order.
+        ans = self.table.get(key)
+        if ans is None:
+            ans = self.table[key] = tuple(index
+                for index, first in enumerate(self.choices)
+                if first is None or self._may_start(first, key))
+        return ans
+
+    def mask(self, key):
+        # Returns the same alternatives as a bit mask.
+        ans = self.masks[key] = sum(1 << i for i in self.indexes(key))
+        return ans
+
+    def _may_start(self, first, key):
+        if key is None:
+            return False
+        if not self.is_text:
+            cls, content = key if self.contents else (key, None)
+        for kind, arg in first:
+            if kind == 'char' and key == arg:
+                return True
+            if kind == 'regex' and arg.match(key):
+                return True
+            if kind == 'class' and issubclass(cls, arg):
+                return True
+            if kind == 'content' and content == arg:
+                return True
+        return False
+
+
+def _cycle_heads(start, children):
+    # Returns a list of parsers that breaks every cycle: the ones that a
+    # depth-first search finds at the end of a back edge.
+    heads = []
+    path = set([id(start)])
+    visited = set([id(start)])
+    work = [(start, iter(children(start)))]
+    while work:
+        node, pending = work[-1]
+        for child in pending:
+            if id(child) in path:
+                if child not in heads:
+                    heads.append(child)
+            elif id(child) not in visited:
+                visited.add(id(child))
+                path.add(id(child))
+                work.append((child, iter(children(child))))
+                break
+        else:
+            work.pop()
+            path.discard(id(node))
+    return heads
+
+
+def _unplanned_parsers(root, attr='memoize'):
+    # Returns the parsers in the graph that don't have the attribute yet. (Or
+    # all of them, when "attr" is None.)
+    ans = []
+    visited = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) in visited or (attr and hasattr(node, attr)):
+            continue
+        visited.add(id(node))
+        ans.append(node)
+        stack.extend(_child_parsers(node))
+    return ans
+
+
+def _child_parsers(parser):
+    # Returns the parsers that the given parser may delegate to.
+    if isinstance(parser, (_OrParser, _SequenceParser)):
+        return list(parser.parsers)
+    names = ('parser', 'left_parser', 'right_parser')
+    return [getattr(parser, i) for i in names if hasattr(parser, i)]
+
+
+def _components(nodes, children=_child_parsers):
+    # Returns the strongly connected components of the graph of parsers,
+    # using Tarjan's algorithm. (Without recursion, since grammars can be
+    # deeper than Python's call stack.) Only the given parsers are included.
+    # The "children" function returns the edges of the graph.
+    members = set(id(i) for i in nodes)
+    indexes = {}
+    lowlinks = {}
+    stack = []
+    on_stack = set()
+    ans = []
+
+    def visit(node):
+        indexes[id(node)] = lowlinks[id(node)] = len(indexes)
+        stack.append(node)
+        on_stack.add(id(node))
+        edges = [i for i in children(node) if id(i) in members]
+        return (node, iter(edges))
+
+    for root in nodes:
+        if id(root) in indexes:
+            continue
+        work = [visit(root)]
+        while work:
+            node, pending = work[-1]
+            for child in pending:
+                if id(child) not in indexes:
+                    work.append(visit(child))
+                    break
+                if id(child) in on_stack:
+                    low = min(lowlinks[id(node)], indexes[id(child)])
+                    lowlinks[id(node)] = low
+            else:
+                work.pop()
+                if work:
+                    parent = id(work[-1][0])
+                    lowlinks[parent] = min(lowlinks[parent], lowlinks[id(node)])
+                if lowlinks[id(node)] == indexes[id(node)]:
+                    component = []
+                    while True:
+                        top = stack.pop()
+                        on_stack.discard(id(top))
+                        component.append(top)
+                        if top is node:
+                            break
+                    ans.append(component)
+    return ans
+
+
+PassStats = namedtuple('PassStats', 'name, seconds, before, after, rewrites')
+
+
+class PassManager(object):
+    '''
+    Runs a series of optimization passes over a newly compiled parser graph,
+    before the compiler plans it. Each pass is a ``(name, function)`` pair.
+    The function takes the root parser and a set with the ids of the parsers
+    that must stay in the graph (the ones that Memo and NoMemo expressions
+    refer to). It returns a pair: the new root, and the number of rewrites
+    that it made. Passes must not change what the grammar parses.
+
+    After each run, the ``stats`` list has a PassStats tuple for each pass,
+    with the name of the pass, the time that it took, the number of parsers
+    in the graph before and after it ran, and the number of rewrites. (Each
+    run starts a new list, so a manager that compiles several grammars, or
+    several modes of one, only keeps the stats of the last one.)
+    '''
+    def __init__(self, passes=None):
+        self.passes = list(DEFAULT_PASSES if passes is None else passes)
+        self.stats = []
+
+    def run(self, root, pinned=()):
+        self.stats = []
+        pinned = frozenset(pinned)
+        size = len(_unplanned_parsers(root)) if self.passes else 0
+        for name, function in self.passes:
+            start = time.time()
+            root, rewrites = function(root, pinned)
+            seconds = time.time() - start
+            before, size = size, len(_unplanned_parsers(root))
+            self.stats.append(PassStats(name, seconds, before, size, rewrites))
+        return root
+
+
+def _rewrite(root, rule, pinned):
+    # Applies a rule to each parser in the graph, until the graph stops
+    # changing. The rule returns a parser to use in place of the given one, or
+    # the same parser if it changed the parser itself, or None. Returns the
+    # new root and the number of rewrites.
+    rewrites = 0
+    while True:
+        changes = rewrites
+        replacements = {}
+        for node in _unplanned_parsers(root):
+            if id(node) in pinned:
+                continue
+            ans = rule(node)
+            if ans is node:
+                rewrites += 1
+            elif ans is not None:
+                replacements[id(node)] = ans
+        if replacements:
+            rewrites += len(replacements)
+            root = _substitute(root, replacements)
+        if rewrites == changes:
+            return root, rewrites
+
+
+def _substitute(root, replacements):
+    # Makes every parser in the graph refer to the replacement of each of its
+    # children, and returns the replacement of the root.
+    def resolve(node):
+        seen = set()
+        while id(node) in replacements and id(node) not in seen:
+            seen.add(id(node))
+            node = replacements[id(node)]
+        return node
+    for node in _unplanned_parsers(root):
+        if isinstance(node, (_OrParser, _SequenceParser)):
+            node.parsers = [resolve(i) for i in node.parsers]
+            continue
+        for name in ('parser', 'left_parser', 'right_parser'):
+            if hasattr(node, name):
+                setattr(node, name, resolve(getattr(node, name)))
+    return resolve(root)
+
+
+def _is_constant(parser):
+    # Returns True for the parsers that always return a constant value without
+    # consuming any input.
+    return (parser is _none_parser
+        or getattr(parser, 'factory', None) is _return_parser)
+
+
+def _constant_value(parser):
+    return None if parser is _none_parser else parser.arg
+
+
+def _left_recursive_parsers(root):
+    # Returns the set of ids of the parsers in left-recursive cycles. Passes
+    # leave these parsers alone. (A head grows its result, so calling its
+    # alternatives directly wouldn't give the same result.)
+    nodes = _unplanned_parsers(root)
+    return set(id(i) for cycle in _left_cycles(nodes)[1] for i in cycle)
+
+
+def _inline_wrappers(root, pinned):
+    # Replaces the parsers that just return the result of another parser:
+    # an Or with one alternative, a Left or Right whose other side is a
+    # constant, and an Expect of an Expect.
+    cyclic = _left_recursive_parsers(root)
+    def rule(node):
+        if id(node) in cyclic:
+            return None
+        if isinstance(node, _OrParser) and len(node.parsers) == 1:
+            return node.parsers[0]
+        if isinstance(node, _LeftParser) and _is_constant(node.right_parser):
+            return node.left_parser
+        if isinstance(node, _RightParser) and _is_constant(node.left_parser):
+            return node.right_parser
+        if (isinstance(node, _ExpectParser)
+                and isinstance(node.parser, _ExpectParser)):
+            return node.parser
+    return _rewrite(root, rule, pinned)
+
+
+def _flatten(root, pinned):
+    # Moves the alternatives of an Or into the Or that calls it, and (when
+    # they don't collect values) the parsers of a sequence into the sequence
+    # that calls it.
+    cyclic = _left_recursive_parsers(root)
+    def is_nested(node, child):
+        if child.__class__ is not node.__class__:
+            return False
+        if id(child) in cyclic or id(child) in pinned:
+            return False
+        return isinstance(child, _OrParser) or not child.collect
+    def rule(node):
+        if isinstance(node, _SequenceParser) and node.collect:
+            return None
+        if not isinstance(node, (_OrParser, _SequenceParser)):
+            return None
+        if not any(is_nested(node, i) for i in node.parsers):
+            return None
+        parsers = []
+        for child in node.parsers:
+            if is_nested(node, child):
+                parsers.extend(child.parsers)
+            else:
+                parsers.append(child)
+        node.parsers = parsers
+        return node
+    return _rewrite(root, rule, pinned)
+
+
+def _fold_constants(root, pinned):
+    # Replaces the parsers whose results don't depend on the input with
+    # constants: a sequence of constants, an Expect of a constant, and a Not
+    # of a constant (which always fails).
+    def rule(node):
+        if isinstance(node, _SequenceParser) and all(
+                _is_constant(i) for i in node.parsers):
+            if not node.collect:
+                return _none_parser
+            return _return_parser(tuple(_constant_value(i)
+                for i in node.parsers))
+        if isinstance(node, _ExpectParser) and _is_constant(node.parser):
+            return node.parser
+        if isinstance(node, _NotParser) and _is_constant(node.parser):
+            return _fail_parser
+    return _rewrite(root, rule, pinned)
+
+
+def _prune_alternatives(root, pinned):
+    # Removes the alternatives of an Or that come after one that always
+    # succeeds, since the Or never gets to try them.
+    nodes = _unplanned_parsers(root)
+    cyclic = _left_recursive_parsers(root)
+    members = set(id(i) for i in nodes)
+    succeeds = set()
+    def always(parser):
+        if id(parser) in members:
+            return id(parser) in succeeds
+        return getattr(parser, 'always_succeeds', False)
+    changed = True
+    while changed:
+        changed = False
+        for node in nodes:
+            if id(node) in succeeds:
+                continue
+            children = [always(i) for i in _child_parsers(node)]
+            if _always_succeeds(node, children):
+                succeeds.add(id(node))
+                changed = True
+    def rule(node):
+        if not isinstance(node, _OrParser) or id(node) in cyclic:
+            return None
+        for index, child in enumerate(node.parsers[:-1]):
+            if always(child):
+                if index == 0:
+                    return child
+                node.parsers = node.parsers[:index + 1]
+                return node
+    return _rewrite(root, rule, pinned)
+
+
+def _merge_equal(root, pinned):
+    # Merges the parsers that do the same thing: leaves that match the same
+    # thing, and composites of the same kind with the same children and
+    # functions. Merging a pair may make their callers equal, so keep going
+    # until nothing changes. (Merging never makes a new cycle.)
+    rewrites = 0
+    cyclic = _left_recursive_parsers(root)
+    while True:
+        seen = {}
+        replacements = {}
+        for node in _unplanned_parsers(root):
+            if id(node) in pinned or id(node) in cyclic:
+                continue
+            key = _merge_key(node)
+            if key is None:
+                continue
+            other = seen.setdefault(key, node)
+            if other is not node:
+                replacements[id(node)] = other
+        if not replacements:
+            return root, rewrites
+        rewrites += len(replacements)
+        root = _substitute(root, replacements)
+
+
+_mergeable_types = (basestring, int, long, float, bool, type(None))
+
+
+def _merge_key(parser):
+    factory = getattr(parser, 'factory', None)
+    if factory is not None:
+        arg = parser.arg
+        if isinstance(arg, _regex_type):
+            return (factory, 'regex', arg.pattern, arg.flags)
+        if isinstance(arg, _mergeable_types) or inspect.isclass(arg):
+            return (factory, type(arg), arg)
+        return (factory, id(arg))
+    if not isinstance(parser, _composite_parsers):
+        return None
+    names = ('function', 'predicate', 'token_class', 'bind')
+    extras = tuple(id(getattr(parser, i, None)) for i in names)
+    children = tuple(id(i) for i in _child_parsers(parser))
+    collect = getattr(parser, 'collect', None)
+    return (parser.__class__, collect, extras, children)
+
+
+DEFAULT_PASSES = [
+    ('inline', _inline_wrappers),
+    ('flatten', _flatten),
+    ('fold', _fold_constants),
+    ('prune', _prune_alternatives),
+    ('merge', _merge_equal),
+]
+
+
 class _Compiler(object):
-    def __init__(self, is_text):
+    def __init__(self, is_text, deferred=False, fuse=True, bind_cache=None):
         self.is_text = is_text
+        self.deferred = deferred
+        self.fuse = fuse and is_text
         self.map = {}
-        self.memo = {}
+        self.bind_cache = BindCache() if bind_cache is None else bind_cache
+        self.hints = []
+        # The compiler for the expressions whose values the parser uses.
+        self.values = self
 
     def bind(self, value, function):
-        key = (value, function)
-        if key in self.memo:
-            return self.memo[key]
-        expression = function(value)
-        parser = self.compile(expression)
-        self.memo[key] = parser
+        if self.deferred:
+            value = _resolve(value)
+        # A BindCache may be shared by several compilers, which build
+        # different parsers for the same expression.
+        key = (self, value, function)
+        return self.bind_cache.get(key, lambda: self.build_bound(value,
+            function))
+
+    def build_bound(self, value, function):
+        # Compile the expression in a scope, so that the parsers that are new
+        # to it go away when the cache evicts it.
+        scope = self.scope()
+        parser = scope.compile(function(value))
+        _plan(parser, scope.memo_hints(), self.is_text)
         return parser
 
+    def scope(self):
+        # Returns a compiler that reuses the parsers that this one has
+        # compiled, but keeps the parsers that it compiles to itself.
+        ans = copy.copy(self)
+        ans.map = dict(self.map)
+        ans.hints = []
+        ans.values = ans if self.values is self else self.values.scope()
+        return ans
+
+    def memo_hints(self):
+        # Returns a dict that maps the id of each parser that appears in a
+        # Memo or NoMemo expression to the requested decision.
+        ans = dict((id(self.map[e]), flag) for e, flag in self.hints)
+        if self.values is not self:
+            ans.update(self.values.memo_hints())
+        return ans
+
     def compile(self, node):
         if node in self.map:
             return self.map[node]
@@ -89,6 +1270,9 @@ class _Compiler(object):
         return parser
 
     def compile_node(self, node):
+        fusion = _fuse(node) if self.fuse else None
+        if fusion is not None:
+            return self.fused(fusion)
         is_cls = inspect.isclass(node)
         if is_cls and issubclass(node, Token):
             return self.compile_token(node)
@@ -134,7 +1318,7 @@ class _Compiler(object):
         return _backtrack_parser(node.count)
 
     def compile_bind(self, node):
-        parser = self.compile(node.expression)
+        parser = self.values.compile(node.expression)
         function = node.function
         if inspect.isclass(function) and issubclass(function, Struct):
             function = compile_bound_struct(function)
@@ -144,6 +1328,9 @@ class _Compiler(object):
         parser = self.compile(node.expression)
         return _ExpectParser(parser)
 
+    def compile_commit(self, node):
+        return _commit_parser
+
     def compile_end(self, node):
         return _end_parser
 
@@ -160,12 +1347,34 @@ class _Compiler(object):
         return _LeftParser(left_parser, right_parser)
 
     def compile_list(self, node):
+        scan = self.scan(node.element, collect=True)
+        if scan is not None:
+            return scan
         parser = self.compile(node.element)
         return _ListParser(parser)
 
+    def scan(self, element, collect):
+        # A list of text-mode terminals becomes one loop over a merged regex,
+        # instead of one step of the interpreter per element.
+        fusion = _fuse_terminals(element) if self.fuse else None
+        if fusion is None:
+            return None
+        return _scan_parser(_Scan(fusion, collect))
+
+    def fused(self, fusion):
+        return _fused_text_parser(fusion)
+
     def compile_literal(self, node):
         return _literal_parser(node.value)
 
+    def compile_memo(self, node):
+        self.hints.append((node.expression, True))
+        return self.compile(node.expression)
+
+    def compile_nomemo(self, node):
+        self.hints.append((node.expression, False))
+        return self.compile(node.expression)
+
     def compile_not(self, node):
         parser = self.compile(node.expression)
         return _NotParser(parser)
@@ -175,7 +1384,7 @@ class _Compiler(object):
         return self.compile(delegate)
 
     def compile_or(self, node):
-        parsers = []
+        alternatives = []
         stack = [node]
         while stack:
             top = stack.pop()
@@ -183,13 +1392,28 @@ class _Compiler(object):
                 stack.append(top.right)
                 stack.append(top.left)
             else:
-                parser = self.compile(top)
-                parsers.append(parser)
+                alternatives.append(top)
+        # Each run of string literals becomes one parser that looks them all
+        # up at once, instead of trying them one at a time.
+        parsers = []
+        for is_string, run in itertools.groupby(alternatives,
+                lambda x: isinstance(x, basestring)):
+            run = list(run)
+            if is_string and len(run) > 1:
+                choice = _LiteralChoice(run, self.is_text)
+                parsers.append(_literal_choice_parser(choice))
+            else:
+                parsers.extend(self.compile(i) for i in run)
+        if len(parsers) == 1:
+            return parsers[0]
         return _OrParser(parsers)
 
     def compile_require(self, node):
-        parser = self.compile(node.expression)
-        return _RequireParser(parser, node.predicate)
+        parser = self.values.compile(node.expression)
+        predicate = node.predicate
+        if self.deferred:
+            predicate = _resolving(predicate)
+        return _RequireParser(parser, predicate)
 
     def compile_return(self, node):
         return _return_parser(node.value)
@@ -200,8 +1424,10 @@ class _Compiler(object):
         return _RightParser(left_parser, right_parser)
 
     def compile_some(self, node):
-        delegate = Require(List(node.element), bool)
-        return self.compile(delegate)
+        # Use the predicate directly, even when the actions are deferred,
+        # since it only looks at the length of the list.
+        parser = self.compile(List(node.element))
+        return _RequireParser(parser, bool)
 
     def compile_start(self, node):
         return _start_parser
@@ -217,17 +1443,68 @@ class _Compiler(object):
         if not self.is_text:
             return _token_instance_parser(node)
         parser = self.compile(node._pattern)
+        if self.deferred:
+            function = _deferring(partial(_make_token, node))
+            return _TransformParser(parser, function)
         return _TokenParser(parser, node)
 
     def compile_transform(self, node):
         parser = self.compile(node.expression)
-        return _TransformParser(parser, node.function)
+        function = node.function
+        if self.deferred:
+            function = _deferring(function)
+        return _TransformParser(parser, function)
 
     def compile_tuple(self, node):
         parsers = [self.compile(i) for i in node]
         return _SequenceParser(parsers)
 
 
+class _Recognizer(_Compiler):
+    # Compiles parsers that don't build values. Lists count their elements
+    # (so that Some can still tell if a list is empty), sequences return None,
+    # and transforms and tokens are left out. Require and Bind expressions
+    # still need the values of their operands, so another compiler builds
+    # those parts of the grammar.
+
+    def __init__(self, is_text, fuse=True, bind_cache=None):
+        _Compiler.__init__(self, is_text, fuse=fuse, bind_cache=bind_cache)
+        self.values = _Compiler(is_text, fuse=fuse,
+            bind_cache=self.bind_cache)
+
+    def compile_list(self, node):
+        scan = self.scan(node.element, collect=False)
+        if scan is not None:
+            return scan
+        parser = self.compile(node.element)
+        return _ListParser(parser, collect=False)
+
+    def compile_token(self, node):
+        if not self.is_text:
+            return _token_instance_parser(node)
+        return self.compile(node._pattern)
+
+    def compile_transform(self, node):
+        return self.compile(node.expression)
+
+    def compile_tuple(self, node):
+        parsers = [self.compile(i) for i in node]
+        return _SequenceParser(parsers, collect=False)
+
+    def fused(self, fusion):
+        # Just find where the regex stops, without building its value.
+        fusion.build = None
+        return _fused_text_parser(fusion)
+
+
+def _leaf(parser, factory, arg):
+    # Record how a leaf parser was made, so that other backends (and any
+    # analysis of the parser graph) can tell what the parser matches.
+    parser.factory = factory
+    parser.arg = arg
+    return parser
+
+
 def _any_parser(source, pos):
     yield (ParseFailure if pos >= len(source)
         else ParseResult(source[pos], pos + 1))
@@ -237,7 +1514,13 @@ def _backtrack_parser(count):
     def parse(source, pos):
         dst = pos - count
         yield ParseFailure if dst < 0 else ParseResult(None, dst)
-    return parse
+    return _leaf(parse, _backtrack_parser, count)
+
+
+def _commit_parser(source, pos):
+    # The interpreter and the code generator recognize this parser and record
+    # the position. On its own, it just succeeds.
+    yield ParseResult(None, pos)
 
 
 def _end_parser(source, pos):
@@ -253,7 +1536,7 @@ def _literal_parser(value):
     def parser(source, pos):
         is_match = (pos < len(source)) and source[pos] == value
         yield ParseResult(value, pos + 1) if is_match else ParseFailure
-    return parser
+    return _leaf(parser, _literal_parser, value)
 
 
 def _none_parser(source, pos):
@@ -263,13 +1546,32 @@ def _none_parser(source, pos):
 def _return_parser(value):
     def parser(source, pos):
         yield ParseResult(value, pos)
-    return _none_parser if value is None else parser
+    if value is None:
+        return _none_parser
+    return _leaf(parser, _return_parser, value)
 
 
 def _start_parser(source, pos):
     yield ParseResult(None, pos) if pos == 0 else ParseFailure
 
 
+# The parsers above don't depend on the grammar, so they're shared by every
+# grammar. They're all cheap, so we never memoize them.
+_any_parser.memoize = False
+_commit_parser.memoize = False
+_end_parser.memoize = False
+_fail_parser.memoize = False
+_none_parser.memoize = False
+_start_parser.memoize = False
+
+_any_parser.always_succeeds = False
+_commit_parser.always_succeeds = True
+_end_parser.always_succeeds = False
+_fail_parser.always_succeeds = False
+_none_parser.always_succeeds = True
+_start_parser.always_succeeds = False
+
+
 class _BindParser(object):
     def __init__(self, bind, parser, function):
         self.bind = bind
@@ -308,17 +1610,22 @@ class _LeftParser(object):
 
 
 class _ListParser(object):
-    def __init__(self, parser):
+    def __init__(self, parser, collect=True):
         self.parser = parser
+        self.collect = collect
 
     def __call__(self, source, pos):
-        ans = []
+        # Without "collect", just count the elements.
+        ans = [] if self.collect else 0
         while True:
             elmt = yield ParseStep(self.parser, pos)
             if elmt is ParseFailure or pos == elmt.pos:
                 break
             pos = elmt.pos
-            ans.append(elmt.value)
+            if self.collect:
+                ans.append(elmt.value)
+            else:
+                ans += 1
         yield ParseResult(ans, pos)
 
 
@@ -334,9 +1641,14 @@ class _NotParser(object):
 class _OrParser(object):
     def __init__(self, parsers):
         self.parsers = parsers
+        self.dispatch = None
 
     def __call__(self, source, pos):
-        for parser in self.parsers:
+        parsers = self.parsers
+        if self.dispatch is not None:
+            key = self.dispatch.key(source, pos)
+            parsers = [parsers[i] for i in self.dispatch.indexes(key)]
+        for parser in parsers:
             ans = yield ParseStep(parser, pos)
             if ans is not ParseFailure:
                 yield ans
@@ -368,8 +1680,9 @@ class _RightParser(object):
 
 
 class _SequenceParser(object):
-    def __init__(self, parsers):
+    def __init__(self, parsers, collect=True):
         self.parsers = parsers
+        self.collect = collect
 
     def __call__(self, source, pos):
         ans = []
@@ -377,9 +1690,10 @@ class _SequenceParser(object):
             elmt = yield ParseStep(parser, pos)
             if elmt is ParseFailure:
                 yield ParseFailure
-            ans.append(elmt.value)
+            if self.collect:
+                ans.append(elmt.value)
             pos = elmt.pos
-        yield ParseResult(tuple(ans), pos)
+        yield ParseResult(tuple(ans) if self.collect else None, pos)
 
 
 class _TransformParser(object):
@@ -405,19 +1719,81 @@ class _TokenParser(object):
         step = yield ParseStep(self.parser, pos)
         if step is ParseFailure:
             yield ParseFailure
-        match = step.value
-        ans = self.token_class(match.group(0))
-        for k, v in match.groupdict().iteritems():
-            setattr(ans, k, v)
+        ans = _make_token(self.token_class, step.value)
         yield ParseResult(ans, step.pos)
 
 
+# The parsers that only delegate to other parsers.
+_composite_parsers = (_BindParser, _ExpectParser, _LeftParser, _ListParser,
+    _NotParser, _OrParser, _RequireParser, _RightParser, _SequenceParser,
+    _TokenParser, _TransformParser)
+
+
+def _make_token(token_class, match):
+    ans = token_class(match.group(0))
+    for k, v in match.groupdict().iteritems():
+        setattr(ans, k, v)
+    return ans
+
+
+class _Deferred(object):
+    # An action that hasn't run yet. Once it runs, "function" is None and
+    # "argument" holds the result, so that the action only runs once even
+    # when the node appears in the tree more than once.
+    __slots__ = ('function', 'argument')
+
+    def __init__(self, function, argument):
+        self.function = function
+        self.argument = argument
+
+
+def _deferring(function):
+    return partial(_Deferred, function)
+
+
+def _resolving(function):
+    return lambda value: function(_resolve(value))
+
+
+def _resolve(value):
+    # Runs the deferred actions in a parse tree, from the bottom up. Use a
+    # stack instead of recursion, since the trees may be very deep. Each frame
+    # holds a node, an iterator over its children, and the resolved children.
+    stack = [(None, iter((value,)), [])]
+    while True:
+        node, children, values = stack[-1]
+        for child in children:
+            kind = child.__class__
+            if kind is _Deferred and child.function is None:
+                values.append(child.argument)
+            elif kind is _Deferred:
+                stack.append((child, iter((child.argument,)), []))
+                break
+            elif (kind is tuple or kind is list) and child:
+                stack.append((child, iter(child), []))
+                break
+            else:
+                values.append(child)
+        else:
+            stack.pop()
+            kind = node.__class__
+            if node is None:
+                return values[0]
+            elif kind is _Deferred:
+                node.argument = node.function(values[0])
+                node.function = None
+                values = node.argument
+            elif kind is tuple:
+                values = tuple(values)
+            stack[-1][2].append(values)
+
+
 def _token_instance_parser(token_class):
     def parser(source, pos):
         obj = source[pos] if pos < len(source) else None
         is_inst = isinstance(obj, token_class)
         yield ParseResult(obj, pos + 1) if is_inst else ParseFailure
-    return parser
+    return _leaf(parser, _token_instance_parser, token_class)
 
 
 def _text_prefix_eq(string):
@@ -426,7 +1802,7 @@ def _text_prefix_eq(string):
         end = pos + count
         test = source[pos : end]
         yield ParseResult(string, end) if test == string else ParseFailure
-    return parser
+    return _leaf(parser, _text_prefix_eq, string)
 
 
 def _token_content_eq(string):
@@ -435,14 +1811,14 @@ def _token_content_eq(string):
             yield ParseFailure
         is_match = string == getattr(source[pos], 'content')
         yield ParseResult(string, pos + 1) if is_match else ParseFailure
-    return parser
+    return _leaf(parser, _token_content_eq, string)
 
 
 def _regex_text_parser(regex):
     def parser(source, pos):
         match = regex.match(source, pos)
         yield ParseResult(match, match.end()) if match else ParseFailure
-    return parser
+    return _leaf(parser, _regex_text_parser, regex)
 
 
 def _regex_token_parser(regex):
@@ -453,4 +1829,291 @@ def _regex_token_parser(regex):
         match = regex.match(content)
         is_end = match and match.end() == len(source)
         yield ParseResult(match, pos + 1) if match else ParseFailure
-    return parser
+    return _leaf(parser, _regex_token_parser, regex)
+
+
+class _LiteralChoice(object):
+    # Finds the first of a list of strings that matches at a position. In
+    # text mode, it groups the strings by length, so that it only has to look
+    # up one slice of the source per length. In data mode, it looks up the
+    # content of the next token.
+
+    def __init__(self, strings, is_text):
+        self.strings = strings
+        self.is_text = is_text
+        self.indexes = {}
+        rows = {}
+        for index, string in enumerate(strings):
+            self.indexes.setdefault(string, index)
+            rows.setdefault(len(string), {}).setdefault(string, index)
+        # Sort the lengths by the first index that they can produce. Once
+        # we have a match, we can skip the lengths that can't beat it.
+        self.rows = sorted((min(row.itervalues()), length, row)
+            for length, row in rows.iteritems())
+        self.longest = max(rows) if rows else 0
+
+    def find(self, source, pos):
+        # Returns the index of the first matching string, or None.
+        if not self.is_text:
+            if pos >= len(source):
+                return None
+            return self.indexes.get(getattr(source[pos], 'content'))
+        best = None
+        for rank, length, row in self.rows:
+            if best is not None and rank > best:
+                break
+            index = row.get(source[pos : pos + length])
+            if index is not None and (best is None or index < best):
+                best = index
+        return best
+
+
+def _literal_choice_parser(choice):
+    strings, find = choice.strings, choice.find
+    step = None if choice.is_text else 1
+    def parser(source, pos):
+        index = find(source, pos)
+        if index is None:
+            yield ParseFailure
+        string = strings[index]
+        end = pos + (len(string) if step is None else step)
+        yield ParseResult(string, end)
+    return _leaf(parser, _literal_choice_parser, choice)
+
+
+def _fused_text_parser(fusion):
+    regex, build = fusion.regex, fusion.build
+    def parser(source, pos):
+        match = regex.match(source, pos)
+        if match is None:
+            yield ParseFailure
+        yield ParseResult(build(match, source), match.end())
+    def recognizer(source, pos):
+        match = regex.match(source, pos)
+        yield ParseFailure if match is None else ParseResult(None, match.end())
+    if build is None:
+        parser = recognizer
+    return _leaf(parser, _fused_text_parser, fusion)
+
+
+def _scan_parser(scan):
+    run = scan.run
+    def parser(source, pos):
+        yield run(source, pos)
+    return _leaf(parser, _scan_parser, scan)
+
+
+class _ScanResult(ParseResult):
+    # The result of a scan that stopped because its terminal failed. The
+    # interpreter records that failure at the end of the result, since it may
+    # be the farthest one, and then passes on a plain ParseResult.
+    __slots__ = ()
+
+
+class _Scan(object):
+    # Matches a fused terminal again and again, the way that a _ListParser
+    # would run it, but in one loop. Like the _ListParser, it stops when the
+    # terminal fails or matches without consuming anything. Without
+    # "collect", it just counts the matches.
+
+    def __init__(self, fusion, collect=True):
+        self.fusion = fusion
+        self.collect = collect
+
+    def run(self, source, pos):
+        match, build = self.fusion.regex.match, self.fusion.build
+        ans = [] if self.collect else 0
+        while True:
+            found = match(source, pos)
+            if found is None:
+                return _ScanResult(ans, pos)
+            end = found.end()
+            if end == pos:
+                return ParseResult(ans, pos)
+            if self.collect:
+                ans.append(build(found, source))
+            else:
+                ans += 1
+            pos = end
+
+
+class _Fusion(object):
+    # A composite of text-mode terminals, merged into one regex. The "build"
+    # function takes the match and the source, and returns the value that
+    # the original parsers would have returned. (Or it's None, if the parser
+    # only recognizes the text.) Python's "re" module doesn't
+    # have atomic groups, so we use ``(?=(X))\N`` to keep the regex engine
+    # from backtracking into X, where a PEG wouldn't.
+
+    def __init__(self, pattern, build, first, is_empty, always_succeeds):
+        self.pattern = pattern
+        self.build = build
+        self.first = first
+        self.is_empty = is_empty
+        self.always_succeeds = always_succeeds
+        self.regex = None
+
+
+_regex_type = type(re.compile(''))
+
+
+def _fuse(node):
+    # Returns a _Fusion for a sequence, Opt, Expect or Not expression whose
+    # operands are all string literals, regexes, choices between string
+    # literals and other such expressions. Returns None for any other
+    # expression. (The expression classes are tuples too, so check for plain
+    # tuples by type.)
+    if type(node) is not tuple and not isinstance(node,
+            (Left, Right, Opt, Expect, Not)):
+        return None
+    return _fuse_terminals(node)
+
+
+def _fuse_terminals(node):
+    # Like _fuse, but also accepts a single terminal, like a string literal or
+    # a regex. (On its own, a single terminal doesn't need to be fused.)
+    groups = [0]
+    ans = _fuse_node(node, groups)
+    # Python 2's "re" module only supports 100 groups.
+    if ans is None or groups[0] >= 100:
+        return None
+    try:
+        ans.regex = re.compile(ans.pattern)
+    except re.error:
+        return None
+    # Keep the expression, so that an error message can run its terminals
+    # one at a time.
+    ans.node = node
+    return ans
+
+
+def _fuse_node(node, groups):
+    # Returns a _Fusion for the expression, without its regex. The "groups"
+    # list holds the number of groups so far.
+    if isinstance(node, basestring):
+        first = frozenset([('char', node[0])] if node else [])
+        build = lambda match, source: node
+        return _Fusion(re.escape(node), build, first, not node, not node)
+    if isinstance(node, _regex_type):
+        return _fuse_regex(node, groups, False)
+    if (isinstance(node, Transform) and node.function is _matched_text
+            and isinstance(node.expression, _regex_type)):
+        return _fuse_regex(node.expression, groups, True)
+    if isinstance(node, Or):
+        strings = _or_strings(node)
+        if strings is None:
+            return None
+        # Regex alternation is ordered, like a PEG's.
+        index = groups[0] = groups[0] + 1
+        options = '|'.join(re.escape(i) for i in strings)
+        pattern = r'(?=(%s))(?:\%d)' % (options, index)
+        build = lambda match, source: match.group(index)
+        first = frozenset(('char', i[0]) for i in strings if i)
+        is_empty = '' in strings
+        return _Fusion(pattern, build, first, is_empty, is_empty)
+    if isinstance(node, Opt):
+        outer = groups[0] = groups[0] + 1
+        inner = groups[0] = groups[0] + 1
+        ans = _fuse_node(node.expression, groups)
+        if ans is None:
+            return None
+        pattern = r'(?=((%s)?))(?:\%d)' % (ans.pattern, outer)
+        build = ans.build
+        value = lambda match, source: (None if match.group(inner) is None
+            else build(match, source))
+        return _Fusion(pattern, value, ans.first, True, True)
+    if isinstance(node, Not):
+        ans = _fuse_node(node.expression, groups)
+        if ans is None:
+            return None
+        none = lambda match, source: None
+        return _Fusion('(?!%s)' % ans.pattern, none, frozenset(), True, False)
+    if isinstance(node, Expect):
+        ans = _fuse_node(node.expression, groups)
+        if ans is None:
+            return None
+        pattern = '(?=%s)' % ans.pattern
+        return _Fusion(pattern, ans.build, ans.first, True,
+            ans.always_succeeds)
+    if isinstance(node, (Left, Right)):
+        parts = [node.left, node.right]
+    elif type(node) is tuple:
+        parts = node
+    else:
+        return None
+    fused = []
+    for part in parts:
+        ans = _fuse_node(part, groups)
+        if ans is None:
+            return None
+        fused.append(ans)
+    builders = [i.build for i in fused]
+    if type(node) is tuple:
+        build = lambda match, source: tuple(f(match, source) for f in builders)
+    else:
+        build = builders[0] if isinstance(node, Left) else builders[1]
+    first = frozenset()
+    for part in fused:
+        if part.first is None or first is None:
+            first = None
+        else:
+            first = first | part.first
+        if not part.is_empty:
+            break
+    return _Fusion(''.join(i.pattern for i in fused), build, first,
+        all(i.is_empty for i in fused), all(i.always_succeeds for i in fused))
+
+
+def _or_strings(node):
+    # Returns the alternatives of an Or if they're all strings, or None.
+    ans = []
+    stack = [node]
+    while stack:
+        top = stack.pop()
+        if isinstance(top, Or):
+            stack.append(top.right)
+            stack.append(top.left)
+        elif isinstance(top, basestring):
+            ans.append(top)
+        else:
+            return None
+    return ans
+
+
+def _fuse_regex(regex, groups, is_text):
+    # A regex keeps its value if it doesn't use flags, named groups or
+    # backreferences, since its groups get new numbers in the merged regex.
+    try:
+        tree = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, TypeError):
+        return None
+    if tree.pattern.flags or regex.groupindex or _has_backreference(tree):
+        return None
+    index = groups[0] = groups[0] + 1
+    groups[0] += regex.groups
+    pattern = r'(?=(%s))(?:\%d)' % (regex.pattern, index)
+    if is_text:
+        build = lambda match, source: match.group(index)
+    else:
+        # Match the original regex again, to get the same match object.
+        build = lambda match, source: regex.match(source, match.start(index))
+    first = _regex_first_set(regex)
+    is_empty = _regex_may_be_empty(regex)
+    return _Fusion(pattern, build, first, is_empty, False)
+
+
+def _has_backreference(items):
+    c = sre_constants
+    for op, arg in items:
+        if op in (c.GROUPREF, c.GROUPREF_EXISTS):
+            return True
+        if op == c.BRANCH:
+            children = arg[1]
+        elif op in (c.SUBPATTERN, c.MAX_REPEAT, c.MIN_REPEAT, c.ASSERT,
+                c.ASSERT_NOT):
+            children = [arg[-1]]
+        else:
+            children = []
+        if any(_has_backreference(i) for i in children):
+            return True
+    return False
@@ -206,6 +206,37 @@ self.Bind = 'expression, function', '''
 '''
 
 
+self.Commit = '', '''
+
+    Tells the parser that it will never have to backtrack to a position before
+    the current one. After a ``Commit``, the parser doesn't try the remaining
+    alternatives of any choice that started before it. If something before
+    the ``Commit`` position fails, then the whole parse fails right away.
+
+    This lets the interpreter throw away the memo entries before the
+    ``Commit`` position, which keeps memory use down on long inputs. It also
+    makes the parser report errors sooner. A ``Commit`` inside of a lookahead
+    (like ``Expect`` or ``Not``) doesn't do anything.
+
+    Example::
+
+        from sourcer import *
+        Name = Pattern(r'[a-z]+')
+        # Once we see "let", we know that we're parsing a let statement.
+        Let = ('let', Commit, ' ', Name, '=', Name)
+        Statements = List((Let | Name) << ';')
+        ans = parse(Statements, 'let x=y;z;')
+        assert ans == [('let', None, ' ', 'x', '=', 'y'), 'z']
+
+        # Without the Commit, "letz" would parse as a name.
+        try:
+            parse(Statements, 'let x=y;letz;')
+            assert False
+        except ParseError:
+            pass
+'''
+
+
 self.End = '', 'Matches the end of the input.'
 
 
@@ -215,7 +246,21 @@ self.Expect = 'expression'
 self.Fail = '', 'Causes the parser to fail.'
 
 
-self.ForwardRef = 'resolve'
+self.ForwardRef = 'resolve', '''
+
+    Refers to an expression that isn't defined yet. The ``resolve`` function
+    returns the expression. Use ``ForwardRef`` to write recursive rules. The
+    rules may be left-recursive.
+
+    Example::
+
+        from sourcer import *
+        Int = Pattern(r'\d+') * int
+        Expr = ForwardRef(lambda: Sum | Int)
+        Sum = (Expr, '+', Int)
+        ans = parse(Expr, '1+2+3')
+        assert ans == ((1, '+', 2), '+', 3)
+'''
 
 
 self.Left = 'left, right'
@@ -276,6 +321,46 @@ self.List = 'element', '''
 self.Literal = 'value'
 
 
+self.Memo = 'expression', '''
+
+    Tells the compiler to memoize the results of the expression.
+
+    Normally, the compiler decides which parsers are worth memoizing. It
+    memoizes the parsers that the grammar may try more than once at the same
+    position. ``Memo`` and ``NoMemo`` let you make this decision yourself. The
+    decision applies to every use of the expression within the grammar.
+
+    Example::
+
+        from sourcer import *
+        # The "Value" rule appears in both alternatives, so the compiler would
+        # memoize it anyway. Here, we make it explicit.
+        Value = Memo(Pattern(r'\d+') * int)
+        Pair = Or((Value, '+', Value), (Value, '-', Value))
+        ans = parse(Pair, '1-2')
+        assert ans == (1, '-', 2)
+'''
+
+
+self.NoMemo = 'expression', '''
+
+    Tells the compiler not to memoize the results of the expression. (See the
+    ``Memo`` class for more details.) The compiler still memoizes a parser
+    that a cycle in the grammar needs, like the head of a left-recursive
+    rule, since the parse would loop forever without it.
+
+    Example::
+
+        from sourcer import *
+        # Let's say we know that our input never has much whitespace, so
+        # we'd rather parse it again than keep it around in the memo table.
+        Space = NoMemo(Pattern(r'\s*'))
+        Words = List(Space >> Pattern(r'\w+'))
+        ans = parse(Words, 'foo bar baz')
+        assert ans == ['foo', 'bar', 'baz']
+'''
+
+
 self.Not = 'expression'
 
 
@@ -325,7 +410,13 @@ def Alt(element, separator, allow_trailer=True):
 
 
 def AnyOf(*args):
-    return reduce(Or, args)
+    # Build a balanced tree, so that a long list of alternatives doesn't
+    # become a deeply nested expression. (The order of the leaves is all
+    # that matters to an ordered choice.)
+    if len(args) <= 1:
+        return reduce(Or, args)
+    middle = len(args) // 2
+    return Or(AnyOf(*args[:middle]), AnyOf(*args[middle:]))
 
 
 def Backtrack(count=1):
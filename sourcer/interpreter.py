@@ -1,9 +1,163 @@
-from .expressions import Left, End
+import ctypes
+import mmap
+import multiprocessing
+import threading
+import time
+from .expressions import Alt, Left, End, Or, Right
 from .compiler import *
+from .compiler import (
+    _ExpectParser,
+    _LeftParser,
+    _ListParser,
+    _NotParser,
+    _OrParser,
+    _RightParser,
+    _SequenceParser,
+    _TokenParser,
+    _TransformParser,
+    _any_parser,
+    _backtrack_parser,
+    _child_parsers,
+    _commit_parser,
+    _end_parser,
+    _fused_text_parser,
+    _literal_choice_parser,
+    _literal_parser,
+    _regex_text_parser,
+    _regex_reach,
+    _regex_token_parser,
+    _resolve,
+    _scan_parser,
+    _start_parser,
+    _text_prefix_eq,
+    _token_content_eq,
+    _token_instance_parser,
+)
+from .codegen import generate
+from .profiler import _rule
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
-# Sourcer raises this exception when it cannot parse an input sequence.
-class ParseError(Exception): pass
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+
+class ParseError(Exception):
+    # Sourcer raises this exception when it cannot parse an input sequence.
+    # When the interpreter ran the parse, "position" is the farthest position
+    # where a terminal failed to match (or where the parse stopped, if that's
+    # farther), and "expected" is a sorted list of descriptions of the
+    # terminals that failed there. For a text source, "line" and "column" are
+    # the one-based line and column of the position. Otherwise, they're None.
+
+    def __init__(self, position=None, expected=(), source=None):
+        Exception.__init__(self)
+        self.position = position
+        self.expected = list(expected)
+        self.line = self.column = None
+        if position is not None and isinstance(source, basestring):
+            self.line = source.count('\n', 0, position) + 1
+            self.column = position - source.rfind('\n', 0, position)
+
+    def __str__(self):
+        if self.position is None:
+            return ''
+        if self.line is None:
+            where = 'at position %d' % self.position
+        else:
+            where = 'at line %d, column %d' % (self.line, self.column)
+        if not self.expected:
+            return 'The parse failed %s.' % where
+        return 'Expected %s %s.' % (' or '.join(self.expected), where)
+
+    def __reduce__(self):
+        # Let worker processes send the error back.
+        return ParseError, (), self.__dict__
+
+
+# The work that a parse had done when it stopped: the number of interpreter
+# steps, the number of memo entries, the depth of the parser stack, and the
+# elapsed time.
+ParseStats = namedtuple('ParseStats', 'steps, memo_size, depth, seconds')
+
+
+class ParseBudgetExceeded(Exception):
+    # Sourcer raises this exception when a parse goes over one of the limits
+    # of its ParseBudget. The "limit" attribute is the name of the limit, and
+    # "stats" is a ParseStats tuple.
+
+    def __init__(self, limit, stats):
+        Exception.__init__(self, 'The parse went over its %s budget.' % limit)
+        self.limit = limit
+        self.stats = stats
+
+
+class ParseBudget(object):
+    '''
+    Limits the work of a parse, so that a pathological input can't keep the
+    parser busy for long. Pass it to ``parse`` (or ``parse_prefix``) as the
+    ``budget`` argument. The parse raises ParseBudgetExceeded if it goes over
+    any of these limits:
+
+    - ``steps``: the number of interpreter steps. (Each step starts or
+      resumes a parser.)
+    - ``memo_size``: the number of entries in the memo table.
+    - ``depth``: the depth of the parser stack.
+    - ``seconds``: the elapsed time.
+
+    A limit of None means no limit. The interpreter looks at the memo table,
+    the stack and the clock every ``interval`` steps, so a parse may go a
+    little past those limits before it stops. Only the interpreter backend
+    accepts a budget.
+
+    Example::
+
+        from sourcer import *
+        Expr = ForwardRef(lambda: Or(('(', Expr, ')'), 'x'))
+        budget = ParseBudget(depth=100)
+        assert parse(Expr, '(((x)))', budget=budget) == ('(', ('(', ('(',
+            'x', ')'), ')'), ')')
+        try:
+            parse(Expr, '(' * 1000 + 'x' + ')' * 1000, budget=budget)
+            assert False
+        except ParseBudgetExceeded as e:
+            assert e.limit == 'depth' and e.stats.depth > 100
+    '''
+    def __init__(self, steps=None, memo_size=None, depth=None, seconds=None,
+            interval=256):
+        self.steps = steps
+        self.memo_size = memo_size
+        self.depth = depth
+        self.seconds = seconds
+        self.interval = interval
+
+    def run(self, interpreter, pause):
+        # Runs the interpreter from the pause in slices of "interval" steps,
+        # and checks the limits after each slice.
+        start = time.time()
+        steps = 0
+        while True:
+            size = self.interval
+            if self.steps is not None:
+                size = min(size, self.steps - steps)
+            ans = interpreter.resume(pause, size)
+            if not isinstance(ans, _Pause):
+                return ans
+            pause = ans
+            steps += size
+            stats = ParseStats(steps, len(interpreter.memo),
+                len(interpreter.stack), time.time() - start)
+            for limit in ('memo_size', 'depth', 'seconds'):
+                value = getattr(self, limit)
+                if value is not None and getattr(stats, limit) > value:
+                    raise ParseBudgetExceeded(limit, stats)
+            if self.steps is not None and steps >= self.steps:
+                raise ParseBudgetExceeded('steps', stats)
 
 
 def tokenize(token_syntax, source):
@@ -18,49 +172,1269 @@ def tokenize_and_parse(token_syntax, expression, source):
     return parse(expression, tokens)
 
 
-def parse(expression, source):
+def parse(expression, source, **options):
     # Use the expression directly, rather than ``Left(expression, End)``
     # because the compiler module caches the parser in the expression object.
     # (We want to be able to reuse the parser instead of building it again.)
-    ans = parse_prefix(expression, source)
-    if ans.pos == len(source):
+    return _parse(expression, source, True, **options).value
+
+
+def parse_prefix(expression, source, backend='interpreter', memo=None,
+        deferred=False, cache=None, budget=None, profile=None, trace=None):
+    # The "backend" argument may be "interpreter" or "codegen". The "codegen"
+    # backend turns the parser into Python source code, which is usually a
+    # lot faster, but which uses Python's call stack.
+    # The "memo" argument is an optional memo table for the interpreter, like
+    # a ``WindowedMemo`` object.
+    # With "deferred", the functions of Transform expressions (and the
+    # constructors of tokens and structs) only run on the parse tree that
+    # wins, after the parse is over. The functions of Require and Bind
+    # expressions still run during the parse, and so they make the parser
+    # run the actions of their values right away.
+    # The "cache" argument is an optional GrammarCache, which keeps the
+    # results of compiling the grammar on disk, for the next process.
+    # The "budget" argument is an optional ParseBudget, which limits the work
+    # of the interpreter.
+    # The "profile" argument is an optional ParseProfile, which gets the
+    # counts and times of each rule of the grammar.
+    # The "trace" argument is an optional ParseTrace (or any object with its
+    # hook methods), which gets an event each time that a parser starts or
+    # stops, and each time that the memo table has the answer already.
+    # The interpreter finds out where the parse failed as it goes, so that
+    # the ParseError can say so. (The "codegen" backend doesn't.)
+    return _parse(expression, source, False, backend, memo, deferred, cache,
+        budget, profile, trace)
+
+
+def _parse(expression, source, whole, backend='interpreter', memo=None,
+        deferred=False, cache=None, budget=None, profile=None, trace=None):
+    # With "whole", the parse fails if it doesn't consume the whole source.
+    original = source
+    is_text, source = _text_source(source)
+    if profile is not None or trace is not None:
+        if backend != 'interpreter':
+            raise ValueError('Only the interpreter accepts a profile or a '
+                'trace.')
+        if profile is not None and trace is not None:
+            raise ValueError('A parse accepts a profile or a trace, but not '
+                'both.')
+        labels = {}
+        parser = compile(expression, is_text, deferred, cache=cache,
+            labels=labels)
+        if profile is not None:
+            interpreter = _ProfilingInterpreter(source, memo, budget, profile,
+                labels)
+        else:
+            interpreter = _TracingInterpreter(source, memo, budget, trace,
+                labels)
+        ans = interpreter.run(parser)
+    elif backend == 'interpreter':
+        parser = compile(expression, is_text, deferred, cache=cache)
+        interpreter = _Interpreter(source, memo, budget)
+        ans = interpreter.run(parser)
+    else:
+        parser = compile(expression, is_text, deferred, cache=cache)
+        interpreter = None
+        ans = _run(parser, source, 0, backend, memo, cache, budget)
+    if ans is ParseFailure or (whole and ans.pos != len(source)):
+        raise _parse_error(interpreter, original, ans)
+    return ParseResult(_resolve(ans.value), ans.pos) if deferred else ans
+
+
+def _parse_error(interpreter, source, ans):
+    # Returns a ParseError for a parse that failed, or that stopped before the
+    # end of the source. (The interpreter may be None, for the "codegen"
+    # backend.)
+    if interpreter is None:
+        return ParseError()
+    pos, expected = interpreter.farthest_failure()
+    if ans is not ParseFailure and ans.pos >= pos:
+        if ans.pos > pos:
+            expected = set()
+        pos = ans.pos
+        expected.add('end of input')
+    return ParseError(pos, sorted(expected), source)
+
+
+def recognize(expression, source, partial=False, backend='interpreter',
+        memo=None, cache=None):
+    # Checks the source without building any values, and without raising
+    # ParseError. Returns True if the expression matches the whole source,
+    # and False if it doesn't. With "partial", returns the position where the
+    # match stops instead (or None if the expression fails).
+    is_text, source = _text_source(source)
+    parser = compile(expression, is_text, recognize=True, cache=cache)
+    ans = _run(parser, source, 0, backend, memo, cache)
+    return _recognized(ans, len(source), partial)
+
+
+def _recognized(ans, length, partial):
+    if partial:
+        return None if ans is ParseFailure else ans.pos
+    return ans is not ParseFailure and ans.pos == length
+
+
+def parse_many(expression, sources, **options):
+    # Parses each source and returns a list of the results. The list has a
+    # ParseError object (instead of a value) for each source that failed.
+    # See the Parser class for the options.
+    processes = options.pop('processes', None)
+    return Parser(expression, **options).parse_many(sources, processes)
+
+
+def parse_parallel(expression, source, boundary, processes=None, pieces=None,
+        **options):
+    # Parses a series of items with boundaries between them, just like
+    # ``parse(Alt(expression, boundary), source)``, but in worker processes.
+    # The source is split into roughly equal pieces at matches of the boundary
+    # expression. Each worker parses the items of a piece one after another,
+    # in the whole source, and checks that the last item ends right where the
+    # piece ends. So a boundary that matched inside of an item can't split
+    # the item in two: the item runs past the end of the piece. If any piece
+    # fails, we parse the whole source again on one process.
+    whole = Alt(expression, boundary)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if pieces is None:
+        pieces = 4 * processes
+    bounds = _split(source, boundary, pieces) if processes > 1 else []
+    if len(bounds) > 1:
+        parser = _PieceParser(expression, boundary, source, options)
+        results = _parse_in_workers(parser, bounds, processes, 1)
+        if None not in results:
+            return [i for piece in results for i in piece]
+    return parse(whole, source, **options)
+
+
+class _PieceParser(object):
+    # Parses the items of a piece of the source for parse_parallel, like
+    # ``Alt(expression, boundary)`` would. The "try_parse" method takes the
+    # start and end of a piece, and returns a list of the values of its items,
+    # or None if they don't end where the piece does.
+
+    def __init__(self, expression, boundary, source, options):
+        self.first = Parser(expression, **options)
+        self.rest = Parser(Right(boundary, expression), **options)
+        self.trailer = Parser(boundary, **options)
+        self.source = _text_source(source)[1]
+        self.length = len(self.source)
+
+    def try_parse(self, bounds):
+        start, stop = bounds
+        at_end = stop == self.length
+        ans = self.first._run(self.source, pos=start)
+        if ans is ParseFailure:
+            # The source may end with a boundary, which the split left out.
+            return [] if at_end and start == stop else None
+        values = []
+        while ans.pos <= stop:
+            values.append(ans.value)
+            pos = ans.pos
+            if pos == stop:
+                return values
+            ans = self.rest._run(self.source, pos=pos)
+            if ans is ParseFailure or ans.pos == pos:
+                ans = self.trailer._run(self.source, pos=pos)
+                if at_end and ans is not ParseFailure and ans.pos == stop:
+                    return values
+                return None
+        return None
+
+
+def _split(source, boundary, count):
+    # Splits the source into about "count" pieces, at the matches of the
+    # boundary expression, and returns a list of the start and end of each
+    # piece. The matches themselves are left out.
+    is_text, source = _text_source(source)
+    parser = compile(boundary, is_text)
+    size = len(source) // count
+    bounds = []
+    start = 0
+    for index in range(1, count):
+        pos = max(start + 1, index * size)
+        while pos < len(source):
+            ans = _run(parser, source, pos, 'interpreter')
+            if ans is not ParseFailure and ans.pos > pos:
+                break
+            pos += 1
+        else:
+            break
+        bounds.append((start, pos))
+        start = ans.pos
+    bounds.append((start, len(source)))
+    return bounds
+
+
+class Parser(object):
+    # Holds a compiled parser, so that it can parse many inputs without
+    # looking up the parser or setting up an interpreter each time. Threads
+    # may share a Parser, since each thread gets its own interpreter.
+
+    def __init__(self, expression, backend='interpreter', deferred=False,
+            cache=None, passes=None, bind_cache=None):
+        # The expression may be a Grammar. The "passes" argument is an
+        # optional PassManager (or a list of passes) for the compiler, and
+        # "bind_cache" is an optional BindCache. See the compile function.
+        if backend not in ('codegen', 'interpreter'):
+            raise ValueError('unknown backend: %r' % (backend,))
+        self.expression = expression
+        self.backend = backend
+        self.deferred = deferred
+        self.cache = cache
+        self.passes = passes
+        self.bind_cache = bind_cache
+        self.parsers = {}
+        self.local = threading.local()
+
+    def parse(self, source):
+        ans = self.try_parse(source)
+        if isinstance(ans, ParseError):
+            raise ans
+        return ans
+
+    def try_parse(self, source):
+        # Like "parse", but returns a ParseError object instead of raising it.
+        ans = self._run(source)
+        if ans is ParseFailure or ans.pos != len(source):
+            return self._error(source, ans)
         return ans.value
-    raise ParseError()
 
+    def parse_prefix(self, source):
+        ans = self._run(source)
+        if ans is ParseFailure:
+            raise self._error(source, ans)
+        return ans
 
-def parse_prefix(expression, source):
-    is_text = isinstance(source, basestring)
-    parser = compile(expression, is_text)
-    interpreter = _Interpreter(source)
-    return interpreter.run(parser)
+    def recognize(self, source, partial=False):
+        # See the recognize function.
+        ans = self._run(source, recognize=True)
+        return _recognized(ans, len(source), partial)
 
+    def parse_many(self, sources, processes=None, chunk_size=256):
+        # Returns a list of results, like the parse_many function. When
+        # "processes" is a number, the work is split among that many worker
+        # processes. The workers get the parser and the sources by forking,
+        # since grammars usually contain lambdas, which can't be pickled.
+        #
+        # The results come back pickled. When a chunk of results can't be
+        # pickled (like the tokens of a TokenSyntax, whose classes only exist
+        # in the syntax object), we parse that chunk again in this process.
+        if not processes:
+            return [self.try_parse(i) for i in sources]
+        return _parse_in_workers(self, list(sources), processes, chunk_size)
 
-class _Interpreter(object):
-    def __init__(self, source):
+    def _run(self, source, recognize=False, pos=0):
+        is_text, source = _text_source(source)
+        key = (is_text, recognize)
+        parser = self.parsers.get(key)
+        if parser is None:
+            deferred = self.deferred
+            parser = compile(self.expression, is_text, deferred, recognize,
+                cache=self.cache, passes=self.passes,
+                bind_cache=self.bind_cache)
+            self.parsers[key] = parser
+        if self.backend == 'codegen':
+            ans = generate(parser, self.cache).run(source, pos)
+        else:
+            interpreter = self._interpreter()
+            interpreter.reset(source)
+            ans = interpreter.run(parser, pos)
+        if recognize:
+            return ans
+        if self.deferred and ans is not ParseFailure:
+            ans = ParseResult(_resolve(ans.value), ans.pos)
+        return ans
+
+    def _error(self, source, ans):
+        is_interpreter = self.backend == 'interpreter'
+        return _parse_error(self._interpreter() if is_interpreter else None,
+            source, ans)
+
+    def _interpreter(self):
+        # Returns the interpreter of the current thread. (An interpreter holds
+        # the memo table and the stack of the parse that it's running.)
+        interpreter = getattr(self.local, 'interpreter', None)
+        if interpreter is None:
+            interpreter = self.local.interpreter = _Interpreter(None)
+        return interpreter
+
+
+def _parse_in_workers(parser, sources, processes, chunk_size):
+    # Calls the parser's "try_parse" method on each source in a pool of worker
+    # processes, and returns a list of the results. (See Parser.parse_many.)
+    chunks = [(i, min(i + chunk_size, len(sources)))
+        for i in range(0, len(sources), chunk_size)]
+    pool = _process_pool(processes, _start_worker, (parser, sources))
+    try:
+        results = list(pool.map(_parse_chunk, chunks))
+    finally:
+        _close_pool(pool)
+    ans = []
+    for (start, stop), data in zip(chunks, results):
+        if data is None:
+            ans.extend(parser.try_parse(i) for i in sources[start:stop])
+        else:
+            ans.extend(pickle.loads(data))
+    return ans
+
+
+# The parser and the list of sources of a worker process. Each worker gets
+# them from the pool's initializer when it starts.
+_worker_state = None
+
+
+def _start_worker(parser, sources):
+    global _worker_state
+    _worker_state = (parser, sources)
+
+
+def _parse_chunk(bounds):
+    # Returns the pickled results of a chunk, or None if they can't be pickled.
+    parser, sources = _worker_state
+    ans = [parser.try_parse(i) for i in sources[bounds[0]:bounds[1]]]
+    try:
+        return pickle.dumps(ans, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def _process_pool(processes, initializer, initargs):
+    # Use concurrent.futures when it's available, and multiprocessing when
+    # it's not. (Python 2 needs the "futures" package for concurrent.futures,
+    # and its older versions don't take an initializer.)
+    if ProcessPoolExecutor is not None:
+        try:
+            return ProcessPoolExecutor(processes, initializer=initializer,
+                initargs=initargs)
+        except TypeError:
+            pass
+    return multiprocessing.Pool(processes, initializer, initargs)
+
+
+def _close_pool(pool):
+    if hasattr(pool, 'shutdown'):
+        pool.shutdown()
+    else:
+        pool.close()
+        pool.join()
+
+
+def iterparse(expression, fileobj, separator=None, chunk_size=65536,
+        backend='interpreter', cache=None):
+    # Parses a series of items from a file-like object, and yields the value of
+    # each item as soon as it's complete. The "separator" argument is an
+    # optional expression that must follow each item, except for the last one.
+    # Only the part of the file that hasn't been parsed yet stays in memory,
+    # and each item gets a new memo table. The reads may return strings or
+    # binary data, like bytearrays and memoryviews.
+    #
+    # An item is only complete if no parser looked at the end of the buffer.
+    # (Even a parser that failed, since more input might let it match.) Like
+    # the IncrementalParser, we keep the terminals apart to find out how far
+    # the parsers looked. Only the interpreter can tell us that, so it builds
+    # each item in the same pass, even with the "codegen" backend.
+    if backend not in ('codegen', 'interpreter'):
+        raise ValueError('unknown backend: %r' % (backend,))
+    if separator is not None:
+        expression = Left(expression, Or(separator, End))
+    parser = compile(expression, fuse=False, cache=cache)
+    buf = ''
+    start = 0
+    # The position of the buffer in the file, the number of lines before it,
+    # and the position where the buffer's first line starts. (For errors.)
+    offset = lines = line_start = 0
+    at_end = False
+    needs_input = True
+    while True:
+        if needs_input and not at_end:
+            # Read at least as much as we already have, so that a long item
+            # only gets parsed a logarithmic number of times.
+            chunk = fileobj.read(max(chunk_size, len(buf) - start))
+            if not isinstance(chunk, basestring):
+                # Like a bytearray or a memoryview from a binary stream.
+                chunk = _text_source(chunk)[1][:]
+            at_end = not chunk
+            lines += buf.count('\n', 0, start)
+            newline = buf.rfind('\n', 0, start)
+            if newline >= 0:
+                line_start = offset + newline + 1
+            offset += start
+            buf = buf[start:] + chunk
+            start = 0
+        if at_end and start == len(buf):
+            return
+        interpreter = _IncrementalInterpreter(buf, {})
+        ans = interpreter.run(parser, start)
+        if not at_end and interpreter.extent > len(buf):
+            needs_input = True
+            continue
+        if ans is ParseFailure or ans.pos == start:
+            error = _parse_error(interpreter, buf, ans)
+            # Move the error from the buffer to the file.
+            if buf.rfind('\n', 0, error.position) < 0:
+                error.column = offset + error.position - line_start + 1
+            error.line += lines
+            error.position += offset
+            raise error
+        yield ans.value
+        start = ans.pos
+        needs_input = False
+
+
+def parse_async(expression, source, step_budget=10000, deferred=False,
+        memo=None, cache=None, chunk_size=65536):
+    # Returns an awaitable that parses the source like the parse function,
+    # but that lets the event loop run other tasks after every "step_budget"
+    # steps of the interpreter. So a long parse doesn't hold up the loop:
+    #
+    #     value = await parse_async(Document, text, step_budget=5000)
+    #
+    # The source may also be a reader, like an asyncio StreamReader, whose
+    # "read" method returns an awaitable. (Or a file-like object, whose "read"
+    # method returns a string.) The parser may look anywhere in its input, so
+    # it reads to the end of the stream before it starts, but it waits for
+    # each read without blocking the loop.
+    #
+    # A generator-based coroutine may "yield from" the awaitable instead. Or,
+    # without an event loop, you can iterate over it, and then look at its
+    # "value" attribute.
+    return _AsyncParse(expression, source, step_budget, deferred, memo, cache,
+        chunk_size)
+
+
+class _AsyncParse(object):
+    # The awaitable object of parse_async. It's also its own iterator. Each
+    # step returns None, which asks the event loop to run other tasks for a
+    # moment, or passes along whatever the awaitable of a read yields (like a
+    # future), which the loop waits for. When the parse is over, it raises
+    # StopIteration with the value, which is how an awaitable returns its
+    # result. (Or the ParseError.) The "pauses" attribute counts the times
+    # that the parse gave way to the loop.
+
+    def __init__(self, expression, source, step_budget, deferred, memo, cache,
+            chunk_size):
+        if step_budget < 1:
+            raise ValueError('step_budget must be at least 1')
+        self.expression = expression
+        self.step_budget = step_budget
+        self.deferred = deferred
+        self.memo = memo
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.pauses = 0
+        self.done = False
+        self.value = None
+        is_reader = hasattr(source, 'read') and not isinstance(source,
+            mmap.mmap)
+        self.source = None if is_reader else source
+        self.reader = source if is_reader else None
+        self.chunks = []
+        # The iterator of the read that we're waiting for.
+        self.pending = None
+        self.interpreter = None
+
+    def __iter__(self):
+        return self
+
+    __await__ = __iter__
+
+    def __next__(self):
+        return self.send(None)
+
+    next = __next__
+
+    def send(self, value):
+        if self.done:
+            raise StopIteration(self.value)
+        if self.pending is not None:
+            try:
+                return _send(self.pending, value)
+            except StopIteration as e:
+                self.pending = None
+                self._receive(e.args[0] if e.args else None)
+        while self.reader is not None:
+            chunk = self.reader.read(self.chunk_size)
+            if isinstance(chunk, basestring):
+                self._receive(chunk)
+            else:
+                self.pending = _await_iterator(chunk)
+                return self.send(None)
+        if self.interpreter is None:
+            self._start()
+        ans = self.interpreter.resume(self.pause, self.step_budget)
+        if isinstance(ans, _Pause):
+            self.pause = ans
+            self.pauses += 1
+            return None
+        self.done = True
+        if ans is ParseFailure or ans.pos != len(self.source):
+            raise _parse_error(self.interpreter, self.source, ans)
+        self.value = _resolve(ans.value) if self.deferred else ans.value
+        raise StopIteration(self.value)
+
+    def throw(self, type, value=None, traceback=None):
+        # The event loop uses this to cancel the task, or to report a failed
+        # read.
+        if self.pending is None:
+            raise type, value, traceback
+        try:
+            return self.pending.throw(type, value, traceback)
+        except StopIteration as e:
+            self.pending = None
+            self._receive(e.args[0] if e.args else None)
+            return self.send(None)
+
+    def close(self):
+        if self.pending is not None and hasattr(self.pending, 'close'):
+            self.pending.close()
+        self.pending = None
+        self.done = True
+
+    def _receive(self, chunk):
+        # An empty chunk means that the stream is over.
+        if chunk:
+            self.chunks.append(chunk)
+        else:
+            self.reader = None
+            self.source = ''.join(self.chunks)
+            self.chunks = None
+
+    def _start(self):
+        is_text, source = _text_source(self.source)
+        parser = compile(self.expression, is_text, self.deferred,
+            cache=self.cache)
+        self.interpreter = _Interpreter(source, self.memo)
+        self.pause = _Pause(self.interpreter._start(parser, 0), 0)
+
+
+def _await_iterator(awaitable):
+    # Returns the iterator that "await" (or "yield from") would run.
+    if hasattr(awaitable, '__await__'):
+        return awaitable.__await__()
+    return iter(awaitable)
+
+
+def _send(iterator, value):
+    if value is None or not hasattr(iterator, 'send'):
+        return next(iterator)
+    return iterator.send(value)
+
+
+class IncrementalParser(object):
+    # Parses a document, and then parses it again after each edit. Only the
+    # memo entries that looked at the edited part of the document have to be
+    # computed again. (Every other entry is kept, and moved over if it comes
+    # after the edit.)
+    #
+    # When the parser can't tell how far a regular expression looked ahead,
+    # it assumes that it looked at the rest of the document.
+
+    def __init__(self, expression, source):
+        # Merged regexes may look far past the start of a failed match, so
+        # keep the terminals apart.
+        is_text = _text_source(source)[0]
+        self.parser = compile(expression, is_text, fuse=False)
         self.source = source
         self.memo = {}
+        # How far before its position a parse may look, like "\b" does.
+        self.behind = 0
+        self.value = self._parse()
+
+    def edit(self, offset, removed, inserted):
+        # Replaces the "removed" items at "offset" with the "inserted" ones,
+        # and returns the new value.
+        end = offset + removed
+        delta = len(inserted) - removed
+        memo = {}
+        for key, entry in self.memo.iteritems():
+            if entry.__class__ is _Seed:
+                continue
+            parser, pos = key
+            if pos + entry[2] <= offset:
+                memo[key] = entry
+            elif pos >= end + self.behind and pos > offset:
+                # The entry only looked at the input after the edit. (When
+                # text is inserted at its position, we drop it, in case it
+                # depends on where it is, like the Start expression does.)
+                memo[parser, pos + delta] = entry
+        self.memo = memo
+        head, tail = self.source[:offset], self.source[end:]
+        if isinstance(head, memoryview):
+            head, tail = head.tobytes(), tail.tobytes()
+        self.source = head + inserted + tail
+        self.value = self._parse()
+        return self.value
+
+    def _parse(self):
+        source = _text_source(self.source)[1]
+        interpreter = _IncrementalInterpreter(source, self.memo)
+        ans = interpreter.run(self.parser)
+        self.memo = interpreter.memo
+        self.behind = max(self.behind, interpreter.behind)
+        if ans is ParseFailure or ans.pos != len(source):
+            # The entries that we kept don't say where their parsers failed,
+            # so parse the document again from scratch to find out.
+            interpreter = _IncrementalInterpreter(source, {})
+            ans = interpreter.run(self.parser)
+            raise _parse_error(interpreter, source, ans)
+        return ans.value
+
+
+def _text_source(source):
+    # Returns a pair: whether to parse the source as text, and the source to
+    # give to the parser. Strings, buffers and mmap objects work as they are.
+    # A bytearray gets wrapped in a buffer, which reads the same memory but
+    # returns strings instead of ints. Python 2's "re" module can't read a
+    # memoryview (and neither can the buffer function), so a memoryview gets
+    # wrapped in a buffer of a ctypes array over its memory.
+    if isinstance(source, (basestring, buffer, mmap.mmap)):
+        return True, source
+    if isinstance(source, bytearray):
+        return True, buffer(source)
+    if isinstance(source, memoryview):
+        return True, _view_buffer(source)
+    return False, source
+
+
+class _PyBuffer(ctypes.Structure):
+    # The Py_buffer struct of the C API.
+    _fields_ = [
+        ('buf', ctypes.c_void_p),
+        ('obj', ctypes.c_void_p),
+        ('len', ctypes.c_ssize_t),
+        ('itemsize', ctypes.c_ssize_t),
+        ('readonly', ctypes.c_int),
+        ('ndim', ctypes.c_int),
+        ('format', ctypes.c_char_p),
+        ('shape', ctypes.c_void_p),
+        ('strides', ctypes.c_void_p),
+        ('suboffsets', ctypes.c_void_p),
+        ('smalltable', ctypes.c_ssize_t * 2),
+        ('internal', ctypes.c_void_p),
+    ]
+
+
+def _view_buffer(view):
+    # Returns a buffer that reads the memory of a memoryview, without copying
+    # it. The ctypes array under the buffer keeps the memoryview alive. When
+    # the memory isn't contiguous, or the interpreter doesn't have the C API,
+    # we copy the memory into a string after all.
+    try:
+        api = ctypes.pythonapi
+        get_buffer, release = api.PyObject_GetBuffer, api.PyBuffer_Release
+    except (AttributeError, ValueError):
+        return view.tobytes()
+    info = _PyBuffer()
+    get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_PyBuffer),
+        ctypes.c_int]
+    release.argtypes = [ctypes.POINTER(_PyBuffer)]
+    try:
+        get_buffer(view, ctypes.byref(info), 0)
+    except BufferError:
+        return view.tobytes()
+    try:
+        array = (ctypes.c_char * info.len).from_address(info.buf)
+    finally:
+        release(ctypes.byref(info))
+    array.view = view
+    return buffer(array)
+
+
+def _run(parser, source, pos, backend, memo=None, cache=None, budget=None):
+    if backend == 'codegen':
+        if memo is not None:
+            raise ValueError('Only the interpreter accepts a memo table.')
+        if budget is not None:
+            raise ValueError('Only the interpreter accepts a budget.')
+        return generate(parser, cache).run(source, pos)
+    if backend == 'interpreter':
+        return _Interpreter(source, memo, budget).run(parser, pos)
+    raise ValueError('unknown backend: %r' % (backend,))
+
+
+class _Interpreter(object):
+    def __init__(self, source, memo=None, budget=None):
+        self.source = source
+        self.memo = {} if memo is None else memo
+        self.budget = budget
         self.stack = []
+        # Maps the memo key of each left-recursive parser that is growing its
+        # result to its seed.
+        self.heads = {}
+        # The position of the last Commit. The parse fails if it has to
+        # backtrack before this position.
+        self.cut = 0
+        self.next_purge = 1024
+        # The farthest position where a parser failed, and the set of the
+        # parsers that failed there.
+        self.farthest = 0
+        self.failures = set()
+        if hasattr(self.memo, 'attach'):
+            self.memo.attach(self)
 
-    def run(self, parser):
-        ans = self._start(parser, 0)
+    def reset(self, source):
+        # Gets the interpreter ready to parse another input.
+        self.source = source
+        self.memo.clear()
+        self.heads.clear()
+        del self.stack[:]
+        self.cut = 0
+        self.next_purge = 1024
+        self.farthest = 0
+        self.failures = set()
+
+    def run(self, parser, pos=0):
+        pause = _Pause(self._start(parser, pos), pos)
+        if self.budget is not None:
+            return self.budget.run(self, pause)
+        return self.resume(pause)
+
+    def resume(self, pause, steps=None):
+        # Carries on with a parse from a _Pause, and returns the answer. With
+        # "steps", returns a new _Pause instead if the parse isn't over after
+        # that many steps.
+        ans, pos = pause
         while self.stack:
+            if steps is not None:
+                if not steps:
+                    return _Pause(ans, pos)
+                steps -= 1
             top = self.stack[-1][-1]
             ans = top.send(ans)
             if isinstance(ans, ParseStep):
-                ans = self._start(ans.parser, ans.pos)
+                pos = ans.pos
+                ans = self._start(ans.parser, pos)
             else:
-                key = self.stack.pop()[0]
-                self.memo[key] = ans
-        if ans is ParseFailure:
-            raise ParseError()
-        else:
-            return ans
+                frame = self.stack.pop()
+                pos, key = frame[1], frame[2]
+                if ans.__class__ is not ParseResult:
+                    if ans is ParseFailure:
+                        if pos >= self.farthest:
+                            self._fail(frame[0], pos)
+                    else:
+                        # A scan stopped where its terminal failed.
+                        if ans.pos >= self.farthest:
+                            self._fail(frame[0], ans.pos)
+                        ans = ParseResult(ans.value, ans.pos)
+                if key is not None:
+                    if key in self.heads:
+                        ans = self._grow(frame, ans)
+                        if ans is None:
+                            continue
+                    self.memo[key] = ans
+            # We can't backtrack past a Commit, so the whole parse fails.
+            # (Except while a left-recursive parser is growing, since it
+            # always stops growing with a failure.)
+            if ans is ParseFailure and pos < self.cut and not self.heads:
+                del self.stack[:]
+        return ans
 
     def _start(self, parser, pos):
-        key = (parser, pos)
-        if key in self.memo:
-            return self.memo[key]
-        self.memo[key] = ParseFailure
+        if parser is _commit_parser:
+            self._commit(pos)
+            return ParseResult(None, pos)
+        # The compiler decides which parsers are worth memoizing. (Parsers
+        # that don't say otherwise are always memoized.)
+        if getattr(parser, 'memoize', True):
+            key = (parser, pos)
+            if key in self.memo:
+                ans = self.memo[key]
+                if ans.__class__ is _Seed:
+                    return self._recurse(key, ans)
+                return ans
+            self.memo[key] = _Seed()
+        else:
+            key = None
         generator = parser(self.source, pos)
-        self.stack.append((key, generator))
+        self.stack.append((parser, pos, key, generator))
+        return None
+
+    def _fail(self, parser, pos):
+        if pos > self.farthest:
+            self.farthest = pos
+            self.failures = set()
+        self.failures.add(parser)
+
+    def farthest_failure(self):
+        # Returns the farthest position where a parser failed, and a set with
+        # descriptions of the terminals that the parse expected there. (Only
+        # the terminals say what they expected. But an Or that dispatches on
+        # the next item never runs the alternatives that can't start with it,
+        # so we describe those from their FIRST sets.)
+        pos, expected = self._expectations()
+        return pos, _report(expected)
+
+    def _expectations(self):
+        # Like farthest_failure, but returns the pairs of _describe.
+        best, ans = self.farthest, set()
+        for parser in self.failures:
+            pos, expected = _expected(parser, self.source, self.farthest)
+            if pos > best:
+                best, ans = pos, set()
+            if pos == best:
+                ans |= expected
+        return best, ans
+
+    def _recurse(self, key, seed):
+        # The parser called itself at the same position. Make it a head, so
+        # that it grows its result when it's done. Until then, the recursive
+        # call gets the seed.
+        if seed.involved is None:
+            seed.involved = set()
+            self.heads[key] = seed
+        # The parsers between the head and the recursive call depend on the
+        # seed, so we have to forget their results whenever the seed grows.
+        for frame in reversed(self.stack):
+            if frame[2] == key:
+                break
+            if frame[2] is not None:
+                seed.involved.add(frame[2])
+        return seed.value
+
+    def _grow(self, frame, ans):
+        # Returns the final result of a head, or None if the head started
+        # over with a bigger seed.
+        parser, pos, key, _ = frame
+        seed = self.heads[key]
+        for involved in seed.involved:
+            if involved in self.memo:
+                del self.memo[involved]
+        best = seed.value
+        if ans is not ParseFailure and (
+                best is ParseFailure or ans.pos > best.pos):
+            seed.value = ans
+            self.stack.append((parser, pos, key, parser(self.source, pos)))
+            return None
+        del self.heads[key]
+        return best
+
+    def _commit(self, pos):
+        if pos <= self.cut:
+            return
+        # A lookahead always goes back to where it started, so a Commit
+        # inside of one doesn't mean anything.
+        lookahead = (_ExpectParser, _NotParser)
+        if any(isinstance(frame[0], lookahead) for frame in self.stack):
+            return
+        self.cut = pos
+        # Throw away the memo entries before the cut, except for the ones of
+        # the parsers that are still running. (A memo table like WindowedMemo
+        # uses the cut position when it sweeps, so we leave it alone.) We wait
+        # for the table to double between purges, so that purging takes
+        # constant amortized time per entry.
+        if type(self.memo) is dict and len(self.memo) >= self.next_purge:
+            active = set(frame[2] for frame in self.stack)
+            self.memo = dict((k, v) for k, v in self.memo.iteritems()
+                if k[1] >= pos or k in active)
+            self.next_purge = max(2 * len(self.memo), 1024)
+
+    def _frontier(self):
+        # Returns the committed position and the set of memo keys for the
+        # parsers that are still running. The committed position is the lowest
+        # position that the parse may have to revisit. (Except for Backtrack
+        # expressions, which can move back anywhere.)
+        active = set(frame[2] for frame in self.stack if frame[2] is not None)
+        if not self.stack:
+            return self.cut, active
+        # Walk down the stack. For each frame, work out whether the frame's
+        # parser may still fail, given the child that it's running, and where
+        # the frame would resume parsing if its child failed.
+        child, child_pos = self.stack[-1][:2]
+        committed = child_pos
+        may_fail = not getattr(child, 'always_succeeds', False)
+        for frame in reversed(self.stack[:-1]):
+            parser, pos = frame[:2]
+            if isinstance(parser, (_ExpectParser, _NotParser)):
+                committed = min(committed, pos)
+            elif may_fail and isinstance(parser, _OrParser):
+                committed = min(committed, pos)
+            elif may_fail and isinstance(parser, _ListParser):
+                committed = min(committed, child_pos)
+            may_fail = _may_still_fail(parser, child, may_fail)
+            child, child_pos = parser, pos
+        # The parse fails instead of backtracking past a Commit.
+        return max(committed, self.cut), active
+
+
+class _ProfilingInterpreter(_Interpreter):
+    # An interpreter that counts the calls, memo hits and misses, and
+    # failures of each parser, and times it. It wraps the generator of each
+    # parser, so that it can time each step. The time within the steps of a
+    # parser is its exclusive time. The time from its first step to its last
+    # one is its inclusive time, which we only count for the outermost call of
+    # a recursive parser. When the parse is over, it adds the records to the
+    # profile.
+
+    def __init__(self, source, memo, budget, profile, labels):
+        _Interpreter.__init__(self, source, memo, budget)
+        self.profile = profile
+        self.labels = labels
+        # Maps each parser to a list: the calls, memo hits, memo misses,
+        # failures, inclusive time, exclusive time, and the number of calls
+        # that are running.
+        self.records = {}
+
+    def run(self, parser, pos=0):
+        try:
+            return _Interpreter.run(self, parser, pos)
+        finally:
+            for parser, record in self.records.iteritems():
+                names = self.labels.get(parser)
+                self.profile.add(parser, names, record)
+            self.records = {}
+
+    def _start(self, parser, pos):
+        record = self.records.get(parser)
+        if record is None:
+            record = self.records[parser] = [0, 0, 0, 0, 0.0, 0.0, 0]
+        record[0] += 1
+        if parser is not _commit_parser and getattr(parser, 'memoize', True):
+            record[1 if (parser, pos) in self.memo else 2] += 1
+        depth = len(self.stack)
+        ans = _Interpreter._start(self, parser, pos)
+        if len(self.stack) > depth:
+            self._wrap(record)
+        elif ans is ParseFailure:
+            record[3] += 1
+        return ans
+
+    def _grow(self, frame, ans):
+        # A left-recursive parser that starts over gets a new generator.
+        ans = _Interpreter._grow(self, frame, ans)
+        if ans is None:
+            self._wrap(self.records[frame[0]])
+        return ans
+
+    def _wrap(self, record):
+        parser, pos, key, generator = self.stack[-1]
+        self.stack[-1] = (parser, pos, key, _timed(generator, record))
+
+
+def _timed(generator, record):
+    clock = time.time
+    record[6] += 1
+    start = clock()
+    own = 0.0
+    ans = None
+    while True:
+        before = clock()
+        step = generator.send(ans)
+        own += clock() - before
+        if not isinstance(step, ParseStep):
+            break
+        ans = yield step
+    record[6] -= 1
+    if not record[6]:
+        record[4] += clock() - start
+    record[5] += own
+    if step is ParseFailure:
+        record[3] += 1
+    yield step
+
+
+class _TracingInterpreter(_Interpreter):
+    # An interpreter that calls the "enter", "exit" and "memo_hit" methods of
+    # a hook, like a ParseTrace. It wraps the generator of each parser, so
+    # that it can tell when the parser stops. A left-recursive parser that
+    # grows its result exits and enters again for each attempt.
+
+    def __init__(self, source, memo, budget, hook, labels):
+        _Interpreter.__init__(self, source, memo, budget)
+        self.hook = hook
+        self.labels = labels
+        if hasattr(hook, 'attach'):
+            hook.attach(self)
+
+    def rule(self, parser):
+        # Returns the name of the rule of a parser. (See ParseProfile.)
+        return _rule(parser, self.labels.get(parser))
+
+    def _start(self, parser, pos):
+        depth = len(self.stack)
+        ans = _Interpreter._start(self, parser, pos)
+        if len(self.stack) > depth:
+            self._wrap()
+        elif parser is not _commit_parser:
+            self.hook.memo_hit(parser, pos, ans)
+        return ans
+
+    def _grow(self, frame, ans):
+        ans = _Interpreter._grow(self, frame, ans)
+        if ans is None:
+            self._wrap()
+        return ans
+
+    def _wrap(self):
+        parser, pos, key, generator = self.stack[-1]
+        self.hook.enter(parser, pos)
+        self.stack[-1] = (parser, pos, key,
+            _traced(generator, self.hook, parser, pos))
+
+
+def _traced(generator, hook, parser, pos):
+    ans = None
+    while True:
+        step = generator.send(ans)
+        if not isinstance(step, ParseStep):
+            break
+        ans = yield step
+    hook.exit(parser, pos, step)
+    yield step
+
+
+# The state of a parse that an interpreter stopped. The "ans" field is the
+# value to send to the parser on the top of the stack (or None if it's just
+# starting), and "pos" is the position of the last step.
+_Pause = namedtuple('_Pause', 'ans, pos')
+
+
+class _IncrementalInterpreter(_Interpreter):
+    # An interpreter that records how far each memo entry looked at the input.
+    # Its memo table maps each key to a triple: the value (or ParseFailure),
+    # the length of the result, and the length of the examined part of the
+    # input. The lengths are relative to the entry's position, so that an edit
+    # only has to move the keys. It memoizes every parser except the leaves,
+    # so that an IncrementalParser can reuse as much as possible.
+
+    def __init__(self, source, memo):
+        _Interpreter.__init__(self, source, memo)
+        self.reach = []
+        # The end of the part of the input that the whole parse looked at.
+        self.extent = 0
+        # How far before their positions the leaves looked.
+        self.behind = 0
+        self.leaves = {}
+        # Keep the whole memo table for the next edit, even after a Commit.
+        self.next_purge = float('inf')
+
+    def run(self, parser, pos=0):
+        ans = self._start(parser, pos)
+        while self.stack:
+            top = self.stack[-1][-1]
+            ans = top.send(ans)
+            if isinstance(ans, ParseStep):
+                pos = ans.pos
+                ans = self._start(ans.parser, pos)
+            else:
+                frame = self.stack.pop()
+                parser, pos, key = frame[:3]
+                reach = max(self.reach.pop(), _examined(parser, self.source, pos, ans))
+                if ans is ParseFailure and pos >= self.farthest:
+                    self._fail(parser, pos)
+                if key is not None:
+                    if key in self.heads:
+                        ans = self._grow(frame, ans)
+                        if ans is None:
+                            # The head started over. It keeps the extent of
+                            # its earlier passes.
+                            self.reach.append(reach)
+                            continue
+                    if ans is ParseFailure:
+                        entry = (ans, 0, reach - pos)
+                    else:
+                        entry = (ans.value, ans.pos - pos, reach - pos)
+                    self.memo[key] = entry
+                self._reached(reach)
+            if ans is ParseFailure and pos < self.cut and not self.heads:
+                del self.stack[:]
+        return ans
+
+    def _start(self, parser, pos):
+        if parser is _commit_parser:
+            self._commit(pos)
+            return ParseResult(None, pos)
+        is_leaf = self.leaves.get(parser)
+        if is_leaf is None:
+            is_leaf = self.leaves[parser] = not _child_parsers(parser)
+            if is_leaf:
+                self.behind = max(self.behind, _looks_behind(parser))
+        if is_leaf:
+            key = None
+        else:
+            key = (parser, pos)
+            if key in self.memo:
+                entry = self.memo[key]
+                if entry.__class__ is _Seed:
+                    ans = self._recurse(key, entry)
+                    reach = _examined(parser, self.source, pos, ans)
+                else:
+                    value, length, reach = entry
+                    reach += pos
+                    ans = value
+                    if value is not ParseFailure:
+                        ans = ParseResult(value, pos + length)
+                self._reached(reach)
+                return ans
+            self.memo[key] = _Seed()
+        self.stack.append((parser, pos, key, parser(self.source, pos)))
+        self.reach.append(pos)
         return None
+
+    def _reached(self, reach):
+        # Adds the extent of a parser to the parser that called it.
+        if self.reach:
+            self.reach[-1] = max(self.reach[-1], reach)
+        else:
+            self.extent = max(self.extent, reach)
+
+
+def _examined(parser, source, pos, ans):
+    # Returns the end of the part of the input that a parser looked at, not
+    # counting its children. Most parsers look at one item past the end of
+    # their result, or past their start if they fail.
+    end = (pos if ans is ParseFailure else max(pos, ans.pos)) + 1
+    factory = getattr(parser, 'factory', None)
+    if factory is _text_prefix_eq:
+        end = max(end, pos + len(parser.arg))
+    elif factory is _literal_choice_parser and parser.arg.is_text:
+        # A choice looks up a slice for each length of its strings.
+        end = max(end, pos + parser.arg.longest)
+    elif factory is _regex_text_parser:
+        end = max(end, _regex_reach(parser.arg).examined(source, pos, ans))
+    return end
+
+
+def _looks_behind(parser):
+    # Returns how far before its position a leaf may look at the input.
+    factory = getattr(parser, 'factory', None)
+    if factory is _regex_text_parser:
+        return _regex_reach(parser.arg).behind
+    if factory is _backtrack_parser:
+        # The parsers after it run before its position.
+        return float('inf')
+    return 1 if parser is _start_parser else 0
+
+
+class _Seed(object):
+    # The memo entry of a parser that is still running. If the parser calls
+    # itself at the same position, the call gets the seed's value, which
+    # starts out as a failure. (See Warth et al., "Packrat Parsers Can Support
+    # Left Recursion".)
+    __slots__ = ('value', 'involved')
+
+    def __init__(self):
+        self.value = ParseFailure
+        self.involved = None
+
+
+def _expected(parser, source, pos):
+    # Returns the position where a parser that failed at "pos" expected
+    # something, and the set of descriptions of the things that it expected.
+    factory = getattr(parser, 'factory', None)
+    if factory is _fused_text_parser:
+        # A fused regex fails at its start, even if most of it matched. Run
+        # its terminals on their own to find the part that failed.
+        node = getattr(parser.arg, 'node', None)
+        if node is not None:
+            interpreter = _Interpreter(source)
+            interpreter.run(compile(node, fuse=False), pos)
+            if interpreter.failures:
+                return interpreter._expectations()
+    if factory is _scan_parser:
+        # A scan stops where its terminal fails.
+        element = _fused_text_parser(parser.arg.fusion)
+        return _expected(element, source, pos)
+    if isinstance(parser, _OrParser) and parser.dispatch is not None:
+        dispatch = parser.dispatch
+        tried = dispatch.indexes(dispatch.key(source, pos))
+        ans = set()
+        for index, child in enumerate(parser.parsers):
+            if index not in tried:
+                ans |= _describe_start(child)
+        return pos, ans
+    return pos, _describe(parser)
+
+
+def _describe(parser):
+    # Returns a set of descriptions of what a terminal matches. (Or an empty
+    # set for the other parsers.) Each description is a pair: the text, and
+    # the texts of the terminal's FIRST set, which the text covers. (See
+    # _report.)
+    factory = getattr(parser, 'factory', None)
+    arg = getattr(parser, 'arg', None)
+    if factory in (_text_prefix_eq, _token_content_eq, _literal_parser):
+        texts = [repr(arg)]
+    elif factory in (_regex_text_parser, _regex_token_parser):
+        texts = [arg.pattern]
+    elif factory is _literal_choice_parser:
+        texts = [repr(i) for i in arg.strings]
+    elif factory is _token_instance_parser:
+        texts = [arg.__name__]
+    elif parser is _end_parser:
+        texts = ['end of input']
+    elif parser is _any_parser:
+        texts = ['any item']
+    elif factory is None:
+        return set()
+    else:
+        return _describe_first(getattr(parser, 'first', None))
+    covers = frozenset(_first_texts(getattr(parser, 'first', None)))
+    return set((i, covers) for i in texts)
+
+
+def _describe_start(parser, depth=0):
+    # Describes what may start a match of a parser. Look for the terminal
+    # that comes first, as long as it has the same FIRST set as the parser.
+    # Otherwise, describe the FIRST set.
+    ans = _describe(parser)
+    if ans:
+        return ans
+    first = getattr(parser, 'first', None)
+    children = _child_parsers(parser)
+    if children and depth < 8:
+        if isinstance(parser, _OrParser):
+            parts = [_describe_start(i, depth + 1) for i in children]
+            if all(parts):
+                return set().union(*parts)
+        elif getattr(children[0], 'first', None) == first:
+            return _describe_start(children[0], depth + 1)
+    return _describe_first(first)
+
+
+def _describe_first(first):
+    return set((i, frozenset()) for i in _first_texts(first))
+
+
+def _first_texts(first):
+    ans = set()
+    for kind, arg in first or ():
+        if kind == 'regex':
+            ans.add(arg.pattern)
+        elif kind == 'class':
+            ans.add(arg.__name__)
+        else:
+            ans.add(repr(arg))
+    return ans
+
+
+def _report(expected):
+    # Returns the texts of a set of descriptions. A FIRST set may describe a
+    # terminal that the set already has, like "[\d]" for "\d+". So leave out
+    # the texts of FIRST sets that a terminal covers.
+    covered = set()
+    for text, covers in expected:
+        covered |= covers
+    return set(text for text, covers in expected
+        if covers or text not in covered)
+
+
+def _may_still_fail(parser, child, child_may_fail):
+    # Decides whether a running parser may still fail, given the child that
+    # it's running and whether that child may fail.
+    succeeds = lambda parsers: any(i.always_succeeds for i in parsers)
+    fails = lambda parsers: not all(i.always_succeeds for i in parsers)
+    if isinstance(parser, _ListParser):
+        return False
+    if isinstance(parser, _OrParser):
+        rest = parser.parsers[parser.parsers.index(child) + 1:]
+        return child_may_fail and not succeeds(rest)
+    if isinstance(parser, _SequenceParser):
+        rest = parser.parsers[parser.parsers.index(child) + 1:]
+        return child_may_fail or fails(rest)
+    if isinstance(parser, (_LeftParser, _RightParser)):
+        if child is parser.left_parser:
+            return child_may_fail or fails([parser.right_parser])
+        return child_may_fail
+    if isinstance(parser, (_ExpectParser, _TokenParser, _TransformParser)):
+        return child_may_fail
+    return True
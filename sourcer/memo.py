@@ -0,0 +1,182 @@
+import heapq
+import threading
+from collections import OrderedDict
+
+
+class WindowedMemo(object):
+    '''
+    A memo table for parsing very large inputs. It groups its entries by
+    position and throws away the ones that the parser won't need again, so
+    that memory use stays flat instead of growing with the input.
+
+    ``window`` is the number of positions to keep behind the committed
+    position. (The committed position is the lowest position that the parser
+    may still have to revisit. The parser can't backtrack past it, except with
+    a Backtrack expression.) Entries behind the window are evicted. Use
+    ``window=None`` to turn this off.
+
+    ``max_size`` is a budget for the number of entries. When the table grows
+    past it, the least recently used positions are evicted. Use
+    ``max_size=None`` for no budget.
+
+    Evicting an entry never changes the result of a parse. At worst, the
+    parser has to do the work again. The ``evictions`` attribute counts the
+    evicted entries.
+
+    Example::
+
+        from sourcer import *
+        Word = Memo(Pattern(r'\\w+'))
+        Line = Or((Word, '=', Word), Word) << '\\n'
+        memo = WindowedMemo(window=16)
+        ans = parse(List(Line), 'x=y\\nz\\n' * 5000, memo=memo)
+        assert len(ans) == 10000
+        assert memo.evictions > 0 and len(memo) < 2000
+    '''
+    def __init__(self, window=0, max_size=None, min_sweep=1024):
+        self.window = window
+        self.max_size = max_size
+        self.min_sweep = min_sweep
+        self.rows = OrderedDict()
+        self.positions = []
+        self.size = 0
+        self.evictions = 0
+        self.next_sweep = min_sweep
+        self.interpreter = None
+
+    def attach(self, interpreter):
+        if self.interpreter is not None:
+            raise ValueError('This memo table is already in use.')
+        self.interpreter = interpreter
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        row = self.rows.get(key[1])
+        return row is not None and key[0] in row
+
+    def __getitem__(self, key):
+        pos = key[1]
+        row = self.rows[pos]
+        if self.max_size is not None:
+            # Move the row to the end, to keep the rows in LRU order.
+            del self.rows[pos]
+            self.rows[pos] = row
+        return row[key[0]]
+
+    def __setitem__(self, key, value):
+        parser, pos = key
+        row = self.rows.get(pos)
+        if row is None:
+            row = self.rows[pos] = {}
+            heapq.heappush(self.positions, pos)
+        if parser not in row:
+            self.size += 1
+        row[parser] = value
+        if self.size >= self.next_sweep:
+            self.sweep()
+
+    def __delitem__(self, key):
+        parser, pos = key
+        row = self.rows[pos]
+        del row[parser]
+        self.size -= 1
+        if not row:
+            del self.rows[pos]
+
+    def sweep(self):
+        if self.interpreter is None:
+            return
+        # Keep the entries of the parsers that are still running. (Their
+        # entries keep left-recursive rules from looping forever.)
+        committed, active = self.interpreter._frontier()
+        if self.window is not None:
+            limit = committed - self.window
+            while self.positions and self.positions[0] < limit:
+                pos = heapq.heappop(self.positions)
+                self._evict_row(pos, active)
+        if self.max_size is not None and self.size > self.max_size:
+            # Evict down to three quarters of the budget, so that we don't
+            # have to sweep again right away.
+            target = self.max_size * 3 // 4
+            for pos in list(self.rows):
+                if self.size <= target:
+                    break
+                self._evict_row(pos, active)
+        # Sweep again when the table doubles (or outgrows its budget), so that
+        # sweeping takes constant amortized time per entry.
+        self.next_sweep = max(self.size * 2, self.min_sweep)
+        if self.max_size is not None and self.size <= self.max_size:
+            self.next_sweep = min(self.next_sweep, self.max_size + 1)
+
+    def _evict_row(self, pos, active):
+        row = self.rows.pop(pos, None)
+        if row is None:
+            return
+        kept = dict((k, v) for k, v in row.iteritems() if (k, pos) in active)
+        if kept:
+            self.rows[pos] = kept
+        self.evictions += len(row) - len(kept)
+        self.size -= len(row) - len(kept)
+
+
+class BindCache(object):
+    '''
+    Holds the parsers that a grammar's Bind expressions compile while it
+    parses. Each distinct value that a Bind expression passes to its function
+    produces a new expression, which the grammar compiles once and keeps
+    here. A bound parser reuses the parsers of the rest of the grammar, and
+    only the parts that are new to it live in the cache.
+
+    ``max_size`` is the number of parsers to keep. When the cache is full,
+    the least recently used parser is evicted. (If the grammar needs it
+    again, it just compiles it again.) Use ``max_size=None`` for no limit.
+
+    The cache is safe to share between threads. The ``hits``, ``misses`` and
+    ``evictions`` attributes count the lookups and evictions.
+
+    Example::
+
+        from sourcer import *
+        Int = Pattern(r'\\d+') * int
+        Run = Bind(Int, lambda count: 'z' * count)
+        cache = BindCache(max_size=2)
+        parser = Parser(List(Run), bind_cache=cache)
+        ans = parser.parse('1z2zz3zzz1z')
+        assert ans == ['z', 'zz', 'zzz', 'z']
+        assert (cache.hits, cache.misses, cache.evictions) == (0, 4, 2)
+        assert len(cache) == 2
+    '''
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, build):
+        # Returns the parser for the key, and calls "build" to make it if the
+        # cache doesn't have it. The lock is reentrant, since building a
+        # parser may run code that binds other values.
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                ans = self.entries.pop(key)
+                self.entries[key] = ans
+                return ans
+            self.misses += 1
+            ans = self.entries[key] = build()
+            while self.max_size is not None and (
+                    len(self.entries) > self.max_size):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return ans
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
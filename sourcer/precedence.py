@@ -13,6 +13,9 @@ pack_tuple = (lambda *args: args)
 
 
 def ReduceLeft(left, op, right, transform=pack_tuple):
+    # Use a List rather than a left-recursive rule. A left-recursive rule
+    # would make the interpreter grow a seed at every level of an operator
+    # precedence table, which costs more than building the list.
     expr = (left, List((op, right)))
     assoc = lambda first, rest: transform(first, *rest)
     xform = lambda pair: reduce(assoc, pair[1], pair[0])
@@ -27,7 +30,7 @@ def ReduceRight(left, op, right, transform=pack_tuple):
 
 
 def operator_row(operators, has_left=True, has_right=True, method=ReduceLeft):
-    middle = reduce(Or, operators)
+    middle = AnyOf(*operators)
     def build(Operand):
         left = Operand if has_left else None
         right = Operand if has_right else None
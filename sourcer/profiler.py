@@ -0,0 +1,254 @@
+import inspect
+import json
+import time
+from collections import namedtuple
+from .expressions import ForwardRef, ParsingOperand
+
+
+# The totals of one rule of a grammar: the number of times that the
+# interpreter started its parser, the number of memo hits and misses, the
+# number of failures, and the time in seconds that the parser took, with and
+# without the parsers that it called.
+RuleStats = namedtuple('RuleStats',
+    'rule, calls, memo_hits, memo_misses, failures, inclusive, exclusive')
+
+
+class ParseProfile(object):
+    '''
+    Counts the work that the interpreter does for each rule of a grammar.
+    Pass it to ``parse`` (or ``parse_prefix``) as the ``profile`` argument.
+    A profile adds up the totals of every parse that it's given.
+
+    Each rule is named after the expression that its parser came from. A
+    Struct or Token class gets the name of the class. Other expressions get
+    their repr, and parsers that the compiler made on its own get the name of
+    their type.
+
+    ``rows`` returns a list of RuleStats tuples, and ``report`` returns the
+    same totals as a table. Both accept the name of a field to sort by.
+    ``pstats.Stats(profile)`` also works, with rules in place of functions.
+
+    Profiling makes the parse several times slower, and it compiles the
+    grammar again for each parse. Only the interpreter backend accepts a
+    profile.
+
+    Example::
+
+        from sourcer import *
+
+        class Pair(Struct):
+            def parse(self):
+                self.left = Pattern(r'\\d+') * int
+                self.right = ',' >> Pattern(r'\\d+') * int
+
+        profile = ParseProfile()
+        parse(List(Pair << ';'), '1,2;3,4;', profile=profile)
+        rows = dict((i.rule, i) for i in profile.rows())
+        assert rows['Pair'].calls == 3 and rows['Pair'].failures == 1
+        assert 'Pair' in profile.report(sort='calls')
+    '''
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, parser, names, record):
+        # Adds the counts of a parser to the totals of its rule. The "names"
+        # argument is the list of expressions that the parser came from, and
+        # "record" is a list of counts, in the order of RuleStats.
+        rule = _rule(parser, names)
+        total = self.totals.get(rule)
+        if total is None:
+            total = self.totals[rule] = [0, 0, 0, 0, 0.0, 0.0]
+        for index, value in enumerate(record[:6]):
+            total[index] += value
+
+    def rows(self, sort='inclusive'):
+        # Returns a RuleStats tuple for each rule. The rules are sorted by the
+        # given field, with the largest values first. (Or in alphabetical
+        # order, for the "rule" field.)
+        if sort not in RuleStats._fields:
+            raise ValueError('unknown field: %r' % (sort,))
+        ans = [RuleStats(rule, *total) for rule, total in
+            sorted(self.totals.iteritems())]
+        if sort != 'rule':
+            ans.sort(key=lambda i: getattr(i, sort), reverse=True)
+        return ans
+
+    def report(self, sort='inclusive', limit=None):
+        rows = self.rows(sort)[:limit]
+        lines = ['%8s %8s %8s %8s %10s %10s  %s' % ('calls', 'hits',
+            'misses', 'failures', 'inclusive', 'exclusive', 'rule')]
+        for row in rows:
+            lines.append('%8d %8d %8d %8d %10.6f %10.6f  %s' % (row[1:] +
+                (row.rule,)))
+        return '\n'.join(lines)
+
+    def create_stats(self):
+        # Fills in the "stats" attribute that pstats.Stats reads. Each rule
+        # looks like a function in a file called "<grammar>".
+        self.stats = {}
+        for row in self.rows('rule'):
+            key = ('<grammar>', 0, row.rule)
+            self.stats[key] = (row.calls, row.calls, row.exclusive,
+                row.inclusive, {})
+
+
+# A TraceEvent has a kind ("enter", "exit" or "memo_hit"), the name of the
+# rule, the position where the parser started, the time in seconds, and the
+# position where the parser stopped (or None if it failed, or if it's still
+# entering).
+TraceEvent = namedtuple('TraceEvent', 'kind, rule, pos, time, end')
+
+
+class ParseTrace(object):
+    '''
+    Records the events of a parse: each time that the interpreter starts a
+    parser, each time that a parser stops, and each time that the memo table
+    already has the answer. Pass it to ``parse`` (or ``parse_prefix``) as the
+    ``trace`` argument. The ``events`` list gets a TraceEvent for each one.
+
+    The interpreter calls the ``enter``, ``exit`` and ``memo_hit`` methods.
+    Any object with these methods works as a trace. If it has an ``attach``
+    method too, the interpreter calls it first, with itself as the argument.
+    The interpreter's ``rule`` method returns the name of a parser's rule.
+    (See ParseProfile.) Without a trace, the interpreter doesn't check for
+    one, so tracing costs nothing until you ask for it.
+
+    ``chrome_trace`` returns the events in the JSON format of Chrome's
+    trace viewer (and Perfetto). ``collapsed`` returns collapsed stacks for
+    flamegraph tools, like flamegraph.pl and speedscope, weighted by the
+    exclusive time of each stack in microseconds. Parsers that were still
+    running when a parse stopped (because of a Commit or a ParseBudget)
+    count as stopping at the last event.
+
+    Example::
+
+        import json
+        from sourcer import *
+        Expr = ForwardRef(lambda: Or((Expr, '+', Pattern(r'\\d+')), 'x'))
+        trace = ParseTrace()
+        parse(Expr, 'x+1', trace=trace)
+        kinds = [i.kind for i in trace.events]
+        assert kinds.count('enter') == kinds.count('exit') > 0
+        names = [i['name'] for i in
+            json.loads(trace.chrome_trace())['traceEvents']]
+        assert "'+'" in names
+    '''
+    def __init__(self):
+        self.events = []
+        self.interpreter = None
+        self.names = {}
+        # The events of the parsers that are running.
+        self.running = []
+
+    def attach(self, interpreter):
+        self._close()
+        self.interpreter = interpreter
+        self.names = {}
+
+    def enter(self, parser, pos):
+        event = TraceEvent('enter', self._name(parser), pos, time.time(), None)
+        self.events.append(event)
+        self.running.append(event)
+
+    def exit(self, parser, pos, ans):
+        end = getattr(ans, 'pos', None)
+        self.events.append(TraceEvent('exit', self._name(parser), pos,
+            time.time(), end))
+        self.running.pop()
+
+    def memo_hit(self, parser, pos, ans):
+        end = getattr(ans, 'pos', None)
+        self.events.append(TraceEvent('memo_hit', self._name(parser), pos,
+            time.time(), end))
+
+    def chrome_trace(self):
+        self._close()
+        start = self.events[0].time if self.events else 0
+        ans = []
+        for event in self.events:
+            item = {'name': event.rule, 'cat': 'parse', 'ph': 'B', 'pid': 1,
+                'tid': 1, 'ts': (event.time - start) * 1e6,
+                'args': {'pos': event.pos}}
+            if event.kind == 'exit':
+                item.update(ph='E', args={'end': event.end})
+            elif event.kind == 'memo_hit':
+                item.update(cat='memo', ph='i', s='t')
+                item['args']['end'] = event.end
+            ans.append(item)
+        return json.dumps({'traceEvents': ans})
+
+    def collapsed(self):
+        self._close()
+        totals = {}
+        # A list of [rule, start time, time in children] for each parser that
+        # is running.
+        stack = []
+        for event in self.events:
+            if event.kind == 'enter':
+                rule = event.rule.replace(';', '\\x3b')
+                stack.append([rule, event.time, 0.0])
+            elif event.kind == 'exit':
+                path = ';'.join(i[0] for i in stack)
+                rule, start, children = stack.pop()
+                elapsed = event.time - start
+                totals[path] = totals.get(path, 0.0) + elapsed - children
+                if stack:
+                    stack[-1][2] += elapsed
+        lines = []
+        for path, seconds in sorted(totals.iteritems()):
+            weight = int(round(seconds * 1e6))
+            if weight > 0:
+                lines.append('%s %d' % (path, weight))
+        return '\n'.join(lines)
+
+    def _name(self, parser):
+        ans = self.names.get(parser)
+        if ans is None:
+            ans = self.names[parser] = self.interpreter.rule(parser)
+        return ans
+
+    def _close(self):
+        # Adds exit events for the parsers that never stopped.
+        if not self.running:
+            return
+        last = self.events[-1].time
+        while self.running:
+            event = self.running.pop()
+            self.events.append(TraceEvent('exit', event.rule, event.pos, last,
+                None))
+
+
+def _rule(parser, names):
+    # Returns the name of the rule of a parser. Prefer a class, since a Struct
+    # or Token class is the name that the grammar gave its rule. Otherwise,
+    # use the shortest repr. (A ForwardRef gets the same parser as the
+    # expression that it refers to, which says more.)
+    names = [i for i in names or () if not isinstance(i, ForwardRef)]
+    if names:
+        classes = [i for i in names if inspect.isclass(i)]
+        if classes:
+            return min(i.__name__ for i in classes)
+        return min((_shorten(_describe(i)) for i in names), key=len)
+    factory = getattr(parser, 'factory', None)
+    if factory is not None:
+        return '%s(%s)' % (factory.__name__, _shorten(_describe(parser.arg)))
+    return getattr(parser, '__name__', parser.__class__.__name__)
+
+
+def _describe(node):
+    # Like repr, but shows regexes by their patterns and functions by their
+    # names, instead of by their addresses.
+    if inspect.isclass(node) or inspect.isfunction(node):
+        return node.__name__
+    if hasattr(node, 'pattern') and hasattr(node, 'match'):
+        return 'Regex(%r)' % node.pattern
+    if isinstance(node, ParsingOperand) and isinstance(node, tuple):
+        args = ', '.join(_describe(i) for i in node)
+        return '%s(%s)' % (node.__class__.__name__, args)
+    if type(node) is tuple:
+        return '(%s)' % ', '.join(_describe(i) for i in node)
+    return repr(node)
+
+
+def _shorten(text, size=60):
+    return text if len(text) <= size else text[:size - 3] + '...'
@@ -55,7 +55,11 @@ def Content(token):
 
 
 def Pattern(pattern):
-    return Transform(Regex(pattern), lambda m: m.group(0))
+    return Transform(Regex(pattern), _matched_text)
+
+
+def _matched_text(match):
+    return match.group(0)
 
 
 def Verbose(pattern):
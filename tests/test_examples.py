@@ -1,6 +1,11 @@
 '''Search all our doc comments for "Example" blocks and try executing them.'''
 import re
+import sourcer.cache
+import sourcer.compiler
 import sourcer.expressions
+import sourcer.interpreter
+import sourcer.memo
+import sourcer.profiler
 
 
 def run_examples(package):
@@ -30,4 +35,9 @@ def run_examples(package):
 
 
 if __name__ == '__main__':
+    run_examples(sourcer.cache)
+    run_examples(sourcer.compiler)
     run_examples(sourcer.expressions)
+    run_examples(sourcer.interpreter)
+    run_examples(sourcer.memo)
+    run_examples(sourcer.profiler)
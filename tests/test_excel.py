@@ -176,6 +176,22 @@ class TestExcelFormulas(unittest.TestCase):
         # when parsing any of the formauls.
         assert all(parse_formula(i) for i in ewbi_cases)
 
+    def test_code_generator(self):
+        # Make sure that the generated code builds the same trees as the
+        # interpreter.
+        def dump(obj):
+            if isinstance(obj, (list, tuple)):
+                return [dump(i) for i in obj]
+            if hasattr(obj, '__dict__'):
+                items = sorted(obj.__dict__.iteritems())
+                return (obj.__class__, [(k, dump(v)) for k, v in items])
+            return obj
+        for formula in ewbi_cases:
+            tokens = tokenize(Tokens, formula)
+            ans1 = parse(Formula, tokens)
+            ans2 = parse(Formula, tokens, backend='codegen')
+            self.assertEqual(dump(ans1), dump(ans2))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,17 @@
 import unittest
 
 import collections
+import mmap
 import operator
+import os
+import random
 import re
+import tempfile
 
 from sourcer import *
+import sourcer.cache
+import sourcer.compiler
+import sourcer.interpreter
 
 
 Int = Transform(Pattern(r'\d+'), int)
@@ -17,6 +24,19 @@ T.Number = r'\d+'
 AnyInst = lambda *classes: Where(lambda x: isinstance(x, classes))
 
 
+class BothBackends(object):
+    # A mixin for the test cases that check that the interpreter and the
+    # generated code give the same result. The "parse_options" go to both.
+    parse_options = {}
+
+    def parse_both(self, expression, source):
+        ans = parse(expression, source, **self.parse_options)
+        other = parse(expression, source, backend='codegen',
+            **self.parse_options)
+        self.assertEqual(ans, other)
+        return ans
+
+
 class TestSomePotentiallyUsefulStrategies(unittest.TestCase):
     def test_tokenize_indentation(self):
         '''Use Backtrack to recognize indentation tokens.'''
@@ -866,5 +886,1553 @@ class TestPerformanceWithManyOperators(unittest.TestCase):
         self.assertIsInstance(ans, Operation)
 
 
+class TestCodeGenerator(unittest.TestCase):
+    def assertSameResult(self, expression, source):
+        expectation = parse(expression, source)
+        ans = parse(expression, source, backend='codegen')
+        self.assertEqual(ans, expectation)
+
+    def test_text_expressions(self):
+        greeting = 'Hello' >> Opt(',') >> ' ' >> Pattern(r'\w+') << '!'
+        self.assertSameResult(greeting, 'Hello, World!')
+        self.assertSameResult(greeting, 'Hello Chief!')
+        self.assertSameResult(Alt(Int, ','), '1,2,3,4')
+        self.assertSameResult(('A', Not('B'), Expect('C'), Any), 'AC')
+        self.assertSameResult(Require(List('A'), len), 'AAA')
+        self.assertSameResult(Pattern(r'[a-z]+') >> Backtrack(1) >> 'o', 'fo')
+        self.assertSameResult((Start, Return(5), End), '')
+
+    def test_operator_precedence(self):
+        Parens = '(' >> ForwardRef(lambda: Expr) << ')'
+        Expr = OperatorPrecedence(
+            Int | Parens,
+            InfixRight('^'),
+            Prefix('+', '-'),
+            Postfix('%'),
+            InfixLeft('*', '/'),
+            InfixLeft('+', '-'),
+        )
+        self.assertSameResult(Expr, '1+2^3/4')
+        self.assertSameResult(Expr, '-(1*(2+3))%')
+
+    def test_data_expressions(self):
+        T = TokenSyntax()
+        T.Number = r'\d+'
+        T.Space = Skip(r'\s+')
+        tokens = tokenize(T, '1 2 3')
+        self.assertSameResult(List(Content(T.Number)), tokens)
+        self.assertSameResult(('1', T.Number, Pattern(r'\d')), tokens)
+        self.assertSameResult(List(Literal(1) | 2), [1, 2, 1])
+
+    def test_bind_expression(self):
+        zs = Bind(Int, lambda count: 'z' * count)
+        self.assertSameResult(zs, '4zzzz')
+        with self.assertRaises(ParseError):
+            parse(zs, '4zzz', backend='codegen')
+
+    def test_parse_prefix(self):
+        ans = parse_prefix(List('A'), 'AAB', backend='codegen')
+        self.assertIsInstance(ans, ParseResult)
+        self.assertEqual(ans, (['A', 'A'], 2))
+        with self.assertRaises(ParseError):
+            parse_prefix('B', 'AAB', backend='codegen')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            parse('A', 'A', backend='bogus')
+
+
+class TestCommit(BothBackends, unittest.TestCase):
+    def assertBothFail(self, expression, source):
+        with self.assertRaises(ParseError):
+            parse(expression, source)
+        with self.assertRaises(ParseError):
+            parse(expression, source, backend='codegen')
+
+    def test_no_backtracking_past_commit(self):
+        Goal = Or(('a', Commit, 'b'), 'ac')
+        self.assertEqual(self.parse_both(Goal, 'ab'), ('a', None, 'b'))
+        self.assertBothFail(Goal, 'ac')
+        self.assertEqual(self.parse_both(Or(('a', 'b'), 'ac'), 'ac'), 'ac')
+
+    def test_commit_in_list(self):
+        Statement = (Pattern(r'\w+') << Commit) << ';'
+        Block = List(Statement) << Opt('!')
+        self.assertEqual(self.parse_both(Block, 'a;b;c;!'), ['a', 'b', 'c'])
+        self.assertBothFail(Block, 'a;b;c')
+        self.assertBothFail(List(Statement | 'c'), 'a;b;c')
+
+    def test_commit_in_lookahead(self):
+        Goal = Or((Expect(('a', Commit, 'x')), Any), 'ab')
+        self.assertEqual(self.parse_both(Goal, 'ab'), 'ab')
+        Goal = Or((Not(('a', Commit, 'x')), 'ab'), 'a')
+        self.assertEqual(self.parse_both(Goal, 'ab'), (None, 'ab'))
+
+    def test_commit_in_bound_grammar(self):
+        # The grammar that Bind builds while parsing may use Commit too.
+        Goal = Or(Bind('a', lambda value: (Commit, 'b')), 'ac')
+        self.assertEqual(self.parse_both(Goal, 'ab'), (None, 'b'))
+        self.assertBothFail(Goal, 'ac')
+        Inner = lambda value: Or(('b', Commit, 'c'), 'bd')
+        Goal = Or(Bind('a', Inner), 'abd')
+        self.assertBothFail(Goal, 'abd')
+        Inner = lambda value: Not(('b', Commit, 'x')) >> 'bd'
+        self.assertEqual(self.parse_both(Bind('a', Inner), 'abd'), 'bd')
+
+    def test_memo_entries_before_commit(self):
+        Word = Memo(Pattern(r'\w+'))
+        Statement = Or((Word, '=', Word), Word) << ';' << Commit
+        source = 'x=y;z;' * 2000
+        parser = sourcer.compiler.compile(List(Statement))
+        interpreter = sourcer.interpreter._Interpreter(source)
+        ans = interpreter.run(parser)
+        self.assertEqual(len(ans.value), 4000)
+        self.assertEqual(interpreter.cut, len(source))
+        self.assertTrue(len(interpreter.memo) < 2000)
+        memo = WindowedMemo(window=0, min_sweep=64)
+        self.assertEqual(parse(List(Statement), source, memo=memo), ans.value)
+        self.assertTrue(len(memo) < 200)
+
+
+class TestLeftRecursion(BothBackends, unittest.TestCase):
+    def test_direct_left_recursion(self):
+        Sum = ForwardRef(lambda: Or((Expr, '+', Int), (Expr, '-', Int)))
+        Expr = Or(Sum, Int)
+        ans = self.parse_both(Expr, '1-2+3')
+        self.assertEqual(ans, ((1, '-', 2), '+', 3))
+        self.assertEqual(self.parse_both(Expr, '4'), 4)
+
+    def test_indirect_left_recursion(self):
+        Term = ForwardRef(lambda: Product | Int)
+        Product = Transform((Term, '*', Int), lambda t: t[0] * t[2])
+        Expr = ForwardRef(lambda: Sum | Term)
+        Sum = Transform((Expr, '+', Term), lambda t: t[0] + t[2])
+        self.assertEqual(self.parse_both(Expr, '1+2*3*4+5'), 30)
+
+    def test_nullable_prefix(self):
+        Space = Pattern(r' *')
+        Expr = ForwardRef(lambda: Or((Space, Expr, '!'), 'x'))
+        ans = self.parse_both(Expr, 'x!!')
+        self.assertEqual(ans, (('', ('', 'x', '!'), '!')))
+
+    def test_long_chain(self):
+        Expr = ReduceLeft(Int, Or('+', '-'), Int, Operation)
+        source = '+'.join(str(i) for i in range(5000))
+        for backend in ['interpreter', 'codegen']:
+            ans = parse(Expr, source, backend=backend)
+            depth = 0
+            while isinstance(ans, Operation):
+                self.assertEqual(ans.right, 4999 - depth)
+                ans = ans.left
+                depth += 1
+            self.assertEqual((ans, depth), (0, 4999))
+
+    def test_plans(self):
+        Expr = ForwardRef(lambda: Or((Expr, '+', Int), Int))
+        parser = sourcer.compiler.compile(Expr)
+        self.assertEqual(parser.left_recursion, [parser.parsers[0]])
+        self.assertIs(parser.parsers[0].left_recursion, None)
+        self.assertTrue(parser.memoize)
+        self.assertFalse(parser.parsers[0].memoize)
+        Parens = ForwardRef(lambda: Or(('(', Parens, ')'), 'x'))
+        parser = sourcer.compiler.compile(Parens)
+        self.assertIs(parser.left_recursion, None)
+
+
+class TestIterParse(unittest.TestCase):
+    class Reader(object):
+        def __init__(self, text):
+            self.text = text
+            self.pos = 0
+
+        def read(self, size):
+            ans = self.text[self.pos:self.pos + size]
+            self.pos += len(ans)
+            return ans
+
+    def test_items_and_separators(self):
+        Record = (Pattern(r'[a-z]+'), '=', Int)
+        source = 'foo=1\nbar=22\nbaz=333\n'
+        for backend in ['interpreter', 'codegen']:
+            items = iterparse(Record, self.Reader(source), separator='\n',
+                chunk_size=4, backend=backend)
+            self.assertEqual(list(items),
+                [('foo', '=', 1), ('bar', '=', 22), ('baz', '=', 333)])
+
+    def test_yields_items_as_they_complete(self):
+        reader = self.Reader(';'.join(str(i) for i in range(1000)))
+        items = iterparse(Int, reader, separator=';', chunk_size=16)
+        self.assertEqual(next(items), 0)
+        self.assertTrue(reader.pos < 100)
+        self.assertEqual(list(items), range(1, 1000))
+
+    def test_long_items(self):
+        source = 'A' * 5000 + ' ' + 'B' * 3
+        items = iterparse(Pattern(r'\w+'), self.Reader(source), separator=' ',
+            chunk_size=10)
+        self.assertEqual(list(items), ['A' * 5000, 'BBB'])
+
+    def test_without_separator(self):
+        items = iterparse(Pattern(r'\d') * int, self.Reader('12345'),
+            chunk_size=2)
+        self.assertEqual(list(items), [1, 2, 3, 4, 5])
+
+    def test_errors(self):
+        items = iterparse(Int, self.Reader('1,2,x,4'), separator=',')
+        self.assertEqual(next(items), 1)
+        self.assertEqual(next(items), 2)
+        with self.assertRaises(ParseError):
+            next(items)
+        self.assertEqual(list(iterparse(Int, self.Reader(''))), [])
+        # The error says where it is in the whole file.
+        source = '1;22;\n333;\n4;5x;6'
+        for size in range(1, len(source) + 1):
+            items = iterparse(Int, self.Reader(source),
+                separator=Pattern(';\n?'), chunk_size=size)
+            with self.assertRaises(ParseError) as context:
+                list(items)
+            error = context.exception
+            self.assertEqual((error.position, error.line, error.column),
+                (source.index('x'), 3, 4))
+            self.assertEqual(error.expected, [';\n?', 'end of input'])
+
+    def test_chunk_sizes(self):
+        # An alternative that failed at the end of the buffer may match once
+        # there's more input, so every chunk size gives the same items.
+        cases = [
+            (List(Or(Pattern('[a-z]+') << '.', Pattern('[a-z]'))), None,
+                'abc.'),
+            (Or(('a', ';bx'), 'a'), ';', 'a;bx;a'),
+            (Pattern(r'\d+') * int, ',', '12,345,6'),
+            # A lookahead may look past the end of the buffer.
+            (Pattern('[a-z]+(?=!)') | Pattern('[a-z!]'), None, 'abc!'),
+        ]
+        for expression, separator, source in cases:
+            expected = list(iterparse(expression, self.Reader(source),
+                separator=separator))
+            for backend in ['interpreter', 'codegen']:
+                for size in range(1, len(source) + 1):
+                    items = iterparse(expression, self.Reader(source),
+                        separator=separator, chunk_size=size, backend=backend)
+                    self.assertEqual(list(items), expected)
+
+
+class TestIncrementalParser(unittest.TestCase):
+    def test_reuses_memo_entries(self):
+        calls = []
+        Name = Pattern(r'[a-z]+')
+        Line = Transform((Name, '=', Int), calls.append) << '\n'
+        source = ''.join('x=%d\n' % i for i in range(100))
+        document = IncrementalParser(List(Line), source)
+        self.assertEqual(len(calls), 100)
+        del calls[:]
+        document.edit(source.index('x=42'), 1, 'abc')
+        self.assertEqual(calls, [('abc', '=', 42)])
+        del calls[:]
+        # The parser drops the entries at the position of an insertion, so
+        # it parses the first line again.
+        document.edit(0, 0, 'y=7\n')
+        self.assertEqual(calls, [('y', '=', 7), ('x', '=', 0)])
+        source = 'y=7\n' + source.replace('x=42', 'abc=42')
+        self.assertEqual(document.source, source)
+
+    def test_edits(self):
+        Parens = '(' >> ForwardRef(lambda: Expr) << ')'
+        Expr = OperatorPrecedence(
+            Int | Parens,
+            Prefix('-'),
+            InfixLeft('*', '/'),
+            InfixLeft('+', '-'),
+        )
+        source = '1+2*(3-4)/5'
+        document = IncrementalParser(Expr, source)
+        edits = [(0, 1, '10'), (3, 0, '-'), (5, 6, '8'), (0, 0, '(1)*'),
+            (4, 5, ''), (0, 0, '7-')]
+        for offset, removed, inserted in edits:
+            source = source[:offset] + inserted + source[offset + removed:]
+            self.assertEqual(document.edit(offset, removed, inserted),
+                parse(Expr, source))
+        self.assertEqual(document.source, source)
+
+    def test_parse_errors(self):
+        document = IncrementalParser(List(Int << ';'), '1;2;3;')
+        with self.assertRaises(ParseError) as context:
+            document.edit(2, 1, 'x')
+        error = context.exception
+        self.assertEqual((error.position, error.column), (2, 3))
+        self.assertEqual(error.expected, ['\\d+', 'end of input'])
+        self.assertEqual(document.edit(2, 1, '4'), [1, 4, 3])
+        with self.assertRaises(ParseError) as context:
+            document.edit(5, 0, '\n7')
+        self.assertEqual(context.exception.expected, ["';'"])
+
+    def test_literal_choices(self):
+        # A choice of literals looks ahead by the length of its longest
+        # string, so an edit in that range invalidates its entries.
+        Goal = List(Or(AnyOf('abcdef', 'x'), Pattern('[a-zA-Z]')))
+        document = IncrementalParser(Goal, 'abcdeX')
+        self.assertEqual(document.edit(5, 1, 'f'), parse(Goal, 'abcdef'))
+        self.assertEqual(document.edit(0, 1, 'x'), parse(Goal, 'xbcdef'))
+
+    def test_regex_reach(self):
+        # The first alternative looks three characters ahead before it fails,
+        # so changing the "q" changes the result at the start.
+        Goal = List(Pattern(r'\d+(?=px)') | Pattern(r'\d') | Pattern('[a-z]'))
+        document = IncrementalParser(Goal, '12pq')
+        self.assertEqual(document.edit(3, 1, 'x'), ['12', 'p', 'x'])
+        # A lookbehind depends on the text before its position.
+        After = Transform(Pattern('(?<=x)y'), str.upper)
+        Goal = List(After | Pattern('[a-z]'))
+        document = IncrementalParser(Goal, 'xy')
+        self.assertEqual(document.value, ['x', 'Y'])
+        self.assertEqual(document.edit(0, 1, 'z'), ['z', 'y'])
+
+    def test_random_edits(self):
+        Item = (Transform(Pattern(r'a+(?=b)'), str.upper)
+            | Pattern(r'a*ab')
+            | Pattern(r'\d+\.\d+')
+            | Pattern(r'\bc+')
+            | Transform(Pattern(r'(?<=a)b'), str.upper)
+            | Pattern(r'"[^"]*"')
+            | Pattern(r'[a-z\d".]'))
+        Goal = List(Item)
+        chars = 'aabc1.."'
+        rand = random.Random(7)
+        for _ in range(20):
+            source = ''.join(rand.choice(chars) for _ in range(12))
+            document = IncrementalParser(Goal, source)
+            for _ in range(10):
+                offset = rand.randint(0, len(source))
+                removed = rand.randint(0, min(3, len(source) - offset))
+                inserted = ''.join(rand.choice(chars)
+                    for _ in range(rand.randint(0, 3)))
+                source = source[:offset] + inserted + source[offset + removed:]
+                self.assertEqual(document.edit(offset, removed, inserted),
+                    parse(Goal, source))
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_methods(self):
+        parser = Parser(List(Int << Opt(',')))
+        self.assertEqual(parser.parse('1,2,3'), [1, 2, 3])
+        self.assertEqual(parser.parse(''), [])
+        self.assertEqual(parser.parse_prefix('4,5x'), ([4, 5], 3))
+        self.assertIsInstance(parser.try_parse('1,x'), ParseError)
+        with self.assertRaises(ParseError):
+            parser.parse('1,x')
+
+    def test_parse_many(self):
+        sources = ['1+2', '3', '4+', '5+6+7']
+        Sum = Alt(Int, '+', allow_trailer=False)
+        for backend in ['interpreter', 'codegen']:
+            ans = parse_many(Sum, sources, backend=backend)
+            self.assertEqual(ans[:2], [[1, 2], [3]])
+            self.assertIsInstance(ans[2], ParseError)
+            self.assertEqual(ans[3], [5, 6, 7])
+
+    def test_text_and_tokens(self):
+        T = TokenSyntax()
+        T.Word = r'[a-z]+'
+        T.Space = Skip(r'\s+')
+        parser = Parser(List(T.Word) * len)
+        self.assertEqual(parser.parse('foo'), 1)
+        self.assertEqual(parser.parse(tokenize(T, 'foo bar')), 2)
+
+    def test_worker_processes(self):
+        sources = [str(i) for i in range(50)] + ['x']
+        parser = Parser(Int)
+        ans = parser.parse_many(sources, processes=2, chunk_size=7)
+        self.assertEqual(ans[:50], range(50))
+        self.assertIsInstance(ans[50], ParseError)
+
+    def test_unpicklable_results(self):
+        # The token classes of a TokenSyntax can't be pickled, so the parser
+        # parses these sources in this process instead.
+        T = TokenSyntax()
+        T.Word = r'[a-z]+'
+        T.Space = Skip(r'\s+')
+        sources = [tokenize(T, 'foo bar'), tokenize(T, 'baz')] * 3
+        parser = Parser(List(T.Word))
+        ans = parser.parse_many(sources, processes=2, chunk_size=2)
+        self.assertEqual(ans, [parser.parse(i) for i in sources])
+
+    def test_concurrent_calls(self):
+        # Each call hands its own parser and sources to its workers.
+        import threading
+        parsers = [Parser(Int), Parser(Pattern('[a-z]+') * len)]
+        sources = [[str(i) for i in range(30)], ['ab', 'c', 'def'] * 10]
+        results = [None, None]
+        def work(index):
+            results[index] = parsers[index].parse_many(sources[index],
+                processes=2, chunk_size=4)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [range(30), [2, 1, 3] * 10])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Parser(Int, backend='bogus')
+
+    def test_threads(self):
+        import threading
+        parser = Parser(Grammar(List(Int << ';')))
+        failures = []
+        def work(index):
+            source = ''.join('%d;' % i for i in range(index, index + 200))
+            try:
+                for _ in range(20):
+                    if parser.parse(source) != range(index, index + 200):
+                        failures.append(index)
+                if parser.try_parse(source + 'x').position != len(source):
+                    failures.append(index)
+            except Exception:
+                failures.append(index)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+
+class TestParseParallel(unittest.TestCase):
+    def test_same_result_as_parse(self):
+        Record = (Pattern(r'[a-z]+'), '=', Int)
+        source = '\n'.join('k=%d' % i for i in range(300))
+        expectation = parse(Alt(Record, '\n'), source)
+        ans = parse_parallel(Record, source, '\n', processes=2, pieces=7)
+        self.assertEqual(ans, expectation)
+
+    def test_falls_back_on_ambiguous_boundaries(self):
+        # The strings may contain newlines, so some of the pieces fail.
+        Item = Int | ('"' >> Pattern(r'[^"]*') << '"')
+        source = '\n'.join('1\n"a\nb\nc"\n2' for i in range(20))
+        expectation = parse(Alt(Item, '\n'), source)
+        ans = parse_parallel(Item, source, '\n', processes=2, pieces=30)
+        self.assertEqual(ans, expectation)
+        with self.assertRaises(ParseError):
+            parse_parallel(Item, source + '\n\n', '\n', processes=2)
+
+    def test_boundaries_inside_items(self):
+        # A word may span lines, so a piece may end in the middle of one. The
+        # pieces still parse, but the items don't end where they do.
+        Item = Pattern(r'[a-z]+(?:\n[a-z]+)*') | Int
+        source = '\n'.join('ab\ncd\n%d' % i for i in range(50))
+        expectation = parse(Alt(Item, '\n'), source)
+        self.assertEqual(expectation[:4], ['ab\ncd', 0, 'ab\ncd', 1])
+        ans = parse_parallel(Item, source, '\n', processes=2, pieces=30)
+        self.assertEqual(ans, expectation)
+
+    def test_trailing_boundary(self):
+        source = ''.join('%d\n' % i for i in range(100))
+        for pieces in [3, 100]:
+            ans = parse_parallel(Int, source, '\n', processes=2, pieces=pieces)
+            self.assertEqual(ans, range(100))
+
+    def test_split(self):
+        source = 'aa,bb,,cc,dd'
+        bounds = sourcer.interpreter._split(source, ',', 3)
+        pieces = [source[start:stop] for start, stop in bounds]
+        self.assertEqual(pieces, ['aa,bb', ',cc', 'dd'])
+
+
+class TestBinarySources(unittest.TestCase):
+    def setUp(self):
+        Pair = (Pattern(r'[a-z]+') << '=', Int)
+        self.grammar = Alt(Pair, ';')
+        self.text = 'a=1;bb=22;ccc=333'
+        self.expectation = [('a', 1), ('bb', 22), ('ccc', 333)]
+
+    def check(self, source):
+        for backend in ('interpreter', 'codegen'):
+            ans = parse(self.grammar, source, backend=backend)
+            self.assertEqual(ans, self.expectation)
+            self.assertTrue(all(type(k) is str for k, v in ans))
+
+    def test_bytearray(self):
+        self.check(bytearray(self.text))
+
+    def test_buffer(self):
+        self.check(buffer('xx' + self.text, 2))
+
+    def test_memoryview(self):
+        self.check(memoryview(self.text))
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as fileobj:
+            fileobj.write(self.text)
+            fileobj.flush()
+            mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.check(mapping)
+                parser = Parser(self.grammar)
+                self.assertEqual(parser.parse(mapping), self.expectation)
+            finally:
+                mapping.close()
+
+    def test_failure(self):
+        with self.assertRaises(ParseError):
+            parse(self.grammar, bytearray(self.text + ';d'))
+
+    def test_memoryview_is_not_copied(self):
+        data = bytearray(self.text)
+        source = sourcer.interpreter._text_source(memoryview(data))[1]
+        data[0] = 'z'
+        self.assertEqual(source[:3], 'z=1')
+
+    def test_incremental_parser(self):
+        for source in [bytearray(self.text), memoryview(self.text)]:
+            document = IncrementalParser(self.grammar, source)
+            self.assertEqual(document.value, self.expectation)
+            self.assertEqual(document.edit(0, 1, 'd')[0], ('d', 1))
+
+    def test_iterparse(self):
+        class Reader(object):
+            def __init__(self, data):
+                self.data = data
+                self.pos = 0
+
+            def read(self, size):
+                ans = self.data[self.pos:self.pos + size]
+                self.pos += len(ans)
+                return ans
+
+        Pair = (Pattern(r'[a-z]+') << '=', Int)
+        for data in [bytearray(self.text), memoryview(self.text)]:
+            items = iterparse(Pair, Reader(data), separator=';', chunk_size=3)
+            self.assertEqual(list(items), self.expectation)
+
+
+class TestDeferredActions(BothBackends, unittest.TestCase):
+    parse_options = {'deferred': True}
+
+    def test_discarded_alternatives(self):
+        calls = []
+        def record(value):
+            calls.append(value)
+            return value.upper()
+        Item = Or((Transform(Name, record), ';'), (Name, ','))
+        for backend in ['interpreter', 'codegen']:
+            del calls[:]
+            ans = parse(List(Item), 'a,b;c,', backend=backend)
+            self.assertEqual(calls, ['a', 'b', 'c'])
+            del calls[:]
+            ans = parse(List(Item), 'a,b;c,', backend=backend, deferred=True)
+            self.assertEqual(ans, [('a', ','), ('B', ';'), ('c', ',')])
+            self.assertEqual(calls, ['b'])
+
+    def test_same_results(self):
+        class Pair(Struct):
+            def parse(self):
+                self.left = Int
+                self.sep = '='
+                self.right = T.Number
+        class Dot(LeftAssoc):
+            def parse(self):
+                self.left = Pair | Name
+                self.op = '.'
+                self.right = Pair | Name
+        for backend in ['interpreter', 'codegen']:
+            ans = parse(Dot, 'foo.1=2.bar', backend=backend, deferred=True)
+            self.assertEqual(ans.right, 'bar')
+            self.assertEqual(ans.left.left, 'foo')
+            pair = ans.left.right
+            self.assertEqual((pair.left, pair.right.content), (1, '2'))
+        Expr = OperatorPrecedence(Int, InfixLeft('*'), InfixLeft('+'))
+        ans = self.parse_both(Expr, '1+2*3')
+        self.assertEqual(ans, Operation(1, '+', Operation(2, '*', 3)))
+
+    def test_bind_and_require(self):
+        Even = Require(Int, lambda x: x % 2 == 0)
+        Run = Bind(Even, lambda count: (Return(count), 'z' * count))
+        self.assertEqual(self.parse_both(Run, '2zz'), (2, 'zz'))
+        with self.assertRaises(ParseError):
+            parse(Run, '1z', deferred=True)
+
+    def test_shared_nodes(self):
+        calls = []
+        Word = Transform(Name, lambda x: calls.append(x) or object())
+        ans = parse((Expect(Word), Word), 'abc', deferred=True)
+        self.assertIs(ans[0], ans[1])
+        self.assertEqual(calls, ['abc'])
+
+    def test_deep_tree(self):
+        Expr = ReduceLeft(Int, '+', Int, Operation)
+        source = '+'.join(str(i) for i in range(5000))
+        parser = Parser(Expr, deferred=True)
+        ans = parser.parse(source)
+        self.assertEqual(ans.right, 4999)
+        self.assertEqual(ans.left.right, 4998)
+
+
+class TestRecognize(unittest.TestCase):
+    def test_results(self):
+        Expr = Alt(Int, '+')
+        for backend in ['interpreter', 'codegen']:
+            check = lambda *a: recognize(Expr, *a, backend=backend)
+            self.assertIs(check('1+2+3'), True)
+            self.assertIs(check('1+2+'), True)
+            self.assertIs(check('1+2 3'), False)
+            self.assertEqual(check('1+2 3', True), 3)
+            self.assertEqual(check(' 1', True), 0)
+            self.assertIs(recognize(Int, 'x', True, backend=backend), None)
+
+    def test_no_values(self):
+        calls = []
+        class Pair(Struct):
+            def parse(self):
+                self.left = Transform(Name, calls.append)
+                self.sep = '='
+                self.right = T.Number
+        for backend in ['interpreter', 'codegen']:
+            self.assertTrue(recognize(List(Pair), 'a=1b=2', backend=backend))
+            self.assertFalse(recognize(List(Pair), 'a=', backend=backend))
+        self.assertEqual(calls, [])
+
+    def test_fused_terminals(self):
+        # A fused sequence only finds out where its regex stops.
+        Goal = ('a', Opt(Pattern(r'\d+')), 'b')
+        parser = sourcer.compiler.compile(Goal, recognize=True)
+        self.assertIsNone(parser.arg.build)
+        self.assertEqual(next(parser('a12b!', 0)), ParseResult(None, 4))
+        self.assertIsNotNone(sourcer.compiler.compile(Goal).arg.build)
+        for backend in ['interpreter', 'codegen']:
+            self.assertEqual(recognize(Goal, 'a12b!', True, backend=backend), 4)
+            self.assertIs(recognize(Goal, 'a1', backend=backend), False)
+
+    def test_require_and_bind(self):
+        Run = Bind(Int, lambda count: 'z' * count)
+        Even = Require(Int, lambda x: x % 2 == 0)
+        for backend in ['interpreter', 'codegen']:
+            check = lambda *a: recognize(*a, backend=backend)
+            self.assertTrue(check(Run, '3zzz'))
+            self.assertFalse(check(Run, '3zz'))
+            self.assertTrue(check((Even, Some('z')), '4z'))
+            self.assertFalse(check((Even, Some('z')), '3z'))
+            self.assertFalse(check((Even, Some('z')), '4'))
+
+    def test_parser(self):
+        Expr = OperatorPrecedence(Int, InfixLeft('*'), InfixLeft('+'))
+        parser = Parser(Expr, backend='codegen')
+        self.assertTrue(parser.recognize('1+2*3'))
+        self.assertEqual(parser.recognize('1+2*', partial=True), 3)
+        self.assertEqual(parser.parse('2*3'), Operation(2, '*', 3))
+
+
+class TestDispatch(BothBackends, unittest.TestCase):
+    def test_text_plan(self):
+        Word = Pattern(r'(?i)[a-z]\w*')
+        parser = sourcer.compiler.compile(Or(Or(Or('(', Int), Word), Opt('-')))
+        dispatch = parser.dispatch
+        self.assertEqual(dispatch.indexes('('), (0, 3))
+        self.assertEqual(dispatch.indexes('7'), (1, 3))
+        self.assertEqual(dispatch.indexes('Q'), (2, 3))
+        self.assertEqual(dispatch.indexes(None), (3,))
+
+    def test_ordered_choice(self):
+        Expr = Or(Or(Or('ab', Pattern(r'a\d')), 'a'), Opt('x'))
+        cases = [('ab', 'ab'), ('a1', 'a1'), ('a', 'a'), ('x', 'x')]
+        for source, expectation in cases:
+            self.assertEqual(self.parse_both(Expr, source), expectation)
+        self.assertEqual(self.parse_both((Expr, 'y'), 'y'), (None, 'y'))
+        self.assertEqual(self.parse_both((Expr, End), ''), (None, None))
+
+    def test_regex_first_sets(self):
+        first = lambda pattern: sourcer.compiler._regex_first_set(
+            re.compile(pattern))
+        match = lambda pattern, char: any(i[1].match(char)
+            for i in first(pattern))
+        self.assertTrue(match(r'\s*\d', '4'))
+        self.assertTrue(match(r'\s*\d', ' '))
+        self.assertFalse(match(r'\s*\d', 'x'))
+        self.assertTrue(match(r'(?i)abc|x?y', 'A'))
+        self.assertTrue(match(r'(?i)abc|x?y', 'Y'))
+        self.assertFalse(match(r'[^"]+', '"'))
+        self.assertEqual(first(r'.x'), None)
+        self.assertTrue(match(r'(a)\1', 'a'))
+        self.assertFalse(match(r'(a)\1', 'b'))
+        self.assertEqual(first(r'\b'), None)
+        self.assertEqual(first(r'(?=a)'), None)
+        self.assertTrue(match(r'a(?=b)', 'a'))
+        self.assertFalse(match(r'a(?=b)', 'b'))
+
+    def test_lookaround_alternatives(self):
+        # A lookahead matches without consuming anything, even though it
+        # doesn't match the empty string.
+        Goal = (Or(Pattern(r'(?=a)'), 'b'), 'a')
+        self.assertEqual(self.parse_both(Goal, 'a'), ('', 'a'))
+        Goal = (Or(Pattern(r'(?<=x)'), 'b'), 'a')
+        self.assertEqual(self.parse_both(('x', Goal), 'xa'), ('x', ('', 'a')))
+        # The same goes for fused sequences and left recursion.
+        Goal = Or((Pattern(r'(?=a)'), Opt('c')), 'b')
+        self.assertEqual(self.parse_both((Goal, 'a'), 'a'), (('', None), 'a'))
+        Expr = ForwardRef(lambda: Or((Pattern(r'(?=x)'), Expr, '+'), 'x'))
+        self.assertEqual(self.parse_both(Expr, 'x++'),
+            ('', ('', 'x', '+'), '+'))
+
+    def test_tokens(self):
+        T = TokenSyntax()
+        T.Word = r'[a-z]+'
+        T.Symbol = r'[()]'
+        class Name(T.Word): pass
+        Call = (T.Word, '(', T.Word, ')')
+        Expr = Or(Or(Call, (T.Symbol, T.Word, T.Symbol)), T.Word)
+        tokens = tokenize(T, 'f(x)')
+        ans = self.parse_both(Expr, tokens)
+        self.assertEqual([i.content for i in ans[::2]], ['f', 'x'])
+        ans = self.parse_both(Expr, tokenize(T, '(x)'))
+        self.assertEqual(ans[1].content, 'x')
+        name = Name('y')
+        self.assertIs(self.parse_both(Expr, [name]), name)
+
+    def test_commit(self):
+        # The first alternative can't match, but its Commit still counts.
+        Expr = Or(Or((Commit, 'x'), ('a', 'b')), 'a')
+        Start = Or(('q', Expr, 'c'), 'qad')
+        self.assertEqual(self.parse_both(Start, 'qac'), ('q', 'a', 'c'))
+        for backend in ['interpreter', 'codegen']:
+            with self.assertRaises(ParseError):
+                parse(Start, 'qad', backend=backend)
+
+
+class TestFusion(BothBackends, unittest.TestCase):
+    def is_fused(self, expression):
+        parser = sourcer.compiler.compile(expression)
+        factory = getattr(parser, 'factory', None)
+        return factory is sourcer.compiler._fused_text_parser
+
+    def test_values(self):
+        Name = Pattern(r'\w+')
+        Greeting = ('Hello', Opt(','), Name << Opt('!'), ~Expect('?'))
+        self.assertTrue(self.is_fused(Greeting))
+        self.assertEqual(self.parse_both(Greeting, 'Hello,world!'),
+            ('Hello', ',', 'world', None))
+        self.assertEqual(self.parse_both(Greeting, 'Hellofoo'),
+            ('Hello', None, 'foo', None))
+        with self.assertRaises(ParseError):
+            parse(Greeting, 'Hello bob')
+
+    def test_regex_match_objects(self):
+        Expr = ('(', re.compile(r'(\d+)-(\d+)'), ')')
+        self.assertTrue(self.is_fused(Expr))
+        ans = parse(Expr, '(12-34)')
+        self.assertEqual(ans[1].groups(), ('12', '34'))
+        self.assertEqual(ans[1].start(), 1)
+
+    def test_no_backtracking(self):
+        # A PEG doesn't backtrack into an Opt, so neither can the regex.
+        Expr = (Opt('ab'), 'abc')
+        self.assertTrue(self.is_fused(Expr))
+        with self.assertRaises(ParseError):
+            self.parse_both(Expr, 'abc')
+        self.assertEqual(self.parse_both(Expr, 'ababc'), ('ab', 'abc'))
+        Greedy = (Pattern(r'a+'), 'ab')
+        with self.assertRaises(ParseError):
+            self.parse_both(Greedy, 'aaab')
+
+    def test_unfusable_regexes(self):
+        for pattern in [r'(?i)x', r'(?P<x>y)', r'(a)\1']:
+            self.assertFalse(self.is_fused(('a', Pattern(pattern))))
+        self.assertEqual(self.parse_both(('a', Pattern(r'(?i)x')), 'aX'),
+            ('a', 'X'))
+
+    def test_fuse_option(self):
+        Expr = ('a', Opt('b'), 'c')
+        parser = sourcer.compiler.compile(Expr, fuse=False)
+        self.assertIsInstance(parser, sourcer.compiler._SequenceParser)
+        self.assertEqual(self.parse_both(Expr, 'ac'), ('a', None, 'c'))
+        document = IncrementalParser(List(Expr), 'abc')
+        self.assertEqual(document.edit(3, 0, 'ac'),
+            [('a', 'b', 'c'), ('a', None, 'c')])
+
+
+class TestLiteralChoice(BothBackends, unittest.TestCase):
+    def test_ordered_choice(self):
+        Expr = AnyOf('ab', 'a', 'abc', '')
+        parser = sourcer.compiler.compile(Expr)
+        self.assertIs(parser.factory, sourcer.compiler._literal_choice_parser)
+        for backend in ['interpreter', 'codegen']:
+            ans = parse_prefix(Expr, 'abcd', backend=backend)
+            self.assertEqual(ans, ('ab', 2))
+            self.assertEqual(parse_prefix(Expr, 'ax', backend=backend),
+                ('a', 1))
+            self.assertEqual(parse_prefix(Expr, 'x', backend=backend),
+                ('', 0))
+        with self.assertRaises(ParseError):
+            self.parse_both(Expr, 'abc')
+
+    def test_keywords(self):
+        words = ['kw%d' % i for i in range(300)]
+        Keyword = AnyOf(*words) << Not(Pattern(r'\w'))
+        Name = Transform(Pattern(r'[a-z]\w*'), lambda x: (x,))
+        Words = Alt(Or(Keyword, Name), ' ')
+        ans = self.parse_both(Words, 'kw7 kw299 kwx kw1000')
+        # The first match wins, so "kw2" beats "kw299", and then Not fails.
+        self.assertEqual(ans, ['kw7', ('kw299',), ('kwx',), ('kw1000',)])
+
+    def test_many_literals(self):
+        # AnyOf builds a balanced tree, so it doesn't nest too deeply.
+        Expr = AnyOf(*['%04d' % i for i in range(5000)])
+        self.assertEqual(self.parse_both(Expr, '4999'), '4999')
+
+    def test_mixed_alternatives(self):
+        Name = Transform(Pattern(r'[a-z]+'), lambda x: (x,))
+        Expr = Or(Or(Or('x', 'y'), Name), Or('zz', 'z'))
+        parser = sourcer.compiler.compile(Expr)
+        self.assertEqual(len(parser.parsers), 3)
+        self.assertEqual(self.parse_both(Expr, 'y'), 'y')
+        self.assertEqual(self.parse_both(Expr, 'q'), ('q',))
+        self.assertEqual(self.parse_both((Expr, 'x'), 'xx'), ('x', 'x'))
+
+    def test_fused(self):
+        Expr = ('(', AnyOf('x', 'xy'), Opt(AnyOf('+', '-')), ')')
+        parser = sourcer.compiler.compile(Expr)
+        self.assertIs(parser.factory, sourcer.compiler._fused_text_parser)
+        self.assertEqual(self.parse_both(Expr, '(x-)'), ('(', 'x', '-', ')'))
+        self.assertEqual(self.parse_both(Expr, '(x)'), ('(', 'x', None, ')'))
+        with self.assertRaises(ParseError):
+            self.parse_both(Expr, '(xy)')
+
+    def test_tokens(self):
+        T = TokenSyntax()
+        T.Word = r'[a-z]+'
+        T.Space = Skip(r'\s+')
+        Expr = List(AnyOf('if', 'then', 'else'))
+        ans = self.parse_both(Expr, tokenize(T, 'if then if else'))
+        self.assertEqual(ans, ['if', 'then', 'if', 'else'])
+        with self.assertRaises(ParseError):
+            self.parse_both(Expr, tokenize(T, 'if what'))
+
+
+class TestScan(BothBackends, unittest.TestCase):
+    def parse_all(self, expression, source):
+        ans = self.parse_both(expression, source)
+        self.assertEqual(ans, parse(expression, source, deferred=True))
+        unfused = sourcer.compiler.compile(expression, fuse=False)
+        self.assertEqual(ans, sourcer.interpreter._run(unfused, source, 0,
+            'interpreter').value)
+        return ans
+
+    def is_scan(self, expression):
+        parser = sourcer.compiler.compile(expression)
+        return getattr(parser, 'factory', None) is sourcer.compiler._scan_parser
+
+    def test_values(self):
+        Words = List(Pattern(r'\w+') << Opt(' '))
+        self.assertTrue(self.is_scan(Words))
+        self.assertEqual(self.parse_all(Words, 'foo bar baz'),
+            ['foo', 'bar', 'baz'])
+        self.assertEqual(self.parse_all(Words, ''), [])
+        Pairs = List(('(', AnyOf('x', 'y'), ')'))
+        self.assertTrue(self.is_scan(Pairs))
+        self.assertEqual(self.parse_all(Pairs, '(x)(y)'),
+            [('(', 'x', ')'), ('(', 'y', ')')])
+
+    def test_stops_like_a_list(self):
+        # The scan stops at the first failure, and at the first empty match.
+        Digits = (List(Pattern(r'\d*') << ','), Pattern(r'.*'))
+        self.assertEqual(self.parse_all(Digits, '1,22,,3'),
+            (['1', '22', ''], '3'))
+        Runs = (List(Pattern(r'\d*')), Pattern(r'.*'))
+        self.assertEqual(self.parse_all(Runs, '12x'), (['12'], 'x'))
+        Items = (List('ab'), Pattern(r'.*'))
+        self.assertEqual(self.parse_all(Items, 'ababa'), (['ab', 'ab'], 'a'))
+
+    def test_some(self):
+        Numbers = Some(Pattern(r'\d+') << ' ')
+        self.assertEqual(parse(Numbers, '1 2 '), ['1', '2'])
+        with self.assertRaises(ParseError):
+            parse(Numbers, '')
+        self.assertTrue(recognize(Numbers, '1 2 3 '))
+        self.assertFalse(recognize(Numbers, ''))
+
+    def test_recognize(self):
+        Words = List(Pattern(r'[a-z]+') << ' ')
+        parser = sourcer.compiler.compile(Words, recognize=True)
+        self.assertIs(parser.factory, sourcer.compiler._scan_parser)
+        self.assertEqual(sourcer.interpreter._run(parser, 'a b c ', 0,
+            'interpreter'), (3, 6))
+        self.assertEqual(recognize(Words, 'a b c d', partial=True), 6)
+
+    def test_unfusable_elements(self):
+        Int = Pattern(r'\d+') * int
+        self.assertFalse(self.is_scan(List(Int << ',')))
+        self.assertFalse(self.is_scan(List(Memo(Pattern(r'\d')))))
+        self.assertEqual(self.parse_all(List(Int << ','), '1,2,'), [1, 2])
+
+
+class TestGrammarCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = GrammarCache(tempfile.mkdtemp())
+
+    def grammar(self):
+        # Returns a new grammar each time, with the same structure.
+        T = TokenSyntax()
+        T.Number = r'\d+'
+        T.Symbol = AnyChar('+-()')
+        T.Space = Skip(r'\s+')
+        Int = Content(T.Number) * int
+        Expr = ForwardRef(lambda: Sum | Term)
+        Term = Int | '(' >> Expr << ')'
+        Sum = Or((Expr, '+', Term), (Expr, '-', Term))
+        return T, Expr
+
+    def plans(self, parser):
+        nodes = sourcer.cache._nodes(parser)
+        indexes = dict((id(node), i) for i, node in enumerate(nodes))
+        classes = dict((id(node.arg), i) for i, node in enumerate(nodes)
+            if hasattr(node, 'factory') and isinstance(node.arg, type))
+        return [sourcer.cache._save_plan(i, indexes, classes) for i in nodes]
+
+    def test_plans(self):
+        T1, Expr1 = self.grammar()
+        first = sourcer.compiler.compile(Expr1, False, cache=self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        T2, Expr2 = self.grammar()
+        second = sourcer.compiler.compile(Expr2, False, cache=self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.plans(first), self.plans(second))
+        source = '1 - (2 + 3) + 4'
+        ans = parse(Expr2, tokenize(T2, source), cache=self.cache)
+        self.assertEqual(ans, ((1, '-', (2, '+', 3)), '+', 4))
+        ans = parse(Expr2, tokenize(T2, source), backend='codegen')
+        self.assertEqual(ans, ((1, '-', (2, '+', 3)), '+', 4))
+
+    def test_code(self):
+        for index in range(2):
+            T, Expr = self.grammar()
+            ans = parse(Expr, tokenize(T, '1+2'), backend='codegen',
+                cache=self.cache)
+            self.assertEqual(ans, (1, '+', 2))
+        # One plan and one program, each missed once and then found.
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+    def test_structs(self):
+        class Pair(Struct):
+            def parse(self):
+                self.left = Pattern(r'\d+') * int
+                self.right = ',' >> Pattern(r'[a-z]+')
+        parser = Parser(Pair, cache=self.cache)
+        self.assertEqual(parser.parse('1,a').left, 1)
+        ans = parse(Grammar(Pair), '2,b', cache=self.cache)
+        self.assertEqual(ans.right, 'b')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_changes_and_damaged_files(self):
+        sourcer.compiler.compile(('a', List('b')), cache=self.cache)
+        sourcer.compiler.compile(('a', List('c')), cache=self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        for name in os.listdir(self.cache.directory):
+            with open(os.path.join(self.cache.directory, name), 'wb') as f:
+                f.write('junk')
+        Goal = ('a', List('b'))
+        self.assertEqual(parse(Goal, 'abb', cache=self.cache),
+            ('a', ['b', 'b']))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 3))
+        self.assertEqual(len(os.listdir(self.cache.directory)), 2)
+
+
+class TestPasses(unittest.TestCase):
+    def compile(self, expression, passes=None, **options):
+        manager = PassManager(passes)
+        parser = sourcer.compiler.compile(expression, passes=manager,
+            fuse=False, **options)
+        return parser, manager.stats
+
+    def only(self, name):
+        return [i for i in sourcer.compiler.DEFAULT_PASSES if i[0] == name]
+
+    def test_stats(self):
+        parser, stats = self.compile(Or((Name, Opt(Return(1))), Name))
+        self.assertEqual([i.name for i in stats],
+            ['inline', 'flatten', 'fold', 'prune', 'merge'])
+        for prev, next in zip(stats, stats[1:]):
+            self.assertEqual(prev.after, next.before)
+        self.assertEqual(stats[3].rewrites, 1)
+        self.assertEqual(stats[3].before - stats[3].after, 1)
+
+    def test_inline(self):
+        parser, stats = self.compile(Right(Return(5), Left(Name, None)))
+        self.assertIsInstance(parser, sourcer.compiler._TransformParser)
+        self.assertEqual(stats[0].rewrites, 2)
+        # A parser that a Memo expression refers to stays put.
+        parser, stats = self.compile(Memo(Left(Name, None)))
+        self.assertIsInstance(parser, sourcer.compiler._LeftParser)
+        self.assertTrue(parser.memoize)
+
+    def test_flatten(self):
+        Inner = ForwardRef(lambda: Or(Int, Name))
+        parser, stats = self.compile(Or(Int * str, Inner), self.only('flatten'))
+        self.assertEqual(len(parser.parsers), 3)
+        self.assertEqual(parse(Or(Int * str, Inner), 'x'), 'x')
+        Goal = (('a', Name), Name)
+        parser, stats = self.compile(Goal, self.only('flatten'),
+            recognize=True)
+        self.assertEqual(len(parser.parsers), 3)
+        parser, stats = self.compile(Goal, self.only('flatten'))
+        self.assertEqual(len(parser.parsers), 2)
+
+    def test_fold(self):
+        parser, stats = self.compile((None, Return(1)))
+        self.assertIs(parser.factory, sourcer.compiler._return_parser)
+        self.assertEqual(parse((None, Return(1)), ''), (None, 1))
+        parser, stats = self.compile(Not(None))
+        self.assertIs(parser, sourcer.compiler._fail_parser)
+
+    def test_prune(self):
+        Goal = Or(Opt(Pattern('[a-z]+')), Int)
+        parser, stats = self.compile(Goal)
+        self.assertEqual(len(parser.parsers), 2)
+        self.assertEqual(parse(Goal, 'x'), 'x')
+        self.assertEqual(parse(Goal, ''), None)
+        with self.assertRaises(ParseError):
+            parse(Goal, '1')
+
+    def test_left_recursion(self):
+        # A left-recursive Or grows its result, so its alternatives can't
+        # move into another Or.
+        Expr = ForwardRef(lambda: Or((Expr, '+', Int), Int))
+        Goal = Or(Expr, Opt(Name))
+        parser, stats = self.compile(Goal)
+        self.assertEqual(parse(Goal, '1+2+3'), (((1, '+', 2), '+', 3)))
+        self.assertEqual(parse(Goal, 'a'), 'a')
+        self.assertEqual(len(parser.parsers), 3)
+        self.assertEqual(len(parser.parsers[0].parsers), 2)
+
+    def test_merge(self):
+        Goal = Or((Left(Int, None), 'x'), (Left(Int, Return(None)), 'y'))
+        parser, stats = self.compile(Goal, self.only('merge'))
+        first, second = [i.parsers[0] for i in parser.parsers]
+        self.assertIs(first, second)
+        self.assertEqual(stats[0].rewrites, 1)
+        self.assertEqual(parse(Goal, '1y'), (1, 'y'))
+
+    def test_parser(self):
+        manager = PassManager()
+        parser = Parser(Or(Opt('a'), 'b'), passes=manager)
+        self.assertEqual(parser.parse('a'), 'a')
+        self.assertEqual(parser.recognize(''), True)
+        # The stats are for the last compile: the recognizer.
+        self.assertEqual(len(manager.stats), 5)
+
+    def test_left_recursive_wrappers(self):
+        # The Left is the head of a left-recursive cycle, so it stays.
+        Expr = ForwardRef(lambda: Left(Or((Expr, '+', Int), Int), Return(7)))
+        parser, stats = self.compile(Expr, self.only('inline'))
+        self.assertIsInstance(parser, sourcer.compiler._LeftParser)
+        self.assertEqual(stats[0].rewrites, 0)
+        self.assertEqual(parse(Expr, '1+2+3'), ((1, '+', 2), '+', 3))
+
+    def test_labels(self):
+        # The inline pass drops the parser of the Left, so it has no label.
+        # Every label belongs to a parser that is still in the graph.
+        Wrapper = Left(Name, None)
+        labels = {}
+        parser = sourcer.compiler.compile((Wrapper, End), labels=labels)
+        nodes = sourcer.compiler._unplanned_parsers(parser, None)
+        self.assertTrue(all(any(i is j for j in nodes) for i in labels))
+        self.assertNotIn(Wrapper, [i for names in labels.values() for i in names])
+        self.assertEqual(labels[sourcer.compiler._end_parser], [End])
+
+    def test_no_passes(self):
+        parser, stats = self.compile(Left(Name, None), [])
+        self.assertIsInstance(parser, sourcer.compiler._LeftParser)
+        self.assertEqual(stats, [])
+
+
+class TestBindCache(unittest.TestCase):
+    def test_eviction(self):
+        Run = Bind(Int, lambda count: 'z' * count)
+        cache = BindCache(max_size=3)
+        parser = Parser(List(Run), bind_cache=cache)
+        counts = [i % 5 + 1 for i in range(49)]
+        source = ''.join('%d%s' % (i, 'z' * i) for i in counts)
+        self.assertEqual(parser.parse(source), parse(List(Run), source))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.misses, cache.evictions + 3)
+        self.assertEqual(cache.hits + cache.misses, 49)
+
+    def test_shares_parsers(self):
+        Run = Bind(Int, lambda count: (',', Int, 'z' * count))
+        parser = sourcer.compiler.compile(Run, fuse=False)
+        compiler = parser.bind.__self__
+        size = len(compiler.map)
+        bound = parser.bind(2, parser.function)
+        self.assertIs(bound.parsers[1], parser.parser)
+        self.assertIs(parser.bind(2, parser.function), bound)
+        self.assertEqual(len(compiler.map), size)
+        self.assertEqual(parse(Run, '2,3zz'), (',', 3, 'zz'))
+
+    def test_threads(self):
+        import threading
+        # Threads that parse with the same expression share its grammar.
+        Run = Bind(Int, lambda count: Some('z' * count))
+        Goal = List(Run << ';')
+        sources = ['%d%s;' % (i, 'z' * i) * 3 for i in range(1, 9)]
+        results = {}
+        def work(index):
+            for source in sources:
+                results[index, source] = parse(Goal, source)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for (index, source), ans in results.items():
+            self.assertEqual(len(ans), 3)
+            self.assertEqual(ans, parse(Goal, source, backend='codegen'))
+        binds = [i for i in sourcer.cache._nodes(sourcer.compiler.compile(Goal))
+            if isinstance(i, sourcer.compiler._BindParser)]
+        self.assertEqual(binds[0].bind.__self__.bind_cache.misses, 8)
+        self.assertEqual(len(results), 32)
+
+
+class TestGrammar(unittest.TestCase):
+    def test_struct_roots(self):
+        class Pair(Struct):
+            def parse(self):
+                self.left = Int
+                self.right = ',' >> Int
+
+        class Triple(Pair):
+            def parse(self):
+                Pair.parse(self)
+                self.third = ',' >> Int
+
+        for source in ['1,2', '3,4', '5,6']:
+            parse(Pair, source)
+        self.assertTrue(recognize(Pair, '7,8'))
+        self.assertEqual(shared_grammar(Pair).compiles, 2)
+        ans = parse(Triple, '1,2,3')
+        self.assertEqual((ans.left, ans.right, ans.third), (1, 2, 3))
+        self.assertIsNot(shared_grammar(Triple), shared_grammar(Pair))
+        self.assertEqual(shared_grammar(Triple).compiles, 1)
+
+    def test_modes(self):
+        Goal = Some(AnyInst(int)) | List(Int << ';')
+        grammar = Grammar(Goal)
+        self.assertEqual(parse(grammar, '1;2;'), [1, 2])
+        self.assertEqual(parse(grammar, [3, 4]), [3, 4])
+        self.assertEqual(parse(grammar, '5;', deferred=True), [5])
+        self.assertEqual(Parser(grammar).parse('6;'), [6])
+        self.assertEqual(grammar.compiles, 3)
+        self.assertIs(grammar.compile(), grammar.compile(True))
+        self.assertIsNone(shared_grammar('a'))
+
+    def test_caches(self):
+        # A cache that comes after a compile still gets the grammar.
+        grammar = Grammar(List(Int << ';'))
+        cache = GrammarCache(tempfile.mkdtemp())
+        parse(grammar, '1;')
+        self.assertEqual(parse(grammar, '2;', cache=cache), [2])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        parse(grammar, '3;', cache=cache)
+        self.assertEqual(grammar.compiles, 2)
+        self.assertEqual(parse(Grammar(grammar.expression), '4;', cache=cache),
+            [4])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        with self.assertRaises(ValueError):
+            sourcer.compiler.compile(grammar, bind_cache=BindCache())
+
+    def test_threads(self):
+        import threading
+        import time
+        # The pass keeps the first thread compiling while the others start.
+        def slow(root, pinned):
+            time.sleep(0.05)
+            return root, 0
+        grammar = Grammar(List(Int << ';'), passes=[('slow', slow)])
+        results = []
+        def work():
+            results.append(parse(grammar, '1;2;3;'))
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[1, 2, 3]] * 8)
+        self.assertEqual(grammar.compiles, 1)
+
+
+class TestParseAsync(unittest.TestCase):
+    def drive(self, awaitable):
+        # Runs the awaitable like an event loop would, and returns its value
+        # and the list of the things that it yielded.
+        iterator = awaitable.__await__()
+        yielded = []
+        try:
+            while True:
+                yielded.append(iterator.send(None))
+        except StopIteration as e:
+            return e.args[0], yielded
+
+    def test_pauses(self):
+        Goal = List(Int << ',')
+        source = '1,22,333,' * 100
+        task = parse_async(Goal, source, step_budget=50)
+        value, yielded = self.drive(task)
+        self.assertEqual(value, parse(Goal, source))
+        self.assertEqual(task.value, value)
+        self.assertGreater(task.pauses, 10)
+        self.assertEqual(yielded, [None] * task.pauses)
+        task = parse_async(Goal, source, step_budget=10 ** 9)
+        self.assertEqual(list(task), [])
+        self.assertEqual(task.value, value)
+
+    def test_errors_and_options(self):
+        task = parse_async(List(Int << ','), '1,2,x', step_budget=1)
+        with self.assertRaises(ParseError):
+            list(task)
+        Goal = (Int * (lambda x: x * 2)) << ';'
+        value, _ = self.drive(parse_async(Goal, '21;', deferred=True))
+        self.assertEqual(value, 42)
+        with self.assertRaises(ValueError):
+            parse_async(Goal, '21;', step_budget=0)
+
+    def test_readers(self):
+        class Read(object):
+            # An awaitable that waits for one "future" and returns a chunk.
+            def __init__(self, chunk):
+                self.chunk = chunk
+                self.waited = False
+            def __await__(self):
+                return self
+            def next(self):
+                if self.waited:
+                    raise StopIteration(self.chunk)
+                self.waited = True
+                return 'future'
+            def send(self, value):
+                return self.next()
+
+        class Reader(object):
+            def __init__(self, source):
+                self.source = source
+            def read(self, size):
+                chunk, self.source = self.source[:size], self.source[size:]
+                return Read(chunk)
+
+        Goal = List(Int << ',')
+        source = '1,22,333,' * 20
+        task = parse_async(Goal, Reader(source), chunk_size=64)
+        value, yielded = self.drive(task)
+        self.assertEqual(value, parse(Goal, source))
+        self.assertEqual(yielded.count('future'), 4)
+        import StringIO
+        task = parse_async(Goal, StringIO.StringIO(source), chunk_size=7)
+        self.assertEqual(self.drive(task)[0], value)
+
+
+class TestParseBudget(unittest.TestCase):
+    def exceeds(self, budget, expression, source, **options):
+        with self.assertRaises(ParseBudgetExceeded) as context:
+            parse(expression, source, budget=budget, **options)
+        return context.exception
+
+    def test_limits(self):
+        Goal = List(Int << ',')
+        source = '1,22,333,' * 200
+        self.assertEqual(len(parse(Goal, source, budget=ParseBudget(
+            steps=10000, memo_size=10000, depth=10, seconds=10))), 600)
+        error = self.exceeds(ParseBudget(steps=100, interval=30), Goal, source)
+        self.assertEqual(error.limit, 'steps')
+        self.assertEqual(error.stats.steps, 100)
+        Pairs = List(Or((Int, ','), (Int, ';')))
+        error = self.exceeds(ParseBudget(memo_size=50), Pairs, '1,2;' * 100)
+        self.assertEqual(error.limit, 'memo_size')
+        self.assertGreater(error.stats.memo_size, 50)
+        error = self.exceeds(ParseBudget(seconds=0), Goal, source)
+        self.assertEqual(error.limit, 'seconds')
+        self.assertNotIsInstance(error, ParseError)
+
+    def test_depth(self):
+        Expr = ForwardRef(lambda: Or(('(', Expr, ')'), 'x'))
+        source = '(' * 500 + 'x' + ')' * 500
+        error = self.exceeds(ParseBudget(depth=200, interval=10), Expr, source)
+        self.assertEqual(error.limit, 'depth')
+        self.assertLess(error.stats.depth, 220)
+        self.assertGreater(error.stats.seconds, 0)
+        with self.assertRaises(ValueError):
+            parse(Expr, 'x', budget=ParseBudget(), backend='codegen')
+
+
+class TestParseErrorLocations(unittest.TestCase):
+    def error(self, expression, source, **options):
+        with self.assertRaises(ParseError) as context:
+            parse(expression, source, **options)
+        return context.exception
+
+    def test_farthest_failure(self):
+        Expr = ForwardRef(lambda: Or((Term, '+', Expr), Term))
+        Term = Int | ('(', Expr, ')') | Pattern('[a-z]+')
+        error = self.error(Expr, '1+(2+\n')
+        self.assertEqual(error.position, 5)
+        self.assertEqual((error.line, error.column), (1, 6))
+        self.assertEqual(error.expected, ["'('", '[a-z]+', '\\d+'])
+        error = self.error(Expr, 'a+b)')
+        self.assertEqual(error.expected, ["'+'", 'end of input'])
+        self.assertEqual(str(error),
+            "Expected '+' or end of input at line 1, column 4.")
+        error = self.error(List(Pattern(r'[a-z]+\n')), 'ab\ncd\nx1\n')
+        self.assertEqual((error.position, error.line, error.column), (6, 3, 1))
+
+    def test_fused_terminals(self):
+        Group = ('(', Pattern(r'\d+'), ')')
+        error = self.error(List(Group), '(1)(12]')
+        self.assertEqual((error.position, error.expected), (6, ["')'"]))
+        error = self.error(Some(Group), 'x')
+        self.assertEqual((error.position, error.expected), (0, ["'('"]))
+
+    def test_no_duplicates(self):
+        # The FIRST set of the operand says "[\d]", but the terminal says
+        # "\d+" for itself.
+        Expr = OperatorPrecedence(
+            Int | ('(' >> ForwardRef(lambda: Expr) << ')'),
+            InfixLeft('+'),
+        )
+        for source in ['(', '1+(x', '((']:
+            error = self.error(Expr, source)
+            self.assertEqual(error.expected, ["'('", '\\d+'])
+            self.assertEqual(len(set(error.expected)), len(error.expected))
+
+    def test_tokens_and_parsers(self):
+        T = TokenSyntax()
+        T.Number = r'\d+'
+        T.Symbol = AnyChar('+-')
+        Goal = (T.Number, '+', T.Number)
+        error = self.error(Goal, tokenize(T, '1-2'))
+        self.assertEqual((error.position, error.line), (1, None))
+        self.assertEqual(error.expected, ["'+'"])
+        self.assertEqual(str(error), "Expected '+' at position 1.")
+        parser = Parser(List(Int << ','))
+        error = parser.try_parse('1,2,x')
+        self.assertEqual(error.expected, ['\\d+', 'end of input'])
+        error = Parser(Int, backend='codegen').try_parse('x')
+        self.assertIsNone(error.position)
+        import pickle
+        error = pickle.loads(pickle.dumps(self.error(Int, '12x')))
+        self.assertEqual((error.position, error.column), (2, 3))
+
+
+class TestParseProfile(unittest.TestCase):
+    def test_counts(self):
+        T = TokenSyntax()
+        T.Number = r'\d+'
+        T.Symbol = AnyChar(',;')
+
+        class Pair(Struct):
+            def parse(self):
+                self.left = T.Number
+                self.right = ',' >> T.Number
+
+        Word = Memo(Regex('[a-z]+'))
+        Item = Or((Word, '!'), (Word, '?'))
+        profile = ParseProfile()
+        parse(List(Item), 'a?bc!d?', profile=profile)
+        parse(List(Pair << ';'), tokenize(T, '1,2;3,4;'), profile=profile)
+        rows = dict((i.rule, i) for i in profile.rows())
+        self.assertEqual(rows['Pair'][1:5], (3, 0, 0, 1))
+        self.assertEqual(rows['Number'].calls, 5)
+        self.assertEqual(rows["Regex('[a-z]+')"][1:5], (5, 2, 3, 0))
+        for row in rows.values():
+            self.assertGreaterEqual(row.inclusive, row.exclusive)
+        profile = ParseProfile()
+        parse(List(Item), 'a?bc!d?', profile=profile)
+        parse(List(Item), 'e!', profile=profile)
+        row = [i for i in profile.rows() if i.rule.startswith('Regex')][0]
+        self.assertEqual(row.calls, 6)
+
+    def test_reports(self):
+        import pstats
+        import StringIO
+        Expr = ForwardRef(lambda: Or((Expr, '+', Int), Int))
+        profile = ParseProfile()
+        self.assertEqual(parse(Expr, '1+2+3', profile=profile),
+            ((1, '+', 2), '+', 3))
+        rows = profile.rows('calls')
+        self.assertEqual(rows, sorted(rows, key=lambda i: -i.calls))
+        self.assertEqual([i.rule for i in profile.rows('rule')],
+            sorted(i.rule for i in rows))
+        lines = profile.report(limit=2).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn(profile.rows()[0].rule, lines[1])
+        out = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats('cumulative').print_stats()
+        self.assertIn('<grammar>', out.getvalue())
+        with self.assertRaises(ValueError):
+            profile.rows('speed')
+        with self.assertRaises(ValueError):
+            parse(Expr, '1', profile=profile, backend='codegen')
+
+
+class TestParseTrace(unittest.TestCase):
+    def test_events(self):
+        Word = Memo(Regex('[a-z]+'))
+        Item = Or((Word, '!'), (Word, '?'))
+        trace = ParseTrace()
+        self.assertEqual(len(parse(List(Item), 'a?', trace=trace)), 1)
+        depth = 0
+        for event in trace.events:
+            if event.kind == 'enter':
+                depth += 1
+            elif event.kind == 'exit':
+                depth -= 1
+            self.assertGreaterEqual(depth, 0)
+        self.assertEqual(depth, 0)
+        hits = [i for i in trace.events if i.kind == 'memo_hit']
+        self.assertEqual([(i.rule, i.pos, i.end) for i in hits],
+            [("Regex('[a-z]+')", 0, 1)])
+        exits = [i for i in trace.events if i.kind == 'exit']
+        self.assertIn(("'!'", 1, None), [i[1:3] + i[4:] for i in exits])
+
+    def test_exporters(self):
+        import json
+        Expr = ForwardRef(lambda: Or((Expr, ';', Int), Int))
+        trace = ParseTrace()
+        parse(Expr, '1;2', trace=trace)
+        events = json.loads(trace.chrome_trace())['traceEvents']
+        self.assertEqual(len(events), len(trace.events))
+        phases = [i['ph'] for i in events]
+        self.assertEqual(phases.count('B'), phases.count('E'))
+        self.assertIn('i', phases)
+        for line in trace.collapsed().splitlines():
+            path, weight = line.rsplit(' ', 1)
+            self.assertGreater(int(weight), 0)
+            self.assertNotIn("';'", path.split(';'))
+
+    def test_unfinished_parsers(self):
+        # A Commit drops the parsers that were running. The exporters close
+        # them.
+        import json
+        Goal = Or(('a', Commit, 'b'), 'ac')
+        trace = ParseTrace()
+        with self.assertRaises(ParseError):
+            parse(Goal, 'ac', trace=trace)
+        self.assertTrue(trace.running)
+        phases = [i['ph'] for i in json.loads(trace.chrome_trace())[
+            'traceEvents']]
+        self.assertEqual(phases.count('B'), phases.count('E'))
+        self.assertFalse(trace.running)
+
+    def test_hooks(self):
+        class Hook(object):
+            def __init__(self):
+                self.events = []
+            def enter(self, parser, pos):
+                self.events.append(('enter', pos))
+            def exit(self, parser, pos, ans):
+                self.events.append(('exit', pos))
+            def memo_hit(self, parser, pos, ans):
+                self.events.append(('memo_hit', pos))
+        hook = Hook()
+        parse(List(Int << ','), '1,2,', trace=hook)
+        self.assertIn(('enter', 2), hook.events)
+        with self.assertRaises(ValueError):
+            parse('a', 'a', trace=hook, backend='codegen')
+        with self.assertRaises(ValueError):
+            parse('a', 'a', trace=hook, profile=ParseProfile())
+
+
+class TestMemoization(unittest.TestCase):
+    def test_leaves_and_single_callers(self):
+        Goal = ('A', List(Pattern(r'\d')))
+        parser = sourcer.compiler.compile(Goal, fuse=False)
+        self.assertFalse(parser.memoize)
+        list_parser = parser.parsers[1]
+        self.assertFalse(list_parser.memoize)
+        self.assertFalse(list_parser.parser.memoize)
+        self.assertFalse(list_parser.parser.parser.memoize)
+
+    def test_shared_and_recursive_parsers(self):
+        Value = Pattern(r'\d+')
+        Pair = Or((Value, '+', Value), (Value, '-', Value))
+        parser = sourcer.compiler.compile(Pair, fuse=False)
+        self.assertTrue(parser.parsers[0].parsers[0].memoize)
+        Parens = '(' >> ForwardRef(lambda: Parens) << ')' | 'x'
+        parser = sourcer.compiler.compile(Parens)
+        self.assertTrue(parser.memoize)
+
+    def test_memo_hints(self):
+        Word = Pattern(r'\w+')
+        Space = Pattern(r'\s+')
+        Goal = (Memo(Regex('A')), NoMemo(Space), Word, Space, Word)
+        parser = sourcer.compiler.compile(Goal)
+        self.assertTrue(parser.parsers[0].memoize)
+        self.assertFalse(parser.parsers[1].memoize)
+        self.assertFalse(parser.parsers[3].memoize)
+        self.assertTrue(parser.parsers[2].memoize)
+        self.assertEqual(parse(Goal, 'A b c')[2:], ('b', ' ', 'c'))
+
+    def test_no_memo_in_cycles(self):
+        # The memo table keeps left recursion from looping forever, so NoMemo
+        # doesn't apply to the head of a cycle.
+        Expr = ForwardRef(lambda: NoMemo(Or((Expr, '+', 'x'), 'x')))
+        self.assertTrue(sourcer.compiler.compile(Expr).memoize)
+        for backend in ['interpreter', 'codegen']:
+            self.assertEqual(parse(Expr, 'x+x+x', backend=backend),
+                (('x', '+', 'x'), '+', 'x'))
+
+    def test_smaller_memo_table(self):
+        Int = Pattern(r'\d+') * int
+        Ints = List(Int << Opt(','))
+        source = ','.join(str(i) for i in range(100))
+        parser = sourcer.compiler.compile(Ints)
+        interpreter = sourcer.interpreter._Interpreter(source)
+        ans = interpreter.run(parser)
+        self.assertEqual(ans.value, range(100))
+        self.assertEqual(len(interpreter.memo), 0)
+
+
+class TestWindowedMemo(unittest.TestCase):
+    def grammar(self):
+        Word = Memo(Pattern(r'\w+'))
+        Line = Or((Word, '=', Word), Word) << '\n'
+        return List(Line)
+
+    def test_window(self):
+        source = 'x=y\nz\n' * 2000
+        memo = WindowedMemo(window=8, min_sweep=64)
+        ans = parse(self.grammar(), source, memo=memo)
+        self.assertEqual(ans, parse(self.grammar(), source))
+        self.assertTrue(memo.evictions > 0)
+        self.assertTrue(len(memo) < 200)
+
+    def test_budget(self):
+        source = 'x=y\nz\n' * 2000
+        memo = WindowedMemo(window=None, max_size=100, min_sweep=16)
+        ans = parse(self.grammar(), source, memo=memo)
+        self.assertEqual(len(ans), 4000)
+        self.assertTrue(memo.evictions > 0)
+        self.assertTrue(len(memo) <= 100)
+
+    def test_backtracking_past_the_window(self):
+        # The Or has to go back to the start when the first line is missing
+        # its terminator, so the window must not evict those entries.
+        Word = Memo(Pattern(r'\w+'))
+        Lines = List(Word << '\n')
+        Goal = Or(Lines << End, (Lines, Word))
+        source = 'a\n' * 500 + 'b'
+        memo = WindowedMemo(window=0, min_sweep=8)
+        ans = parse(Goal, source, memo=memo)
+        self.assertEqual(ans, (['a'] * 500, 'b'))
+
+    def test_memo_table_is_not_reusable(self):
+        memo = WindowedMemo()
+        parse(self.grammar(), 'a\n', memo=memo)
+        with self.assertRaises(ValueError):
+            parse(self.grammar(), 'a\n', memo=memo)
+
+    def test_always_succeeds(self):
+        parser = sourcer.compiler.compile((List('a'), Opt('b'), 'c'))
+        self.assertFalse(parser.always_succeeds)
+        self.assertTrue(parser.parsers[0].always_succeeds)
+        self.assertTrue(parser.parsers[1].always_succeeds)
+        self.assertFalse(parser.parsers[2].always_succeeds)
+
+
 if __name__ == '__main__':
     unittest.main()